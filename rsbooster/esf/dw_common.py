@@ -0,0 +1,2198 @@
+"""Shared helpers for the Double-Wilson ESF tools (rs.dw_extrapolate and
+rs.mle_dw_extrapolate).
+
+Notes
+-----
+    - Monte Carlo samples are drawn once as standard normals and pushed through the
+    Cholesky factor of the Double-Wilson covariance for a given r
+    - Everything the per-reflection likelihood needs from the samples depends only on
+    (r, p), so it is computed once per run as a "sample table" and shared with the
+    workers
+    - The same integrals can instead be computed deterministically by Gauss-Legendre
+    quadrature over |GS| and |ON| with the relative phase integrated analytically (see
+    :func:`quadrature_reflections`)
+    - If Numba is installed, the Monte Carlo sums run in a fused, JIT-compiled kernel
+    that makes one pass over the samples per reflection without (reflections x samples)
+    temporaries (see :func:`fused_reflections`)
+    - Samples and sample tables can be kept in an on-disk sample bank (see
+    :func:`sample_bank`), which workers memory-map read-only instead of receiving copies
+    in shared memory
+"""
+
+import contextlib
+import hashlib
+import json
+import mmap
+import os
+import warnings
+import numpy as np
+import reciprocalspaceship as rs
+from multiprocessing import shared_memory
+from reciprocalspaceship.algorithms.scale_merged_intensities import (
+    mean_intensity_by_resolution,
+)
+from scipy.special import expit, i0e, i1e, log_ndtr, logsumexp, ndtr, ndtri
+from scipy.stats import norm, qmc
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+LOG_SQRT_2PI = 0.5 * np.log(2 * np.pi)
+
+# Names of the arrays in a sample table, for acentric ("ac") and centric ("c")
+# reflections
+SAMPLE_TABLE_KEYS = (
+    "OF_abs_ac",
+    "ON_abs_ac",
+    "ES_abs_ac",
+    "OF_abs_c",
+    "ON_abs_c",
+    "ES_abs_c",
+)
+
+# Posterior quantiles of |ES| returned by estimate_reflections(quantiles=True), keyed by
+# output name
+ES_QUANTILES = {"ES_q05": 0.05, "ES_q50": 0.5, "ES_q95": 0.95}
+
+
+def sobol_normal_samples(nsamples, seed=None, replicates=1):
+    """Standard normal draws from scrambled Sobol points for randomized quasi-Monte
+    Carlo.
+
+    Each replicate is an independently scrambled Sobol sequence of 2**m points, with m
+    chosen so that all replicates together hold at least ``nsamples`` points, mapped to
+    normals by the inverse normal CDF. The replicates are stored one after the other, so
+    the spread of an estimate across replicates gives its randomized QMC standard error
+    (see ``replicates`` in :func:`estimate_reflections`).
+
+    Parameters
+    ----------
+    nsamples : int
+        Minimum total number of samples
+    seed : int, optional
+        Seed for the scrambling
+    replicates : int
+        Number of independently scrambled replicates
+
+    Returns
+    -------
+    (raw_Z_ac, raw_Z_c) : tuple of np.ndarray
+        (n, 4) and (n, 2) float32 standard normal samples, with
+        n = replicates * 2**m >= nsamples
+    """
+    rng = np.random.default_rng(seed)
+    m = max(int(np.ceil(np.log2(max(nsamples / replicates, 1)))), 0)
+    tiny = np.finfo(np.float64).tiny
+    raw_Z = []
+    for d in (4, 2):
+        blocks = []
+        for _ in range(replicates):
+            u = qmc.Sobol(d=d, scramble=True, seed=rng).random_base2(m)
+            blocks.append(ndtri(np.clip(u, tiny, 1 - 2**-53)).astype(np.float32))
+        raw_Z.append(np.concatenate(blocks))
+    return tuple(raw_Z)
+
+
+def antithetic_samples(raw_Z_ac, raw_Z_c):
+    """Follow every standard normal sample by its antithetic partner.
+
+    Negating all components would leave every amplitude unchanged, so the partner only
+    negates the innovation of ES, i.e. the components that ES does not share with GS
+    (columns 2 and 3 of the acentric and column 1 of the centric samples). |GS| is the
+    same for both members of a pair and ES is reflected about r GS. Pairs are stored
+    next to each other, so prefixes and replicate blocks of even length hold whole
+    pairs.
+
+    Returns
+    -------
+    (raw_Z_ac, raw_Z_c) : tuple of np.ndarray
+        Samples of twice the length of the inputs
+    """
+    paired = []
+    for raw_Z, first in ((raw_Z_ac, 2), (raw_Z_c, 1)):
+        partner = raw_Z.copy()
+        partner[:, first:] *= -1
+        paired.append(np.stack([raw_Z, partner], axis=1).reshape(-1, raw_Z.shape[1]))
+    return tuple(paired)
+
+
+def dw_cholesky(r, dtype=np.float32):
+    """Cholesky factors of the acentric and centric Double-Wilson covariances.
+
+    Parameters
+    ----------
+    r : float
+        Double-Wilson correlation between ground and excited state structure factors
+    dtype : np.dtype
+        Floating point type of the returned matrices
+
+    Returns
+    -------
+    (L_ac, L_c) : tuple of np.ndarray
+        (4, 4) factor for acentric samples (Re GS, Im GS, Re ES, Im ES) and (2, 2)
+        factor for centric samples (GS, ES)
+    """
+    L_ac = np.sqrt(0.5) * np.array(
+        [
+            [1, 0, 0, 0],
+            [0, 1, 0, 0],
+            [r, 0, np.sqrt(1 - r**2), 0],
+            [0, r, 0, np.sqrt(1 - r**2)],
+        ],
+        dtype=dtype,
+    )
+    L_c = np.array([[1, 0], [r, np.sqrt(1 - r**2)]], dtype=dtype)
+    return L_ac, L_c
+
+
+def sample_table(
+    raw_Z_ac,
+    raw_Z_c,
+    r,
+    p,
+    dtype=np.float32,
+    gradient=False,
+    analytic_k=False,
+    sort_es=False,
+):
+    """Transform standard normal samples into the quantities used by the likelihood.
+
+    For both acentric and centric samples this computes |GS| (OF_abs), |(1-p)GS + p
+    ES| / k (ON_abs) and |ES| (ES_abs), where k = median(|ON|) / median(|GS|) puts the
+    ON amplitudes on the OFF scale. None of these depend on the reflection, so they are
+    computed once per (r, p).
+
+    Parameters
+    ----------
+    raw_Z_ac : np.ndarray
+        (nsamples, 4) standard normal samples for acentric reflections
+    raw_Z_c : np.ndarray
+        (nsamples, 2) standard normal samples for centric reflections
+    r : float
+        Double-Wilson correlation parameter
+    p : float
+        Excited state fraction
+    dtype : np.dtype
+        Floating point type of the returned arrays
+    gradient : bool
+        If True, use the analytic k = sqrt(a^2 + b^2) with a = (1-p) + pr and b = p
+        sqrt(1 - r^2), which is smooth in (r, p), and add the derivatives of ON_abs with
+        respect to r and p as "dON_dr_<case>" and "dON_dp_<case>" (see
+        :func:`estimate_reflections`)
+    analytic_k : bool
+        Use the analytic k without adding derivatives. ON_abs then has the same Wilson
+        distribution as OF_abs, which the control variates of
+        :func:`variance_reduced_reflections` rely on
+    sort_es : bool
+        Order the samples of each case by increasing ES_abs, so that
+        :func:`estimate_reflections` can read posterior quantiles of |ES| off the
+        cumulative sum of the weights. The order of the samples is lost, so this cannot
+        be combined with ``gradient``, QMC replicates or antithetic pairs.
+
+    Returns
+    -------
+    dict
+        Arrays of length nsamples keyed by the names in SAMPLE_TABLE_KEYS
+    """
+    return sample_tables(
+        raw_Z_ac,
+        raw_Z_c,
+        [(r, p)],
+        dtype=dtype,
+        gradient=gradient,
+        analytic_k=analytic_k,
+        sort_es=sort_es,
+    )[0]
+
+
+def sample_tables(
+    raw_Z_ac,
+    raw_Z_c,
+    rp_values,
+    dtype=np.float32,
+    gradient=False,
+    analytic_k=False,
+    sort_es=False,
+):
+    """Sample tables for several (r, p) pairs from the same standard normal samples.
+
+    OF_abs depends on neither r nor p and ES_abs only on r, so the returned tables share
+    those arrays (the same objects) wherever possible; :func:`create_shared_arrays`
+    stores shared arrays only once. With ``sort_es`` the samples are sorted once per r,
+    and OF_abs is only shared between tables with the same r.
+
+    Parameters
+    ----------
+    raw_Z_ac : np.ndarray
+        (nsamples, 4) standard normal samples for acentric reflections
+    raw_Z_c : np.ndarray
+        (nsamples, 2) standard normal samples for centric reflections
+    rp_values : list of (float, float)
+        Double-Wilson correlation and excited state fraction for each table
+    dtype : np.dtype
+        Floating point type of the returned arrays
+    gradient, analytic_k, sort_es : bool
+        See :func:`sample_table`
+
+    Returns
+    -------
+    list of dict
+        One table per (r, p), see :func:`sample_table`
+    """
+    if sort_es and gradient:
+        raise ValueError("Sample tables sorted by ES_abs do not carry derivatives")
+    amplitudes = {}
+    OF_abs = {}
+    tables = []
+    for r, p in rp_values:
+        if r not in amplitudes:
+            L_ac, L_c = dw_cholesky(r, dtype=raw_Z_ac.dtype)
+            E_ac = raw_Z_ac.dot(L_ac.T)
+            E_c = raw_Z_c.dot(L_c.T)
+            amplitudes[r] = {
+                "ac": (E_ac[:, 0] + 1j * E_ac[:, 1], E_ac[:, 2] + 1j * E_ac[:, 3]),
+                "c": (E_c[:, 0], E_c[:, 1]),
+            }
+            for case, (GS, ES) in amplitudes[r].items():
+                ES_abs = np.abs(ES).astype(dtype)
+                if sort_es:
+                    order = np.argsort(ES_abs, kind="stable")
+                    GS, ES, ES_abs = GS[order], ES[order], ES_abs[order]
+                amplitudes[r][case] = (GS, ES, ES_abs)
+                OF_abs.setdefault(
+                    (r, case) if sort_es else case, np.abs(GS).astype(dtype)
+                )
+
+        table = {}
+        for case, (GS, ES, ES_abs) in amplitudes[r].items():
+            table["OF_abs_" + case] = OF_abs[(r, case) if sort_es else case]
+            ON = (1 - p) * GS + p * ES
+            ON_abs = np.abs(ON)
+            if gradient or analytic_k:
+                a, b = (1 - p) + p * r, p * np.sqrt(1 - r**2)
+                k = np.sqrt(a**2 + b**2)
+            else:
+                k = np.median(ON_abs) / np.median(table["OF_abs_" + case])
+            if gradient:
+                table.update(
+                    _on_derivatives(
+                        raw_Z_ac, raw_Z_c, case, GS, ON, ON_abs, r, p, dtype
+                    )
+                )
+            table["ON_abs_" + case] = (ON_abs / k).astype(dtype)
+            table["ES_abs_" + case] = ES_abs
+        tables.append(table)
+    return tables
+
+
+def _on_derivatives(raw_Z_ac, raw_Z_c, case, GS, ON, ON_abs, r, p, dtype):
+    """Derivatives of |ON| / k with respect to r and p for fixed standard normal
+    samples.
+
+    ON = a GS + b W with a = (1-p) + pr, b = p sqrt(1 - r^2) and W the standard normal
+    innovation of ES, and k = sqrt(a^2 + b^2).
+    """
+    if case == "ac":
+        W = np.sqrt(0.5) * (raw_Z_ac[:, 2] + 1j * raw_Z_ac[:, 3])
+    else:
+        W = raw_Z_c[:, 1]
+    a, b = (1 - p) + p * r, p * np.sqrt(1 - r**2)
+    k = np.sqrt(a**2 + b**2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dON_da = np.real(GS * np.conj(ON)) / ON_abs / k - ON_abs * a / k**3
+        dON_db = np.real(W * np.conj(ON)) / ON_abs / k - ON_abs * b / k**3
+    dON_da = np.nan_to_num(dON_da)
+    dON_db = np.nan_to_num(dON_db)
+    da_dr, da_dp = p, r - 1
+    db_dr, db_dp = -p * r / np.sqrt(1 - r**2), np.sqrt(1 - r**2)
+    return {
+        "dON_dr_" + case: (dON_da * da_dr + dON_db * db_dr).astype(dtype),
+        "dON_dp_" + case: (dON_da * da_dp + dON_db * db_dp).astype(dtype),
+    }
+
+
+def histogram_table(table, nbins=256):
+    """Bin a sample table onto a 2D (OF_abs, ON_abs) grid for the histogram engine.
+
+    The likelihood of a reflection depends on a sample only through (OF_abs, ON_abs),
+    and the posterior moments only need sums of ES_abs and ES_abs^2. Each non-empty cell
+    of an nbins x nbins grid is therefore replaced by one entry at the centroid of its
+    samples, carrying the sample count and the mean ES_abs and ES_abs^2 of the cell.
+    :func:`estimate_reflections` evaluates the likelihood once per cell instead of once
+    per sample.
+
+    Error bound: sums over the samples in a cell are replaced by the cell count times
+    the integrand at the centroid, so the first-order error cancels. For a Gaussian
+    measurement with standard deviation sigma, the relative error of a cell weight is
+    about (delta / sigma)^2 * (z^2 - 1) / 24 per axis. Here delta is the bin width in
+    the units of the observation (sqrt_eps * sqrt(Sigma) * bin width for |F|) and z is
+    the standardized residual of the cell. For the cells that carry the posterior
+    (|z| <= 3) this is below (delta / sigma)^2 / 3. It is well under 1% when the bins
+    are at least ~5x narrower than the measurement errors; see
+    :func:`histogram_resolution`.
+
+    Parameters
+    ----------
+    table : dict
+        Sample table from :func:`sample_table`
+    nbins : int
+        Number of bins along each axis
+
+    Returns
+    -------
+    dict
+        Binned table with OF_abs, ON_abs, ES_abs and ES2_abs (cell means), count
+        (samples per cell) and bin_width (OF_abs and ON_abs bin widths) for each case
+    """
+    binned = {}
+    for case in ("ac", "c"):
+        OF_abs = table["OF_abs_" + case].astype(np.float64)
+        ON_abs = table["ON_abs_" + case].astype(np.float64)
+        ES_abs = table["ES_abs_" + case].astype(np.float64)
+        widths = np.array([OF_abs.max(), ON_abs.max()]) / nbins
+        i = np.minimum((OF_abs / widths[0]).astype(np.int64), nbins - 1)
+        j = np.minimum((ON_abs / widths[1]).astype(np.int64), nbins - 1)
+        cell = i * nbins + j
+        counts = np.bincount(cell, minlength=nbins**2)
+        occupied = np.flatnonzero(counts)
+        n = counts[occupied].astype(np.float64)
+
+        def cell_mean(x):
+            return np.bincount(cell, weights=x, minlength=nbins**2)[occupied] / n
+
+        binned["OF_abs_" + case] = cell_mean(OF_abs)
+        binned["ON_abs_" + case] = cell_mean(ON_abs)
+        binned["ES_abs_" + case] = cell_mean(ES_abs)
+        binned["ES2_abs_" + case] = cell_mean(ES_abs**2)
+        binned["count_" + case] = counts[occupied]
+        binned["bin_width_" + case] = widths
+    return binned
+
+
+def histogram_resolution(binned, case, cols, model):
+    """Ratio of histogram bin width to measurement error for each reflection.
+
+    Returns the larger of the OFF and ON ratios of bin width (in units of the
+    observation) to measurement standard deviation. The relative error of the histogram
+    engine scales with the square of this ratio, see :func:`histogram_table`. For
+    intensities the bin width is propagated through I = eps * Sigma * |E|^2 at the
+    observed amplitude.
+    """
+    widths = binned["bin_width_" + case]
+    c = {key: np.asarray(value, dtype=np.float64) for key, value in cols.items()}
+    ratios = []
+    for axis, state in enumerate(("off", "on")):
+        scale = c["sqrt_eps"] * c["sqrt_Sig_" + state]
+        if model == "SF":
+            ratios.append(scale * widths[axis] / c["scale_" + state])
+        else:
+            E_obs = np.sqrt(np.maximum(c["I_" + state], 0)) / scale
+            dI = 2 * scale**2 * (E_obs + widths[axis]) * widths[axis]
+            ratios.append(dI / c["SigI_" + state])
+    return np.maximum(*ratios)
+
+
+# Bounds of the truncated normal used to model French-Wilson |F| posteriors
+TRUNCNORM_LOW = 1e-32
+TRUNCNORM_HIGH = 1e10
+
+# Largest standardized lower bound alpha = -loc / scale considered when solving for
+# truncated normal parameters. Beyond it the truncated normal is indistinguishable from
+# an exponential, whose mean/std ratio of 1 cannot be reached.
+_ALPHA_MAX = 30.0
+
+
+def _truncnorm_ratio(alpha):
+    """mean / std of a standard normal truncated to [alpha, inf), with its derivative
+    and variance factor."""
+    lam = np.exp(-0.5 * alpha**2 - LOG_SQRT_2PI - log_ndtr(-alpha))
+    v = 1 + alpha * lam - lam**2
+    dlam = lam * (lam - alpha)
+    dv = lam + dlam * (alpha - 2 * lam)
+    g = (lam - alpha) / np.sqrt(v)
+    dg = (dlam - 1) / np.sqrt(v) - 0.5 * (lam - alpha) * dv / v**1.5
+    return g, dg, v, lam
+
+
+def truncnorm_params_from_moments(mean, std, tol=1e-10, maxiter=100):
+    """Vectorized method of moments for a normal truncated to [0, inf).
+
+    Finds loc and scale such that the truncated normal has the given mean and standard
+    deviation. The problem reduces to a monotone equation in the standardized lower
+    bound alpha = -loc / scale for the ratio mean / std, which is solved for all
+    reflections at once with safeguarded Newton iterations.
+
+    Parameters
+    ----------
+    mean : np.ndarray
+        Means, e.g. French-Wilson F
+    std : np.ndarray
+        Standard deviations, e.g. French-Wilson SigF
+    tol : float
+        Convergence tolerance on the relative error of the mean / std ratio
+    maxiter : int
+        Maximum number of Newton iterations
+
+    Returns
+    -------
+    (loc, scale, converged) : tuple of np.ndarray
+        Truncated normal parameters and a boolean mask of reflections that met the
+        tolerance. Reflections with mean / std too close to (or below) 1 have no exact
+        solution; for those the mean is matched at the largest supported alpha and
+        ``converged`` is False.
+    """
+    mean = np.asarray(mean, dtype=np.float64)
+    std = np.asarray(std, dtype=np.float64)
+    t = mean / std
+
+    # g(alpha) decreases monotonically from +inf to 1, and g(-t) >= t
+    lo = np.minimum(-t, _ALPHA_MAX)
+    hi = np.full_like(t, _ALPHA_MAX)
+    alpha = lo.copy()
+    active = np.ones(t.shape, dtype=bool)
+    for _ in range(maxiter):
+        g, dg, _, _ = _truncnorm_ratio(alpha[active])
+        f = g - t[active]
+        lo[active] = np.where(f > 0, alpha[active], lo[active])
+        hi[active] = np.where(f < 0, alpha[active], hi[active])
+        step = alpha[active] - f / dg
+        bracketed = (step > lo[active]) & (step < hi[active])
+        step = np.where(bracketed, step, 0.5 * (lo[active] + hi[active]))
+        done = np.abs(f) <= tol * t[active]
+        alpha[active] = np.where(done, alpha[active], step)
+        active[active] = ~done
+        if not active.any():
+            break
+
+    g, _, v, lam = _truncnorm_ratio(alpha)
+    converged = np.abs(g - t) <= tol * t
+    scale = np.where(converged, std / np.sqrt(v), mean / (lam - alpha))
+    loc = -alpha * scale
+    return loc, scale, converged
+
+
+def reparam(df, tol=1e-10):
+    """Method of moments reparametrization of French-Wilson |F| as a truncated normal.
+
+    Input df must contain columns F and SigF. Adds columns low, high, loc and scale
+    describing a normal truncated to [low, high] with mean F and standard deviation
+    SigF.
+
+    Parameters
+    ----------
+    df : rs.DataSet
+        Dataset with F and SigF columns
+    tol : float
+        Convergence tolerance on the relative error of F / SigF, see
+        :func:`truncnorm_params_from_moments`
+
+    Returns
+    -------
+    rs.DataSet
+    """
+    l = len(df["F"])
+    df["low"] = np.repeat(np.array([TRUNCNORM_LOW], dtype=np.float32), l)
+    df["high"] = np.repeat(np.array([TRUNCNORM_HIGH], dtype=np.float32), l)
+
+    loc, scale, converged = truncnorm_params_from_moments(
+        df["F"].to_numpy(np.float64), df["SigF"].to_numpy(np.float64), tol=tol
+    )
+    if not converged.all():
+        warnings.warn(
+            f"Truncated normal method of moments did not reach tol={tol:g} for "
+            f"{np.count_nonzero(~converged)} of {l} reflections (typically F/SigF <= "
+            "1); their means are matched exactly but their widths are approximate.",
+            RuntimeWarning,
+        )
+
+    df["loc"] = loc
+    df["scale"] = scale
+    df = df.infer_mtz_dtypes()
+    return df
+
+
+# Outputs a list of columns and column types present in the .mtz files if any expected
+# column is missing
+def _check_columns(ds, col_names, mtz_path):
+    missing = [c for c in col_names if c not in ds.columns]
+    if not missing:
+        return
+    col_info = ", ".join(f"{c} ({ds[c].dtype})" for c in ds.columns)
+    raise ValueError(
+        f"Column(s) {', '.join(missing)} not found in {mtz_path}.\n"
+        f"Available columns: {col_info}\n"
+        "For MTZ column type reference, see: "
+        "https://rs-station.github.io/reciprocalspaceship/userguide/mtzdtypes.html\n"
+        "Run `rs.dw_extrapolate -h` to see column name options, then specify the "
+        "correct column names with -use_SF or -use_I."
+    )
+
+
+def _column_names(names, flag):
+    if len(names) == 2:
+        return list(names) + list(names)
+    elif len(names) == 4:
+        return list(names)
+    raise ValueError(f"{flag} requires 2 or 4 column names")
+
+
+def prepare_reflections(
+    onmtz, offmtz, use_structure_factors=None, use_intensities=None
+):
+    """Read and merge the ON and OFF data and compute the per-reflection inputs of the
+    likelihood.
+
+    Both rs.dw_extrapolate and rs.mle_dw_extrapolate prepare their data here, so a fit
+    and an extrapolation of the same files see identical inputs.
+
+    Parameters
+    ----------
+    onmtz, offmtz : str
+        Paths of the perturbed and ground state .mtz files
+    use_structure_factors : list of str or None
+        (F, SigF) or (F_off, SigF_off, F_on, SigF_on) column names of French-Wilson
+        structure factors
+    use_intensities : list of str or None
+        (I, SigI) or (I_off, SigI_off, I_on, SigI_on) column names of integrated
+        intensities. Without either, F and SigF columns are used (and their truncated
+        normal parameters if already present).
+
+    Returns
+    -------
+    (ds_all, model, cols) : tuple
+        Merged dataset, likelihood model ("SF" or "I") and dict of per-reflection input
+        arrays for :func:`estimate_reflections`
+    """
+    return prepare_series([onmtz], offmtz, use_structure_factors, use_intensities)[0]
+
+
+def prepare_series(onmtzs, offmtz, use_structure_factors=None, use_intensities=None):
+    """:func:`prepare_reflections` for several ON datasets (e.g. the timepoints of a
+    time-resolved series) against the same OFF dataset, which is read and
+    reparameterized only once.
+
+    Returns
+    -------
+    list of (ds_all, model, cols)
+        One tuple per ON file, see :func:`prepare_reflections`
+    """
+    if use_intensities:
+        model = "I"
+        col_off, sig_off, col_on, sig_on = _column_names(use_intensities, "-use_I")
+    else:
+        model = "SF"
+        col_off, sig_off, col_on, sig_on = _column_names(
+            use_structure_factors or ["F", "SigF"], "-use_SF"
+        )
+    reparameterize = bool(use_structure_factors)
+    ds_of = _read_observations(offmtz, col_off, sig_off, model, reparameterize)
+    return [
+        _merge_reflections(
+            ds_of,
+            _read_observations(onmtz, col_on, sig_on, model, reparameterize),
+            model,
+        )
+        for onmtz in onmtzs
+    ]
+
+
+def _read_observations(mtz_path, col, sig_col, model, reparameterize):
+    """Read one dataset with its observations renamed to F, SigF (or I, SigI) and, for
+    structure factors, the truncated normal parameters of :func:`reparam` (computed
+    unless the file already carries them or ``reparameterize`` is True)."""
+    obs, sig = ("I", "SigI") if model == "I" else ("F", "SigF")
+    ds = rs.read_mtz(mtz_path)
+    _check_columns(ds, [col, sig_col], mtz_path)
+    ds = ds.rename(columns={col: obs, sig_col: sig}).dropna(
+        subset=[obs, sig], how="any"
+    )
+    if model == "SF" and (
+        reparameterize or not {"loc", "scale", "low", "high"}.issubset(ds.columns)
+    ):
+        ds = reparam(ds)
+    return ds
+
+
+def _merge_reflections(ds_of, ds_on, model):
+    """Merge an OFF and an ON dataset from :func:`_read_observations` and compute the
+    likelihood inputs."""
+    ds_all = ds_of.merge(
+        ds_on,
+        left_index=True,
+        right_index=True,
+        suffixes=("_off", "_on"),
+        check_isomorphous=False,
+    )
+    ds_all = ds_all.copy()
+    ds_all.label_centrics(inplace=True)
+    ds_all.compute_multiplicity(inplace=True)
+    ds_all.compute_dHKL(inplace=True)
+    multiplicity = ds_all.EPSILON.to_numpy()
+    dHKL = ds_all.dHKL.to_numpy()
+
+    if model == "SF":
+        Sigma_off = mean_intensity_by_resolution(
+            (ds_all.F_off**2 / multiplicity).to_numpy(), dHKL
+        )
+        Sigma_on = mean_intensity_by_resolution(
+            (ds_all.F_on**2 / multiplicity).to_numpy(), dHKL
+        )
+        names = [
+            "loc_off",
+            "scale_off",
+            "low_off",
+            "high_off",
+            "loc_on",
+            "scale_on",
+            "low_on",
+            "high_on",
+        ]
+    else:
+        Sigma_off = mean_intensity_by_resolution(
+            ds_all.I_off.to_numpy() / multiplicity, dHKL
+        )
+        Sigma_on = mean_intensity_by_resolution(
+            ds_all.I_on.to_numpy() / multiplicity, dHKL
+        )
+        names = ["I_off", "SigI_off", "I_on", "SigI_on"]
+    cols = {name: ds_all[name].to_numpy(np.float64) for name in names}
+    cols["Sigma_off"] = Sigma_off
+    cols["Sigma_on"] = Sigma_on
+    cols["sqrt_eps"] = np.sqrt(multiplicity)
+    cols["sqrt_Sig_off"] = np.sqrt(Sigma_off)
+    cols["sqrt_Sig_on"] = np.sqrt(Sigma_on)
+    return ds_all, model, cols
+
+
+# Method of Moments equations for a truncated normal on [TRUNCNORM_LOW, TRUNCNORM_HIGH],
+# used as the reference for the vectorized solver
+def equations(ab, m, s):
+    a = TRUNCNORM_LOW
+    b = TRUNCNORM_HIGH
+
+    alpha, beta = ab
+    Z = norm.cdf(beta) - norm.cdf(alpha)
+    lam = (norm.pdf(alpha) - norm.pdf(beta)) / Z
+    nu = 1 + (alpha * norm.pdf(alpha) - beta * norm.pdf(beta)) / Z - lam**2
+    sigma = (b - a) / (beta - alpha)
+    mu = a - sigma * alpha
+    return [mu + sigma * lam - m, sigma**2 * nu - s**2]
+
+
+def create_shared_arrays(arrays):
+    """Copy named arrays into newly created shared memory blocks.
+
+    Arrays memory-mapped from the sample bank are not copied; their specs hold the path
+    of the file instead.
+
+    Parameters
+    ----------
+    arrays : dict
+        np.ndarray values keyed by name
+
+    Returns
+    -------
+    (handles, specs) : tuple
+        List of SharedMemory objects that the caller must close and unlink, and a
+        picklable dict of (shm_name, shape, dtype) keyed by array name for use with
+        :func:`attach_shared_arrays`. If ``arrays`` is a list of dicts, specs is a list
+        as well and arrays that appear in several dicts (the same object) are only
+        copied once.
+    """
+    if isinstance(arrays, (list, tuple)):
+        handles = []
+        specs = []
+        seen = {}
+        for group in arrays:
+            group_specs = {}
+            for name, array in group.items():
+                if id(array) not in seen:
+                    new_handles, new_specs = create_shared_arrays({name: array})
+                    handles += new_handles
+                    seen[id(array)] = new_specs[name]
+                group_specs[name] = seen[id(array)]
+            specs.append(group_specs)
+        return handles, specs
+
+    handles = []
+    specs = {}
+    for name, array in arrays.items():
+        path = _bank_file(array)
+        if path is not None:
+            specs[name] = (path, array.shape, array.dtype.str)
+            continue
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        handles.append(shm)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        specs[name] = (shm.name, array.shape, array.dtype.str)
+    return handles, specs
+
+
+def attach_shared_arrays(specs):
+    """Attach to shared memory blocks created by :func:`create_shared_arrays`.
+
+    Returns
+    -------
+    (handles, arrays) : tuple
+        List of SharedMemory objects, which must stay referenced while the arrays are in
+        use, and a dict of np.ndarray views keyed by array name (a list of dicts if
+        ``specs`` is a list)
+    """
+    if isinstance(specs, (list, tuple)):
+        handles = {}
+        groups = []
+        for group_specs in specs:
+            group = {}
+            for name, (shm_name, shape, dtype) in group_specs.items():
+                if shm_name.endswith(".npy"):
+                    group[name] = np.load(shm_name, mmap_mode="r")
+                    continue
+                if shm_name not in handles:
+                    handles[shm_name] = shared_memory.SharedMemory(name=shm_name)
+                buf = handles[shm_name].buf
+                group[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=buf)
+            groups.append(group)
+        return list(handles.values()), groups
+
+    handles = []
+    arrays = {}
+    for name, (shm_name, shape, dtype) in specs.items():
+        if shm_name.endswith(".npy"):
+            arrays[name] = np.load(shm_name, mmap_mode="r")
+            continue
+        shm = shared_memory.SharedMemory(name=shm_name)
+        handles.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return handles, arrays
+
+
+def release_shared_arrays(handles):
+    """Close and unlink shared memory blocks created by :func:`create_shared_arrays`."""
+    for shm in handles:
+        shm.close()
+        shm.unlink()
+
+
+def sample_bank(bank_dir, key, build):
+    """Named arrays from the on-disk sample bank, memory-mapped read-only.
+
+    An entry of the bank is a directory of .npy files named after a hash of ``key``, a
+    JSON-serializable dict of everything that determines the arrays (e.g. sampler, seed,
+    number of samples, r and p). On a miss ``build()`` is called and its arrays are
+    written to temporary files that are renamed into place, followed by ``key.json``,
+    which marks the entry as complete; concurrent runs building the same entry write
+    identical files. Processes that map the same entry share its pages through the page
+    cache.
+
+    Parameters
+    ----------
+    bank_dir : str
+        Directory of the bank, created if needed
+    key : dict
+        Parameters identifying the arrays
+    build : callable
+        Returns a dict of np.ndarray keyed by name when the entry is missing
+
+    Returns
+    -------
+    dict
+        Read-only np.memmap arrays keyed by name
+    """
+    key_json = json.dumps(key, sort_keys=True)
+    entry = os.path.join(bank_dir, hashlib.sha256(key_json.encode()).hexdigest()[:24])
+    key_path = os.path.join(entry, "key.json")
+    if not os.path.exists(key_path):
+        arrays = build()
+        os.makedirs(entry, exist_ok=True)
+        for name, array in arrays.items():
+            tmp = os.path.join(entry, f".{name}.{os.getpid()}.npy")
+            np.save(tmp, np.ascontiguousarray(array))
+            os.replace(tmp, os.path.join(entry, name + ".npy"))
+        tmp = os.path.join(entry, f".key.{os.getpid()}.json")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"key": key, "arrays": list(arrays)}, f, indent=2)
+        os.replace(tmp, key_path)
+    with open(key_path, encoding="utf-8") as f:
+        names = json.load(f)["arrays"]
+    return {
+        name: np.load(os.path.join(entry, name + ".npy"), mmap_mode="r")
+        for name in names
+    }
+
+
+def _bank_file(array):
+    """Path of the .npy file that ``array`` maps in full (as returned by
+    :func:`sample_bank`), or None."""
+    if (
+        isinstance(array, np.memmap)
+        and isinstance(array.base, mmap.mmap)
+        and array.filename
+    ):
+        if array.filename.endswith(".npy"):
+            return array.filename
+    return None
+
+
+def mpi_comm(backend):
+    """MPI.COMM_WORLD for ``backend == "mpi"``, None for the multiprocessing backend.
+
+    mpi4py is only imported when the MPI backend is requested.
+    """
+    if backend != "mpi":
+        return None
+    from mpi4py import MPI
+
+    return MPI.COMM_WORLD
+
+
+def split_reflections(centric, nparts):
+    """Partition the reflections into ``nparts`` sorted index arrays (e.g. one per MPI
+    rank) with balanced numbers of acentric and centric reflections."""
+    parts = [
+        np.array_split(np.flatnonzero(mask), nparts) for mask in (~centric, centric)
+    ]
+    return [np.sort(np.concatenate(pieces)) for pieces in zip(*parts)]
+
+
+# Private memory of a spawned worker after importing numpy, scipy and
+# reciprocalspaceship (about 120 MB)
+WORKER_BASE_MB = 128
+# Number of (reflections x samples) temporaries of the tiled NumPy evaluation that are
+# alive at the same time
+TILE_TEMPORARIES = 8
+# Environment variables read by BLAS/OpenMP (and Numba) when a spawned worker imports
+# them
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "NUMBA_NUM_THREADS",
+)
+
+
+def array_mb(arrays):
+    """Total size in MB of the distinct arrays in a dict or a list of dicts of
+    arrays."""
+    groups = arrays if isinstance(arrays, (list, tuple)) else [arrays]
+    unique = {id(array): array for group in groups for array in group.values()}
+    return sum(np.asarray(array).nbytes for array in unique.values()) / 2**20
+
+
+def plan_execution(
+    memory_budget_mb, shared_mb, worker_mb, nsamples, nproc=None, tile_mb=64
+):
+    """Number of workers, threads per worker and tile size that fit a memory budget.
+
+    The largest number of workers (up to ``nproc`` or the number of usable CPUs) is
+    chosen for which every worker fits with tiles of a single reflection; the remaining
+    memory goes to larger tiles, up to ``tile_mb``. The CPUs are divided evenly among
+    the workers for their BLAS/OpenMP threads.
+
+    Parameters
+    ----------
+    memory_budget_mb : float
+        Memory available to the whole run in MB
+    shared_mb : float
+        Memory used once, independent of the number of workers (parent process and
+        shared memory)
+    worker_mb : float
+        Memory each worker needs in addition to ``WORKER_BASE_MB`` and its tile
+        temporaries
+    nsamples : int
+        Number of samples, i.e. float64 values in a tile row
+    nproc : int, optional
+        Largest number of workers to use
+    tile_mb : float
+        Largest tile size to use
+
+    Returns
+    -------
+    dict
+        nproc, threads, tile_mb and the estimated total memory estimated_mb
+    """
+    cpus = (
+        len(os.sched_getaffinity(0))
+        if hasattr(os, "sched_getaffinity")
+        else os.cpu_count()
+    )
+    min_tile_mb = min(tile_mb, nsamples * 8 / 2**20)
+    per_worker_mb = WORKER_BASE_MB + worker_mb + TILE_TEMPORARIES * min_tile_mb
+    available_mb = memory_budget_mb - shared_mb
+    workers = min(nproc or cpus, int(available_mb // per_worker_mb))
+    if workers < 1:
+        raise ValueError(
+            f"A memory budget of {memory_budget_mb:.0f} MB is too small: a single "
+            f"worker needs about {shared_mb + per_worker_mb:.0f} MB"
+        )
+    tile_mb = min(
+        tile_mb,
+        (available_mb / workers - WORKER_BASE_MB - worker_mb) / TILE_TEMPORARIES,
+    )
+    return {
+        "nproc": workers,
+        "threads": max(1, cpus // workers),
+        "tile_mb": tile_mb,
+        "estimated_mb": shared_mb
+        + workers * (WORKER_BASE_MB + worker_mb + TILE_TEMPORARIES * tile_mb),
+    }
+
+
+def format_plan(plan, memory_budget_mb):
+    """One-line description of a plan from :func:`plan_execution`."""
+    return (
+        f"Execution plan for a {memory_budget_mb:.0f} MB budget: {plan['nproc']} "
+        f"workers x {plan['threads']} threads, {plan['tile_mb']:.2f} MB tiles, about "
+        f"{plan['estimated_mb']:.0f} MB in total"
+    )
+
+
+@contextlib.contextmanager
+def limit_worker_threads(threads):
+    """Cap the BLAS/OpenMP threads of the worker processes spawned inside the block.
+
+    Spawned workers read THREAD_ENV_VARS when they import NumPy (and Numba), so the
+    variables are set while the pool starts and restored afterwards. Forked workers
+    inherit the thread pools of the parent and are not affected. ``threads=None`` leaves
+    the environment alone.
+    """
+    saved = {name: os.environ.get(name) for name in THREAD_ENV_VARS}
+    if threads is not None:
+        os.environ.update({name: str(threads) for name in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _log_diff_exp(x, y):
+    """log(exp(x) - exp(y)) for x >= y."""
+    return x + np.log1p(-np.exp(y - x))
+
+
+def log_gauss_mass(a, b):
+    """Vectorized log(Phi(b) - Phi(a)) that stays accurate far into either tail."""
+    a, b = np.broadcast_arrays(
+        np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    )
+    out = np.empty(a.shape)
+    left = b < 0
+    right = a > 0
+    mid = ~(left | right)
+    out[left] = _log_diff_exp(log_ndtr(b[left]), log_ndtr(a[left]))
+    out[right] = _log_diff_exp(log_ndtr(-a[right]), log_ndtr(-b[right]))
+    out[mid] = np.log1p(-ndtr(a[mid]) - ndtr(-b[mid]))
+    return out
+
+
+def truncnorm_logpdf(x, loc, scale, low, high):
+    """Log-density of a Normal(loc, scale) truncated to [low, high], evaluated with
+    broadcasting.
+
+    Equivalent to ``scipy.stats.truncnorm((low - loc) / scale, (high - loc) / scale,
+    loc, scale).logpdf(x)`` without the per-call argument checking of a frozen scipy
+    distribution.
+    """
+    z = (x - loc) / scale
+    logZ = log_gauss_mass((low - loc) / scale, (high - loc) / scale)
+    out = -0.5 * z**2 - (LOG_SQRT_2PI + np.log(scale) + logZ)
+    return np.where((x >= low) & (x <= high), out, -np.inf)
+
+
+def norm_logpdf(x, loc, scale):
+    """Log-density of a Normal(loc, scale), evaluated with broadcasting."""
+    return -0.5 * ((x - loc) / scale) ** 2 - (LOG_SQRT_2PI + np.log(scale))
+
+
+def reflection_logweights(table, case, cols, model):
+    """Log-likelihood of every sample in the table for a block of reflections.
+
+    Parameters
+    ----------
+    table : dict
+        Sample table from :func:`sample_table`, possibly restricted to a subset of
+        samples
+    case : str
+        "ac" for acentric or "c" for centric reflections
+    cols : dict
+        1D arrays with one entry per reflection. For ``model="SF"`` these are the
+        truncated normal parameters loc_off, scale_off, low_off, high_off, loc_on,
+        scale_on, low_on, high_on; for ``model="I"`` the observed I_off, SigI_off, I_on,
+        SigI_on and resolution trends Sigma_off, Sigma_on. Both models also need
+        sqrt_eps, sqrt_Sig_off and sqrt_Sig_on.
+    model : str
+        "SF" for structure factor amplitudes or "I" for intensities
+
+    Returns
+    -------
+    np.ndarray
+        (nreflections, nsamples) array of log-weights
+    """
+    OF_abs = table["OF_abs_" + case][None, :]
+    ON_abs = table["ON_abs_" + case][None, :]
+    c = {
+        key: np.asarray(value, dtype=np.float64)[:, None] for key, value in cols.items()
+    }
+    return amplitude_loglikelihood(OF_abs, c, "off", model) + amplitude_loglikelihood(
+        ON_abs, c, "on", model
+    )
+
+
+def amplitude_loglikelihood(x, c, state, model):
+    """Log-likelihood of the "off" or "on" data of a reflection given a normalized
+    amplitude x.
+
+    ``x`` and the per-reflection arrays in ``c`` (see :func:`reflection_logweights`) are
+    broadcast against each other.
+    """
+    if model == "SF":
+        x = (c["sqrt_eps"] * c["sqrt_Sig_" + state]) * x
+        return truncnorm_logpdf(
+            x,
+            c["loc_" + state],
+            c["scale_" + state],
+            c["low_" + state],
+            c["high_" + state],
+        )
+    elif model == "I":
+        eps = c["sqrt_eps"] ** 2
+        return norm_logpdf(
+            c["I_" + state], (c["Sigma_" + state] * eps) * x**2, c["SigI_" + state]
+        )
+    raise ValueError(f"Unknown likelihood model {model!r}, expected 'SF' or 'I'")
+
+
+# Upper ends of the windows holding the Wilson prior of acentric and centric amplitudes,
+# where the density has dropped by exp(-50)
+_PRIOR_WINDOW = {"ac": np.sqrt(50.0), "c": 10.0}
+
+# Gauss-Legendre rule for the 1D integrals of _log_marginal_likelihood
+_MARGINAL_RULE = np.polynomial.legendre.leggauss(96)
+
+
+def _log_marginal_likelihood(c, state, case, model):
+    """log E[p(data | x)] of the "off" or "on" data term alone for x with the Wilson
+    distribution of OF_abs.
+
+    The expectation is a 1D integral, computed by Gauss-Legendre quadrature over the
+    window where both the data term and the prior contribute.
+    """
+    lo, hi, _ = _combine_windows(
+        _data_window(c, state, model), (0.0, _PRIOR_WINDOW[case])
+    )
+    x, w = _MARGINAL_RULE
+    X = lo[:, None] + (hi - lo)[:, None] * (x + 1) / 2
+    if case == "ac":
+        log_prior = np.log(2 * X) - X**2
+    else:
+        log_prior = 0.5 * np.log(2 / np.pi) - X**2 / 2
+    cc = {key: value[:, None] for key, value in c.items()}
+    with np.errstate(divide="ignore"):
+        log_dx = np.log(w / 2 * (hi - lo)[:, None])
+    return logsumexp(
+        amplitude_loglikelihood(X, cc, state, model) + log_prior + log_dx, axis=1
+    )
+
+
+def _posterior_moments(sum_w, sum_w_es, sum_w_es2, valid, cols):
+    """ES, SIGES, FS and SIGFS from weighted sums of |ES| and |ES|^2; NaN where not
+    ``valid``."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(valid, sum_w_es / sum_w, np.nan)
+        var = np.where(valid, sum_w_es2 / sum_w - mean**2, np.nan)
+    sqrt_eps = np.asarray(cols["sqrt_eps"], dtype=np.float64)
+    sqrt_Sig_off = np.asarray(cols["sqrt_Sig_off"], dtype=np.float64)
+    ES = sqrt_eps * mean
+    SIGES = sqrt_eps * np.sqrt(np.maximum(var, 0))
+    return {
+        "ES": ES,
+        "SIGES": SIGES,
+        "FS": sqrt_Sig_off * ES,
+        "SIGFS": sqrt_Sig_off * SIGES,
+    }
+
+
+def _posterior_quantiles(es, valid, cols):
+    """Quantiles of ES from the (reflections x quantiles) normalized |ES| at each level;
+    NaN where not ``valid``."""
+    sqrt_eps = np.asarray(cols["sqrt_eps"], dtype=np.float64)
+    es = np.where(valid[:, None], es.astype(np.float64), np.nan) * sqrt_eps[:, None]
+    return {key: es[:, k] for k, key in enumerate(ES_QUANTILES)}
+
+
+def amplitude_dloglikelihood(x, c, state, model):
+    """Derivative of :func:`amplitude_loglikelihood` with respect to the normalized
+    amplitude x."""
+    if model == "SF":
+        s = c["sqrt_eps"] * c["sqrt_Sig_" + state]
+        F = s * x
+        inside = (F >= c["low_" + state]) & (F <= c["high_" + state])
+        return np.where(
+            inside, -s * (F - c["loc_" + state]) / c["scale_" + state] ** 2, 0.0
+        )
+    elif model == "I":
+        eps_Sigma = c["sqrt_eps"] ** 2 * c["Sigma_" + state]
+        residual = c["I_" + state] - eps_Sigma * x**2
+        return residual / c["SigI_" + state] ** 2 * 2 * eps_Sigma * x
+    raise ValueError(f"Unknown likelihood model {model!r}, expected 'SF' or 'I'")
+
+
+def estimate_reflections(
+    table,
+    case,
+    cols,
+    model,
+    eps=1e-10,
+    moments=True,
+    tile_bytes=64 * 2**20,
+    replicates=1,
+    min_samples=None,
+    ess_target=None,
+    se_target=None,
+    fused=None,
+    antithetic=False,
+    control_variates=False,
+    quantiles=False,
+):
+    """Batched importance-sampling estimates for a block of reflections with the same
+    centricity.
+
+    The (reflections x samples) log-weight matrix is evaluated in tiles of at most
+    ``tile_bytes`` bytes per temporary. If a single reflection does not fit in one tile,
+    the samples are tiled as well and the log-weights are computed in two passes (one
+    for the maximum, one for the sums), so the results do not depend on the tiling.
+
+    Parameters
+    ----------
+    table : dict
+        Sample table from :func:`sample_table`, binned table from
+        :func:`histogram_table` or quadrature rules from :func:`quadrature_table`
+    case : str
+        "ac" for acentric or "c" for centric reflections
+    cols : dict
+        Per-reflection input arrays, see :func:`reflection_logweights`
+    model : str
+        "SF" for structure factor amplitudes or "I" for intensities
+    eps : float
+        Relative weights below this threshold are ignored in the posterior moments
+    moments : bool
+        If False, only the log-likelihoods are computed
+    tile_bytes : int
+        Memory budget for each (reflections x samples) temporary
+    replicates : int
+        Number of equally sized, independently randomized replicates stored one after
+        the other in the table (see :func:`sobol_normal_samples`). If greater than one,
+        the standard error of the posterior mean of ES is estimated from its spread
+        across replicates.
+    min_samples, ess_target, se_target : optional
+        If ``min_samples`` is given, each reflection only uses as many samples as it
+        needs; see :func:`adaptive_reflections`
+    fused : bool, optional
+        Use :func:`fused_reflections` instead of the tiled NumPy evaluation. By default
+        it is used whenever Numba is installed and ``replicates == 1``.
+    antithetic, control_variates : bool
+        Use the variance-reduced estimators of :func:`variance_reduced_reflections`,
+        which also return standard errors
+    quantiles : bool
+        Also return the posterior quantiles of ES in ES_QUANTILES. Needs a plain sample
+        table sorted by ES_abs (see :func:`sample_tables`), from which the quantiles are
+        read off the cumulative sum of the weights that the moments are computed from
+
+    Returns
+    -------
+    dict
+        Arrays with one entry per reflection: "loglik" and, if ``moments`` is True, the
+        posterior mean and standard deviation of the excited state amplitude ("ES",
+        "SIGES") and of the excited state structure factor ("FS", "SIGFS"). Moments are
+        NaN where five or fewer samples carry weight. With ``replicates > 1`` the
+        standard error of "ES" is returned as "SE_ES", and in adaptive mode the
+        effective sample size and number of samples used as "ESS" and "NSAMPLES". If the
+        table holds the derivatives of ON_abs (see :func:`sample_table`), the
+        derivatives of "loglik" with respect to r and p for the fixed samples are
+        returned as "dloglik_dr" and "dloglik_dp". With ``antithetic`` or
+        ``control_variates`` the standard errors "SE_loglik" and "SE_ES" are added. With
+        ``quantiles`` the smallest ES whose cumulative posterior probability reaches
+        each quantile is returned under the keys of ES_QUANTILES.
+    """
+    if quantiles:
+        if (
+            "rp" in table
+            or "count_" + case in table
+            or min_samples is not None
+            or replicates > 1
+            or antithetic
+            or control_variates
+        ):
+            raise ValueError(
+                "Posterior quantiles need a plain sample table without replicates, "
+                "adaptive sample budgets or variance reduction"
+            )
+        ES_abs = table["ES_abs_" + case]
+        if np.any(ES_abs[1:] < ES_abs[:-1]):
+            raise ValueError(
+                "Posterior quantiles need a sample table sorted by ES_abs, see "
+                "sample_tables"
+            )
+    if "rp" in table:
+        return quadrature_reflections(
+            table, case, cols, model, eps=eps, moments=moments, tile_bytes=tile_bytes
+        )
+    if min_samples is not None:
+        if replicates > 1 or "count_" + case in table:
+            raise ValueError(
+                "Adaptive sample budgets need a plain sample table without replicates"
+            )
+        return adaptive_reflections(
+            table,
+            case,
+            cols,
+            model,
+            min_samples,
+            ess_target=ess_target,
+            se_target=se_target,
+            eps=eps,
+            tile_bytes=tile_bytes,
+        )
+    if antithetic or control_variates:
+        if replicates > 1 or "count_" + case in table:
+            raise ValueError(
+                "Antithetic pairs and control variates need a plain sample table "
+                "without replicates"
+            )
+        return variance_reduced_reflections(
+            table,
+            case,
+            cols,
+            model,
+            antithetic=antithetic,
+            control_variates=control_variates,
+            eps=eps,
+            moments=moments,
+            tile_bytes=tile_bytes,
+        )
+    if fused is None:
+        fused = numba is not None and replicates == 1
+    elif fused and numba is None:
+        _warn_no_numba()
+        fused = False
+    if fused:
+        if replicates > 1:
+            raise ValueError("The fused kernel does not estimate QMC replicate errors")
+        return fused_reflections(
+            table, case, cols, model, eps=eps, moments=moments, quantiles=quantiles
+        )
+
+    nrefl = len(next(iter(cols.values())))
+    nsamples = len(table["OF_abs_" + case])
+    tile = max(int(tile_bytes // 8), 1)
+    row_step = max(tile // nsamples, 1)
+    sample_step = min(nsamples, tile)
+    ES_abs = table["ES_abs_" + case]
+    ES2_abs = table.get("ES2_abs_" + case)
+    counts = table.get("count_" + case)
+    ntotal = nsamples if counts is None else counts.sum(dtype=np.float64)
+    gradient = "dON_dr_" + case in table
+    sum_w_dr = np.zeros(nrefl)
+    sum_w_dp = np.zeros(nrefl)
+
+    sum_all = np.zeros(nrefl)
+    sum_w = np.zeros(nrefl)
+    sum_w_es = np.zeros(nrefl)
+    sum_w_es2 = np.zeros(nrefl)
+    count = np.zeros(nrefl)
+    logw_max = np.full(nrefl, -np.inf)
+    replicate_size = nsamples // replicates
+    rep_w = np.zeros((replicates, nrefl))
+    rep_w_es = np.zeros((replicates, nrefl))
+    levels = np.array(list(ES_QUANTILES.values()))
+    below = np.zeros((nrefl, len(levels)), dtype=np.int64)
+
+    def logweights(rows, samples):
+        sub_table = {
+            key: table[key][samples] for key in ("OF_abs_" + case, "ON_abs_" + case)
+        }
+        sub_cols = {key: value[rows] for key, value in cols.items()}
+        return reflection_logweights(sub_table, case, sub_cols, model)
+
+    for start in range(0, nrefl, row_step):
+        rows = slice(start, min(start + row_step, nrefl))
+        sample_tiles = [
+            slice(s, min(s + sample_step, nsamples))
+            for s in range(0, nsamples, sample_step)
+        ]
+        if len(sample_tiles) > 1:
+            for samples in sample_tiles:
+                logw_max[rows] = np.maximum(
+                    logw_max[rows], logweights(rows, samples).max(axis=1)
+                )
+        for samples in sample_tiles:
+            # Entries of a binned table stand for `count` samples with the given mean
+            # |ES| and |ES|^2
+            if counts is None:
+                n = np.ones(samples.stop - samples.start)
+            else:
+                n = counts[samples].astype(np.float64)
+            logw = logweights(rows, samples)
+            if len(sample_tiles) == 1:
+                logw_max[rows] = logw.max(axis=1)
+            w = np.exp(logw - logw_max[rows, None])
+            sum_all[rows] += w.dot(n)
+            if gradient:
+                sub_cols = {
+                    key: np.asarray(value, dtype=np.float64)[rows, None]
+                    for key, value in cols.items()
+                }
+                ON_abs = table["ON_abs_" + case][samples][None, :]
+                gw = w * amplitude_dloglikelihood(ON_abs, sub_cols, "on", model)
+                sum_w_dr[rows] += gw.dot(table["dON_dr_" + case][samples])
+                sum_w_dp[rows] += gw.dot(table["dON_dp_" + case][samples])
+            if not moments:
+                continue
+            w *= w > eps
+            count[rows] += (w > 0).dot(n)
+            sum_w[rows] += w.dot(n)
+            es = ES_abs[samples].astype(np.float64)
+            es2 = es**2 if ES2_abs is None else ES2_abs[samples].astype(np.float64)
+            sum_w_es[rows] += w.dot(n * es)
+            sum_w_es2[rows] += w.dot(n * es2)
+            if replicates > 1:
+                first = samples.start // replicate_size
+                last = (samples.stop - 1) // replicate_size
+                for k in range(first, last + 1):
+                    a = max(k * replicate_size - samples.start, 0)
+                    b = min((k + 1) * replicate_size, samples.stop) - samples.start
+                    rep_w[k, rows] += w[:, a:b].dot(n[a:b])
+                    rep_w_es[k, rows] += w[:, a:b].dot(n[a:b] * es[a:b])
+        if quantiles and moments:
+            # Count the samples (sorted by ES) whose cumulative weight is below each
+            # quantile; the weights of the last sample tile are still at hand, the
+            # others are recomputed
+            targets = sum_w[rows, None] * levels
+            cum_w = np.zeros(len(targets))
+            for samples in sample_tiles:
+                if len(sample_tiles) > 1:
+                    w = np.exp(logweights(rows, samples) - logw_max[rows, None])
+                    w *= w > eps
+                cw = np.cumsum(w, axis=1)
+                cw += cum_w[:, None]
+                for k in range(len(levels)):
+                    below[rows, k] += np.count_nonzero(cw < targets[:, k, None], axis=1)
+                cum_w = cw[:, -1]
+
+    results = {"loglik": logw_max + np.log(sum_all / ntotal + 1e-300)}
+    if gradient:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            results["dloglik_dr"] = sum_w_dr / sum_all
+            results["dloglik_dp"] = sum_w_dp / sum_all
+    if not moments:
+        return results
+
+    valid = (sum_w > 0) & (count > 5)
+    results.update(_posterior_moments(sum_w, sum_w_es, sum_w_es2, valid, cols))
+    sqrt_eps = np.asarray(cols["sqrt_eps"], dtype=np.float64)
+    if quantiles:
+        results.update(
+            _posterior_quantiles(ES_abs[np.minimum(below, nsamples - 1)], valid, cols)
+        )
+    if replicates > 1:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rep_mean = rep_w_es / rep_w
+        se = np.std(rep_mean, axis=0, ddof=1) / np.sqrt(replicates)
+        results["SE_ES"] = np.where(valid, sqrt_eps * se, np.nan)
+    return results
+
+
+# Samples whose log-weight is this far below the maximum are skipped in the sums of the
+# fused kernel; their total relative contribution is below
+# nsamples * exp(-40) ~ 4e-18 * nsamples, and skipping the exp roughly halves the time
+# of the second pass for typical data
+_FUSED_LOGW_CUTOFF = -40.0
+
+
+def _fused_kernel(
+    x_off, x_on, es, es2, n, d_dr, d_dp, par, power, eps, moments, levels, out, scratch
+):
+    """Importance-sampling sums for each reflection in two streaming passes over the
+    samples.
+
+    The first pass stores the log-weights in ``scratch`` and finds their maximum, the
+    second accumulates the weights. ``par`` holds (s, loc, scale, low, high, const) for
+    "off" followed by "on" per reflection, for the log-density -((s
+    x^power - loc) / scale)^2 / 2 - const on [low, high]. Writes loglik, the weighted
+    sums for the moments and the derivatives of loglik (if ``d_dr`` is not empty) to
+    ``out``. For samples sorted by ``es``, the second pass also keeps the cumulative
+    moment weight in ``scratch`` and ``es`` at each of the quantile ``levels`` is looked
+    up in it by bisection.
+    """
+    nsamples = x_off.shape[0]
+    gradient = d_dr.shape[0] > 0
+    quantiles = moments and levels.shape[0] > 0
+    ntotal = 0.0
+    for j in range(nsamples):
+        ntotal += n[j]
+    for i in range(par.shape[0]):
+        s_off, loc_off, low_off, high_off = par[i, 0], par[i, 1], par[i, 3], par[i, 4]
+        s_on, loc_on, low_on, high_on = par[i, 6], par[i, 7], par[i, 9], par[i, 10]
+        inv_off, inv_on = 1 / par[i, 2], 1 / par[i, 8]
+        logw_max = -np.inf
+        for j in range(nsamples):
+            if power == 1:
+                y_off = s_off * x_off[j]
+                y_on = s_on * x_on[j]
+            else:
+                y_off = s_off * (x_off[j] * x_off[j])
+                y_on = s_on * (x_on[j] * x_on[j])
+            z_off = (y_off - loc_off) * inv_off
+            z_on = (y_on - loc_on) * inv_on
+            inside = (
+                (y_off >= low_off)
+                & (y_off <= high_off)
+                & (y_on >= low_on)
+                & (y_on <= high_on)
+            )
+            logw = -0.5 * (z_off * z_off + z_on * z_on) if inside else -np.inf
+            scratch[j] = logw
+            logw_max = max(logw_max, logw)
+        sum_all = sum_w = sum_w_es = sum_w_es2 = count = sum_w_dr = sum_w_dp = 0.0
+        for j in range(nsamples):
+            delta = scratch[j] - logw_max
+            if delta < _FUSED_LOGW_CUTOFF:
+                if quantiles:
+                    scratch[j] = sum_w
+                continue
+            w = np.exp(delta)
+            sum_all += w * n[j]
+            if gradient:
+                # d log p(on data | x_on) / d x_on, times the derivatives of x_on for
+                # the fixed sample
+                y_on = s_on * x_on[j] if power == 1 else s_on * (x_on[j] * x_on[j])
+                dy = s_on if power == 1 else 2 * s_on * x_on[j]
+                g = -w * (y_on - loc_on) * inv_on * inv_on * dy
+                sum_w_dr += g * d_dr[j]
+                sum_w_dp += g * d_dp[j]
+            if moments and w > eps:
+                count += n[j]
+                sum_w += w * n[j]
+                sum_w_es += w * n[j] * es[j]
+                sum_w_es2 += w * n[j] * es2[j]
+            if quantiles:
+                scratch[j] = sum_w
+        const = par[i, 5] + par[i, 11]
+        out[i, 0] = logw_max - const + np.log(sum_all / ntotal + 1e-300)
+        out[i, 1] = sum_w
+        out[i, 2] = sum_w_es
+        out[i, 3] = sum_w_es2
+        out[i, 4] = count
+        out[i, 5] = sum_w_dr / sum_all
+        out[i, 6] = sum_w_dp / sum_all
+        for k in range(levels.shape[0] if quantiles else 0):
+            j = np.searchsorted(scratch, levels[k] * sum_w)
+            out[i, 7 + k] = es[min(j, nsamples - 1)]
+
+
+if numba is not None:
+    # Allow reassociation so that the first pass vectorizes, but keep IEEE inf/nan
+    # semantics for the -inf log-weights outside the truncation bounds
+    _fused_kernel = numba.njit(
+        cache=True,
+        nogil=True,
+        error_model="numpy",
+        fastmath={"reassoc", "contract", "arcp", "nsz"},
+    )(_fused_kernel)
+
+
+def _warn_no_numba():
+    warnings.warn(
+        "Numba is not installed, so the fused kernel would run as plain Python; using "
+        "the tiled NumPy evaluation instead",
+        RuntimeWarning,
+    )
+
+
+def _density_params(cols, state, model):
+    """Per-reflection (s, loc, scale, low, high, const) of the "off" or "on" log-density
+    for :func:`_fused_kernel`; the data log-likelihood of amplitude x is -((s
+    x^power - loc) / scale)^2 / 2 - const on [low, high], see
+    :func:`amplitude_loglikelihood`."""
+    c = {key: np.asarray(value, dtype=np.float64) for key, value in cols.items()}
+    if model == "SF":
+        loc, scale, low, high = (
+            c[key + "_" + state] for key in ("loc", "scale", "low", "high")
+        )
+        s = c["sqrt_eps"] * c["sqrt_Sig_" + state]
+        const = (
+            LOG_SQRT_2PI
+            + np.log(scale)
+            + log_gauss_mass((low - loc) / scale, (high - loc) / scale)
+        )
+    elif model == "I":
+        loc, scale = c["I_" + state], c["SigI_" + state]
+        s = c["sqrt_eps"] ** 2 * c["Sigma_" + state]
+        low, high = np.full_like(s, -np.inf), np.full_like(s, np.inf)
+        const = LOG_SQRT_2PI + np.log(scale)
+    else:
+        raise ValueError(f"Unknown likelihood model {model!r}, expected 'SF' or 'I'")
+    return [s, loc, scale, low, high, const]
+
+
+def fused_reflections(
+    table, case, cols, model, eps=1e-10, moments=True, quantiles=False
+):
+    """Importance-sampling estimates from a single fused pass over the samples of each
+    reflection.
+
+    Computes the same quantities as :func:`estimate_reflections` for sample tables from
+    :func:`sample_table` (with or without derivatives) and binned tables from
+    :func:`histogram_table`, but evaluates the log-densities, the log-mean-exp and the
+    weighted moments sample by sample with one scratch array of length nsamples instead
+    of (reflections x samples) temporaries. The kernel is JIT-compiled with Numba;
+    without Numba a warning is issued and the tiled evaluation of
+    :func:`estimate_reflections` is used.
+    """
+    if numba is None:
+        _warn_no_numba()
+        return estimate_reflections(
+            table,
+            case,
+            cols,
+            model,
+            eps=eps,
+            moments=moments,
+            fused=False,
+            quantiles=quantiles,
+        )
+    x_off = np.ascontiguousarray(table["OF_abs_" + case])
+    x_on = np.ascontiguousarray(table["ON_abs_" + case])
+    es = np.ascontiguousarray(table["ES_abs_" + case])
+    es2 = table.get("ES2_abs_" + case)
+    es2 = es.astype(np.float64) ** 2 if es2 is None else np.ascontiguousarray(es2)
+    counts = table.get("count_" + case)
+    n = np.ones(len(x_off)) if counts is None else counts.astype(np.float64)
+    gradient = "dON_dr_" + case in table
+    empty = np.zeros(0, dtype=x_on.dtype)
+    d_dr = np.ascontiguousarray(table["dON_dr_" + case]) if gradient else empty
+    d_dp = np.ascontiguousarray(table["dON_dp_" + case]) if gradient else empty
+    par = np.column_stack(
+        _density_params(cols, "off", model) + _density_params(cols, "on", model)
+    )
+    levels = np.array(
+        list(ES_QUANTILES.values()) if quantiles else [], dtype=np.float64
+    )
+    out = np.empty((len(par), 7 + len(levels)))
+    power = 1 if model == "SF" else 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        _fused_kernel(
+            x_off,
+            x_on,
+            es,
+            es2,
+            n,
+            d_dr,
+            d_dp,
+            par,
+            power,
+            eps,
+            moments,
+            levels,
+            out,
+            np.empty(len(x_off)),
+        )
+
+    results = {"loglik": out[:, 0]}
+    if gradient:
+        results["dloglik_dr"] = out[:, 5]
+        results["dloglik_dp"] = out[:, 6]
+    if not moments:
+        return results
+    sum_w, sum_w_es, sum_w_es2, count = out[:, 1], out[:, 2], out[:, 3], out[:, 4]
+    valid = (sum_w > 0) & (count > 5)
+    results.update(_posterior_moments(sum_w, sum_w_es, sum_w_es2, valid, cols))
+    if quantiles:
+        results.update(_posterior_quantiles(out[:, 7:], valid, cols))
+    return results
+
+
+def variance_reduced_reflections(
+    table,
+    case,
+    cols,
+    model,
+    antithetic=False,
+    control_variates=False,
+    eps=1e-10,
+    moments=True,
+    tile_bytes=64 * 2**20,
+):
+    """Importance-sampling estimates with antithetic pairs and/or control variates, with
+    standard errors.
+
+    With ``antithetic`` the samples come in pairs from :func:`antithetic_samples`, and
+    pairs rather than samples are the independent units of the estimates and their
+    standard errors. With ``control_variates`` the mean weight is estimated by
+    regressing the weights on the "off" and the "on" data terms evaluated on their own,
+    whose expectations under the prior are known from :func:`_log_marginal_likelihood`.
+    This requires a table with the analytic k (see :func:`sample_table`), for which
+    ON_abs has the Wilson distribution of OF_abs. Control variates reduce the variance
+    of "loglik" but not of the posterior moments; where the regression estimate of the
+    mean weight is not positive, the plain estimate is used.
+
+    Every tile holds all samples of ``tile_bytes // (8 * nsamples)`` reflections (at
+    least one).
+
+    Parameters
+    ----------
+    table, case, cols, model, eps, moments, tile_bytes
+        See :func:`estimate_reflections`
+    antithetic : bool
+        Whether consecutive samples are antithetic pairs
+    control_variates : bool
+        Whether to use the "off" and "on" data terms as control variates
+
+    Returns
+    -------
+    dict
+        The results of :func:`estimate_reflections` and the standard errors "SE_loglik"
+        of "loglik" and, if ``moments`` is True, "SE_ES" of "ES"
+    """
+    nrefl = len(next(iter(cols.values())))
+    OF_abs = table["OF_abs_" + case][None, :]
+    ON_abs = table["ON_abs_" + case][None, :]
+    ES_abs = table["ES_abs_" + case].astype(np.float64)
+    nsamples = ES_abs.shape[0]
+    unit = 2 if antithetic else 1
+    if nsamples % unit:
+        raise ValueError("Antithetic pairs need an even number of samples")
+    nunits = nsamples // unit
+    gradient = "dON_dr_" + case in table
+    row_step = max(int(tile_bytes // 8) // nsamples, 1)
+
+    def unit_mean(x):
+        return x if unit == 1 else x.reshape(x.shape[0], nunits, unit).mean(axis=2)
+
+    results = {key: np.full(nrefl, np.nan) for key in ("loglik", "SE_loglik")}
+    if gradient:
+        results.update(
+            dloglik_dr=np.full(nrefl, np.nan), dloglik_dp=np.full(nrefl, np.nan)
+        )
+    sums = {key: np.zeros(nrefl) for key in ("w", "w_es", "w_es2", "count", "se2")}
+    for start in range(0, nrefl, row_step):
+        rows = slice(start, min(start + row_step, nrefl))
+        flat = {
+            key: np.asarray(value, dtype=np.float64)[rows]
+            for key, value in cols.items()
+        }
+        c = {key: value[:, None] for key, value in flat.items()}
+        log_off = amplitude_loglikelihood(OF_abs, c, "off", model)
+        log_on = amplitude_loglikelihood(ON_abs, c, "on", model)
+        logw_max = np.max(log_off + log_on, axis=1)
+        w = np.exp(log_off + log_on - logw_max[:, None])
+        W = unit_mean(w)
+        L = W.mean(axis=1)
+        var = W.var(axis=1)
+        if control_variates:
+            log_marginal = {
+                state: _log_marginal_likelihood(flat, state, case, model)[:, None]
+                for state in ("off", "on")
+            }
+            C = np.stack(
+                [
+                    unit_mean(np.exp(log_term - log_marginal[state])) - 1
+                    for state, log_term in (("off", log_off), ("on", log_on))
+                ],
+                axis=-1,
+            )
+            C_mean = C.mean(axis=1)
+            Ct = np.swapaxes(C - C_mean[:, None, :], 1, 2)
+            with np.errstate(invalid="ignore", over="ignore"):
+                cov_cc = Ct @ np.swapaxes(Ct, 1, 2) / nunits
+                cov_wc = (Ct @ (W - L[:, None])[..., None])[..., 0] / nunits
+                ridge = (
+                    1e-12
+                    * np.trace(cov_cc, axis1=1, axis2=2)[:, None, None]
+                    * np.eye(2)
+                    + 1e-300
+                )
+                beta = np.linalg.solve(cov_cc + ridge, cov_wc[..., None])[..., 0]
+                L_cv = L - np.einsum("rk,rk->r", beta, C_mean)
+                var_cv = var - np.einsum("rk,rk->r", beta, cov_wc)
+            ok = np.isfinite(L_cv) & (L_cv > 0) & np.isfinite(var_cv)
+            L = np.where(ok, L_cv, L)
+            var = np.where(ok, var_cv, var)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            results["loglik"][rows] = logw_max + np.log(L + 1e-300)
+            results["SE_loglik"][rows] = np.sqrt(np.maximum(var, 0) / nunits) / L
+        if gradient:
+            gw = w * amplitude_dloglikelihood(ON_abs, c, "on", model)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                results["dloglik_dr"][rows] = gw.dot(table["dON_dr_" + case]) / w.sum(
+                    axis=1
+                )
+                results["dloglik_dp"][rows] = gw.dot(table["dON_dp_" + case]) / w.sum(
+                    axis=1
+                )
+        if not moments:
+            continue
+        w *= w > eps
+        sums["count"][rows] = np.count_nonzero(w, axis=1)
+        sums["w"][rows] = w.sum(axis=1)
+        sums["w_es"][rows] = w.dot(ES_abs)
+        sums["w_es2"][rows] = w.dot(ES_abs**2)
+        # Delta-method variance of the ratio estimate of the mean |ES| over independent
+        # units
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = sums["w_es"][rows] / sums["w"][rows]
+            W = unit_mean(w)
+            residual = unit_mean(w * ES_abs) - mean[:, None] * W
+            sums["se2"][rows] = np.sum(residual**2, axis=1) / W.sum(axis=1) ** 2
+
+    if not moments:
+        return results
+    valid = (sums["w"] > 0) & (sums["count"] > 5)
+    results.update(
+        _posterior_moments(sums["w"], sums["w_es"], sums["w_es2"], valid, cols)
+    )
+    sqrt_eps = np.asarray(cols["sqrt_eps"], dtype=np.float64)
+    results["SE_ES"] = np.where(valid, sqrt_eps * np.sqrt(sums["se2"]), np.nan)
+    return results
+
+
+def adaptive_reflections(
+    table,
+    case,
+    cols,
+    model,
+    min_samples,
+    ess_target=None,
+    se_target=None,
+    eps=1e-10,
+    tile_bytes=64 * 2**20,
+):
+    """Importance sampling estimates that use only as many samples as each reflection
+    needs.
+
+    Every reflection starts with the first ``min_samples`` samples of the table. The
+    prefix is doubled for the reflections that have not yet reached either target, until
+    the table is exhausted. The samples of a Monte Carlo table are independent, so any
+    prefix is a valid sample. The prefixes of a single scrambled Sobol sequence are
+    balanced point sets whenever their length is a power of 2.
+
+    Parameters
+    ----------
+    table : dict
+        Sample table from :func:`sample_table`
+    case, cols, model, eps, tile_bytes
+        See :func:`estimate_reflections`
+    min_samples : int
+        Number of samples every reflection starts with
+    ess_target : float, optional
+        Stop extending a reflection once the effective sample size (sum w)^2 / sum w^2
+        reaches this value
+    se_target : float, optional
+        Stop extending a reflection once the standard error of the posterior mean of ES,
+        relative to the mean, is at most this value
+
+    Returns
+    -------
+    dict
+        See :func:`estimate_reflections`, with the effective sample size "ESS" and the
+        number of samples used "NSAMPLES"
+    """
+    nrefl = len(next(iter(cols.values())))
+    nsamples = len(table["OF_abs_" + case])
+    ES_abs = table["ES_abs_" + case]
+
+    logw_max = np.full(nrefl, -np.inf)
+    sum_all = np.zeros(nrefl)
+    count = np.zeros(nrefl)
+    # Sums of w and w^2 times 1, |ES| and |ES|^2, relative to exp(logw_max)
+    sums_w = np.zeros((3, nrefl))
+    sums_w2 = np.zeros((3, nrefl))
+    used = np.zeros(nrefl, dtype=np.int64)
+
+    active = np.arange(nrefl)
+    start, stop = 0, min(min_samples, nsamples)
+    while active.size:
+        samples = slice(start, stop)
+        sub_table = {
+            key: table[key][samples] for key in ("OF_abs_" + case, "ON_abs_" + case)
+        }
+        es = ES_abs[samples].astype(np.float64)
+        powers = np.stack([np.ones_like(es), es, es**2], axis=1)
+        row_step = max(int(tile_bytes // (8 * (stop - start))), 1)
+        for i in range(0, active.size, row_step):
+            rows = active[i : i + row_step]
+            logw = reflection_logweights(
+                sub_table,
+                case,
+                {key: value[rows] for key, value in cols.items()},
+                model,
+            )
+            # Rescale the running sums whenever a larger weight turns up
+            new_max = np.maximum(logw_max[rows], logw.max(axis=1))
+            with np.errstate(invalid="ignore"):
+                rescale = np.where(
+                    np.isfinite(logw_max[rows]), np.exp(logw_max[rows] - new_max), 0.0
+                )
+            logw_max[rows] = new_max
+            sum_all[rows] *= rescale
+            sums_w[:, rows] *= rescale
+            sums_w2[:, rows] *= rescale**2
+
+            w = np.exp(logw - new_max[:, None])
+            sum_all[rows] += w.sum(axis=1)
+            w *= w > eps
+            count[rows] += np.count_nonzero(w, axis=1)
+            sums_w[:, rows] += w.dot(powers).T
+            sums_w2[:, rows] += (w**2).dot(powers).T
+        used[active] = stop
+
+        done = np.full(active.size, stop == nsamples)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if ess_target is not None:
+                ess = sums_w[0, active] ** 2 / sums_w2[0, active]
+                done |= ess >= ess_target
+            if se_target is not None:
+                mean = sums_w[1, active] / sums_w[0, active]
+                var = (
+                    sums_w2[2, active]
+                    - 2 * mean * sums_w2[1, active]
+                    + mean**2 * sums_w2[0, active]
+                )
+                done |= (
+                    np.sqrt(np.maximum(var, 0)) / sums_w[0, active] <= se_target * mean
+                )
+        active = active[~done]
+        start, stop = stop, min(2 * stop, nsamples)
+
+    results = {"loglik": logw_max + np.log(sum_all / used + 1e-300)}
+    valid = (sums_w[0] > 0) & (count > 5)
+    results.update(_posterior_moments(sums_w[0], sums_w[1], sums_w[2], valid, cols))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        results["ESS"] = np.where(valid, sums_w[0] ** 2 / sums_w2[0], 0.0)
+    results["NSAMPLES"] = used
+    return results
+
+
+# Half-width of the quadrature windows in standard deviations. Each factor of the
+# integrand is below exp(-50) of its maximum outside of its window.
+_QUAD_WINDOW = 10.0
+
+
+def quadrature_table(r, p, nodes=48, theta_nodes=16):
+    """Gauss-Legendre rules for the deterministic quadrature engine.
+
+    The returned dict takes the place of a sample table in :func:`estimate_reflections`,
+    which then calls :func:`quadrature_reflections`. Nodes and weights are given on [0,
+    1] and are rescaled to a window for each reflection.
+
+    Parameters
+    ----------
+    r : float
+        Double-Wilson correlation parameter
+    p : float
+        Excited state fraction
+    nodes : int
+        Number of nodes along |GS|, and along |ON| on either side of the kink of |ES|
+    theta_nodes : int
+        Number of nodes along the relative phase of acentric reflections, used for the
+        mean of |ES|
+
+    Returns
+    -------
+    dict
+        Arrays "rp", "nodes", "weights", "theta_nodes" and "theta_weights"
+    """
+    x, w = np.polynomial.legendre.leggauss(nodes)
+    xt, wt = np.polynomial.legendre.leggauss(theta_nodes)
+    return {
+        "rp": np.array([r, p], dtype=np.float64),
+        "nodes": (x + 1) / 2,
+        "weights": w / 2,
+        "theta_nodes": (xt + 1) / 2,
+        "theta_weights": wt / 2,
+    }
+
+
+def _normal_window(loc, scale, low):
+    """Window of x >= low outside of which a Normal(loc, scale) density has dropped by
+    exp(-50)."""
+    width = _QUAD_WINDOW * scale
+    lo = np.maximum(low, loc - width)
+    hi = loc + np.sqrt(np.maximum(low - loc, 0) ** 2 + width**2)
+    return lo, hi
+
+
+def _data_window(c, state, model):
+    """Window of normalized amplitudes outside of which the "off" or "on" data term is
+    negligible."""
+    if model == "SF":
+        s = c["sqrt_eps"] * c["sqrt_Sig_" + state]
+        lo, hi = _normal_window(
+            c["loc_" + state], c["scale_" + state], c["low_" + state]
+        )
+        return lo / s, np.minimum(hi, c["high_" + state]) / s
+    eps_Sigma = c["sqrt_eps"] ** 2 * c["Sigma_" + state]
+    lo, hi = _normal_window(
+        c["I_" + state] / eps_Sigma, c["SigI_" + state] / eps_Sigma, 0.0
+    )
+    return np.sqrt(lo), np.sqrt(hi)
+
+
+def _combine_windows(*windows):
+    """Window holding the mass of a product of factors, given a window for each factor.
+
+    This is the intersection of the windows. Where they do not overlap, the factors
+    conflict and each window is instead treated as a normal density; the window of their
+    product is used and flagged in the returned boolean array.
+    """
+    bounds = np.broadcast_arrays(
+        *[np.asarray(x, dtype=np.float64) for w in windows for x in w]
+    )
+    los, his = bounds[0::2], bounds[1::2]
+    lo = np.maximum.reduce(los)
+    hi = np.minimum.reduce(his)
+    precision = 0
+    weighted = 0
+    for w_lo, w_hi in zip(los, his):
+        w_hi = np.minimum(w_hi, np.finfo(np.float64).max / 4)
+        sd = np.maximum((w_hi - w_lo) / (2 * _QUAD_WINDOW), 1e-300)
+        precision = precision + sd**-2
+        weighted = weighted + (w_hi + w_lo) / 2 * sd**-2
+    mu = weighted / precision
+    width = _QUAD_WINDOW / np.sqrt(precision)
+    empty = ~(lo < hi)
+    lo = np.where(
+        empty, np.maximum(mu - width, 0), np.minimum(lo, np.maximum(mu - width, 0))
+    )
+    hi = np.where(empty, mu + width, np.maximum(hi, mu + width))
+    return lo, hi, empty
+
+
+def _rescale(lo, hi, nodes, weights):
+    """Nodes and log-weights of a rule on [0, 1] moved to [lo, hi], with a trailing axis
+    for the nodes."""
+    span = (hi - lo)[..., None]
+    with np.errstate(divide="ignore"):
+        return lo[..., None] + span * nodes, np.log(span * weights)
+
+
+def _quadrature_logweights(
+    A, logwA, c, model, acentric, a, sigma, k, q, on_window, nodes, weights
+):
+    """Log-weights of the (A, B) nodes for a block of reflections, given (nrefl, nA)
+    nodes along A.
+
+    Returns A and B broadcast to (nrefl, nA, nB) and the log-weights with the same
+    shape.
+    """
+    nu = np.abs(a) * A
+    B_lo, B_hi, _ = _combine_windows(
+        (np.maximum(nu - _QUAD_WINDOW * sigma, 0), nu + _QUAD_WINDOW * sigma),
+        (on_window[0][:, None], on_window[1][:, None]),
+    )
+    # |ES| has a kink at B = (1-p) A (smoothed by the phase for acentric reflections),
+    # so each side of it gets its own rule
+    kink = np.clip(q * A, B_lo, B_hi)
+    B, logwB = (
+        np.concatenate(pair, axis=-1)
+        for pair in zip(
+            _rescale(B_lo, kink, nodes, weights), _rescale(kink, B_hi, nodes, weights)
+        )
+    )
+    A = A[..., None]
+    nu = nu[..., None]
+    if acentric:
+        logprior = np.log(2 * A) - A**2
+        kappa = nu * B / sigma**2
+        logcond = (
+            np.log(B / sigma**2) - (B - nu) ** 2 / (2 * sigma**2) + np.log(i0e(kappa))
+        )
+    else:
+        logprior = np.log(2) - LOG_SQRT_2PI - A**2 / 2
+        logcond = norm_logpdf(B, nu, sigma) + np.log1p(np.exp(-2 * B * nu / sigma**2))
+    ca = {key: value[:, None] for key, value in c.items()}
+    cb = {key: value[:, None, None] for key, value in c.items()}
+    logw = (
+        (
+            logwA
+            + logprior[..., 0]
+            + amplitude_loglikelihood(A[..., 0], ca, "off", model)
+        )[..., None]
+        + logwB
+        + logcond
+        + amplitude_loglikelihood(B / k, cb, "on", model)
+    )
+    return np.broadcast_to(A, B.shape), B, logw
+
+
+def quadrature_reflections(
+    table, case, cols, model, eps=1e-10, moments=True, tile_bytes=64 * 2**20
+):
+    """Deterministic counterpart of :func:`estimate_reflections` for the rules of
+    :func:`quadrature_table`.
+
+    With A = |GS| and B = |ON|, ON = a GS + b W where a = (1-p) + pr, b = p
+    sqrt(1 - r^2) and W is a standard (complex) normal independent of GS. The marginal
+    likelihood is the double integral over A and B of the Wilson prior of A, the Rice
+    (acentric) or folded normal (centric) density of B given A and the two data terms,
+    with B scaled by k = sqrt(a^2 + b^2), the analytic ratio of the median amplitudes.
+    It is computed with Gauss-Legendre nodes on windows fitted to each reflection: A on
+    the overlap of the prior and the data, B on the overlap of its density given A and
+    the "on" data. If the windows for A do not overlap, a uniform pilot grid over all of
+    them locates the mass first.
+
+    ES = (ON - (1-p) GS) / p, so |ES| follows from A, B and their relative phase. The
+    phase has a von Mises (acentric) or two-point (centric) distribution given A and B;
+    its moments are analytic except for the mean of |ES| of acentric reflections, which
+    uses a further Gauss-Legendre rule over the phase.
+
+    Parameters
+    ----------
+    table : dict
+        Quadrature rules from :func:`quadrature_table`
+    case, cols, model, eps, moments, tile_bytes
+        See :func:`estimate_reflections`
+
+    Returns
+    -------
+    dict
+        See :func:`estimate_reflections`
+    """
+    r, p = table["rp"]
+    a = (1 - p) + p * r
+    b = max(p * np.sqrt(1 - r**2), 1e-8)
+    q = 1 - p
+    k = np.sqrt(a**2 + b**2)
+    sign = 1.0 if a >= 0 else -1.0
+    acentric = case == "ac"
+    # Standard deviation of each component of W
+    sigma = b / np.sqrt(2) if acentric else b
+    nodes, weights = table["nodes"], table["weights"]
+    rule = (acentric, a, sigma, k, q)
+    npilot = 4 * len(nodes)
+
+    nrefl = len(next(iter(cols.values())))
+    theta_cost = len(table["theta_nodes"]) if (moments and acentric) else 1
+    row_step = max(
+        int(tile_bytes // (8 * 2 * max(len(nodes), npilot) * len(nodes) * theta_cost)),
+        1,
+    )
+    results = {"loglik": np.empty(nrefl)}
+    if moments:
+        for key in ("ES", "SIGES"):
+            results[key] = np.empty(nrefl)
+
+    for start in range(0, nrefl, row_step):
+        rows = slice(start, min(start + row_step, nrefl))
+        c = {
+            key: np.asarray(value, dtype=np.float64)[rows]
+            for key, value in cols.items()
+        }
+
+        # Windows for A: Wilson prior, "off" data and the "on" data mapped through
+        # B ~ |a| A
+        off = _data_window(c, "off", model)
+        on = tuple(k * x for x in _data_window(c, "on", model))
+        windows = [(0.0, _QUAD_WINDOW / np.sqrt(2) if acentric else _QUAD_WINDOW), off]
+        if abs(a) > 1e-6:
+            windows.append(
+                (
+                    np.maximum(on[0] - _QUAD_WINDOW * sigma, 0) / abs(a),
+                    (on[1] + _QUAD_WINDOW * sigma) / abs(a),
+                )
+            )
+        A_lo, A_hi, conflict = _combine_windows(*windows)
+        if conflict.any():
+            # Locate the mass of conflicting reflections on a uniform grid spanning all
+            # of their windows
+            sub = {key: value[conflict] for key, value in c.items()}
+            lo = np.zeros(conflict.sum())
+            hi = np.max(
+                [np.broadcast_to(w[1], conflict.shape)[conflict] for w in windows],
+                axis=0,
+            )
+            step = (hi - lo) / npilot
+            A = lo[:, None] + step[:, None] * (np.arange(npilot) + 0.5)
+            *_, logw = _quadrature_logweights(
+                A,
+                np.log(step)[:, None],
+                sub,
+                model,
+                *rule,
+                (on[0][conflict], on[1][conflict]),
+                nodes,
+                weights,
+            )
+            logm = np.logaddexp.reduce(logw, axis=-1)
+            keep = logm > logm.max(axis=1, keepdims=True) - _QUAD_WINDOW**2 / 2
+            first = np.argmax(keep, axis=1)
+            last = npilot - 1 - np.argmax(keep[:, ::-1], axis=1)
+            A_lo[conflict] = np.maximum(lo + first * step - step, 0)
+            A_hi[conflict] = lo + (last + 2) * step
+
+        A, logwA = _rescale(A_lo, A_hi, nodes, weights)
+        A, B, logw = _quadrature_logweights(
+            A, logwA, c, model, *rule, on, nodes, weights
+        )
+        logw = logw.reshape(len(logw), -1)
+        logw_max = logw.max(axis=1)
+        w = np.exp(logw - logw_max[:, None])
+        sum_w = w.sum(axis=1)
+        results["loglik"][rows] = logw_max + np.log(sum_w + 1e-300)
+        if not moments:
+            continue
+
+        # Moments of |ES| given A and B over the relative phase of GS and ON, at the
+        # nodes that carry weight
+        row, node = np.nonzero(w > eps)
+        w = w[row, node]
+        A = A.reshape(len(sum_w), -1)[row, node]
+        B = B.reshape(len(sum_w), -1)[row, node]
+        if acentric:
+            kappa = abs(a) * A * B / sigma**2
+            es2 = (
+                B**2 + (q * A) ** 2 - 2 * q * sign * A * B * (i1e(kappa) / i0e(kappa))
+            ) / p**2
+            width = np.minimum(np.pi, _QUAD_WINDOW / np.sqrt(np.maximum(kappa, 1e-300)))
+            theta = width[:, None] * table["theta_nodes"]
+            wt = table["theta_weights"] * np.exp(kappa[:, None] * (np.cos(theta) - 1))
+            es_theta = np.sqrt(
+                np.maximum(
+                    B[:, None] ** 2
+                    + (q * A[:, None]) ** 2
+                    - 2 * q * sign * (A * B)[:, None] * np.cos(theta),
+                    0,
+                )
+            )
+            es = (wt * es_theta).sum(axis=-1) / wt.sum(axis=-1) / p
+        else:
+            # ON has the sign of a GS with probability 1 - pi_flip
+            pi_flip = expit(-2 * B * abs(a) * A / sigma**2)
+            es_same, es_flip = (
+                np.abs(B - sign * q * A) / p,
+                np.abs(B + sign * q * A) / p,
+            )
+            es = (1 - pi_flip) * es_same + pi_flip * es_flip
+            es2 = (1 - pi_flip) * es_same**2 + pi_flip * es_flip**2
+        nrows = len(sum_w)
+        sum_w = np.bincount(row, weights=w, minlength=nrows)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.bincount(row, weights=w * es, minlength=nrows) / sum_w
+            var = np.bincount(row, weights=w * es2, minlength=nrows) / sum_w - mean**2
+        results["ES"][rows] = mean
+        results["SIGES"][rows] = np.sqrt(np.maximum(var, 0))
+
+    if moments:
+        sqrt_eps = np.asarray(cols["sqrt_eps"], dtype=np.float64)
+        sqrt_Sig_off = np.asarray(cols["sqrt_Sig_off"], dtype=np.float64)
+        results["ES"] = sqrt_eps * results["ES"]
+        results["SIGES"] = sqrt_eps * results["SIGES"]
+        results["FS"] = sqrt_Sig_off * results["ES"]
+        results["SIGFS"] = sqrt_Sig_off * results["SIGES"]
+    return results
@@ -1,26 +1,59 @@
 #!/usr/bin/env python
-"""
-Runs DW-Extrapolator, a Bayesian inference procedure to infer excited state structure factors in perturbative crystallography datsets.
+"""Runs DW-Extrapolator, a Bayesian inference procedure to infer excited state
+structure factors in perturbative crystallography datsets.
 
 Equations
 ---------
-The underlying model assumes that ground state (GS) and excited state (ES) structure factors have correlation r and that the observed "on" state structure factors are given by F^{ON} = (1-p)*F^{GS} + p*F&{ES}.
+The underlying model assumes that ground state (GS) and excited state (ES) structure
+factors have correlation r and that the observed "on" state structure factors are given
+by F^{ON} = (1-p)*F^{GS} + p*F&{ES}.
 
 Notes
 -----
     - At minimum, two .mtz's for the off and on data need to be provided
-    - DW-Extrapolator can be run using French-Wilson scaled structure factors or integrated intensities
+    - DW-Extrapolator can be run using French-Wilson scaled structure factors or
+    integrated intensities
+    - With --backend mpi (e.g. ``mpirun -n 4 rs.dw_extrapolate --backend mpi ...``) the
+    reflections are scattered across MPI ranks once, every rank builds the same seeded
+    sample tables and the results are gathered to rank 0, which reads and writes the
+    files
+    - With --checkpoint DIR the per-reflection results are kept on disk as they are
+    computed, and a rerun with --resume computes only the reflections that are missing
+    (see :class:`Checkpoint`)
+    - Several ON datasets (e.g. the time points of a series) can be given to -on. They
+    share the OFF data and the Monte Carlo samples, are evaluated in the same pass (each
+    with its own -p when several values are given) and are written to one MTZ each, or
+    to a single MTZ with --single-mtz
 """
 
 import argparse
+import hashlib
+import json
+import os
+import time
 import numpy as np
-from scipy.stats import truncnorm, norm
-from scipy import optimize
-import reciprocalspaceship as rs
 import multiprocessing as mp
-from multiprocessing import shared_memory
-from reciprocalspaceship.algorithms.scale_merged_intensities import (
-    mean_intensity_by_resolution,
+from rsbooster.esf.dw_common import (
+    prepare_series,
+    sample_tables,
+    sobol_normal_samples,
+    antithetic_samples,
+    sample_bank,
+    ES_QUANTILES,
+    histogram_table,
+    histogram_resolution,
+    quadrature_table,
+    estimate_reflections,
+    create_shared_arrays,
+    attach_shared_arrays,
+    release_shared_arrays,
+    mpi_comm,
+    split_reflections,
+    WORKER_BASE_MB,
+    array_mb,
+    plan_execution,
+    format_plan,
+    limit_worker_threads,
 )
 
 try:
@@ -29,193 +62,94 @@ except ImportError:
     tqdm = lambda iterable, **kwargs: iterable
 
 # globals
-GS_ac_shm = ES_ac_shm = GS_c_shm = ES_c_shm = None
-GS_ac = ES_ac = None
-GS_c = ES_c = None
-
-
-def init_shared_memory(GS_ac_name, ES_ac_name, GS_c_name, ES_c_name, nsamples):
-    global GS_ac_shm, ES_ac_shm, GS_c_shm, ES_c_shm
-    global GS_ac, ES_ac, GS_c, ES_c
-
-    GS_ac_shm = shared_memory.SharedMemory(name=GS_ac_name)
-    ES_ac_shm = shared_memory.SharedMemory(name=ES_ac_name)
-    GS_c_shm = shared_memory.SharedMemory(name=GS_c_name)
-    ES_c_shm = shared_memory.SharedMemory(name=ES_c_name)
-
-    GS_ac = np.ndarray((nsamples,), dtype=np.complex64, buffer=GS_ac_shm.buf)
-    ES_ac = np.ndarray((nsamples,), dtype=np.complex64, buffer=ES_ac_shm.buf)
-    GS_c = np.ndarray((nsamples,), dtype=np.float32, buffer=GS_c_shm.buf)
-    ES_c = np.ndarray((nsamples,), dtype=np.float32, buffer=ES_c_shm.buf)
+_shm = []
+TABLES = []
+COLUMNS = {}
+OUTPUTS = {}
+
+
+def init_shared_memory(table_specs, column_specs, output_specs):
+    """Attach each worker to the shared sample tables and the input and output
+    columns."""
+    global _shm, TABLES, COLUMNS, OUTPUTS
+    table_shm, TABLES = attach_shared_arrays(table_specs)
+    column_shm, COLUMNS = attach_shared_arrays(column_specs)
+    output_shm, OUTPUTS = attach_shared_arrays(output_specs)
+    _shm = table_shm + column_shm + output_shm
+
+
+# worker function for batched inference on a range of reflections with the same
+# centricity, evaluated against the sample tables of the (table, output row) targets.
+# Inputs are read from and results written to shared memory.
+def estimate_block(args):
+    case, start, stop, model, options, targets = args
+    idx = COLUMNS["order"][start:stop]
+    cols = {name: col[idx] for name, col in COLUMNS.items() if name != "order"}
+    for table, row in targets:
+        results = estimate_reflections(TABLES[table], case, cols, model, **options)
+        for key, value in results.items():
+            OUTPUTS[key][row, idx] = value
+    return start, stop
+
+
+def _report_histogram(table, cols, centric, model):
+    ncells = sum(len(table["count_" + case]) for case in ("ac", "c"))
+    ratio = np.empty(len(centric))
+    for case, mask in (("ac", ~centric), ("c", centric)):
+        block = {name: col[mask] for name, col in cols.items()}
+        ratio[mask] = histogram_resolution(table, case, block, model)
+    print(
+        f"Histogram engine: {ncells} occupied cells, bin width / sigma "
+        f"median={np.median(ratio):.3f} max={np.max(ratio):.3f}"
+    )
+    if np.any(ratio > 1):
+        print(
+            "Warning: bins are wider than the measurement error for "
+            f"{np.sum(ratio > 1)} reflections; increase --nbins or use --engine mc for "
+            "these data"
+        )
 
 
-# worker function for inference using the Truncated Normal distribution on structure factors
-def estimate_reflection(args):
-    (
-        i,
-        centric,
-        loc_off,
-        scale_off,
-        loc_on,
-        scale_on,
-        sqrt_eps,
-        sqrt_Sig_on,
-        sqrt_Sig_off,
-        p,
-        eps,
-        low,
-        high,
-        r,
-    ) = args
-
-    a_off, b_off = (float(low) - float(loc_off)) / float(scale_off), (
-        float(high) - float(loc_off)
-    ) / float(scale_off)
-
-    a_on, b_on = (float(low) - float(loc_on)) / float(scale_on), (
-        float(high) - float(loc_on)
-    ) / float(scale_on)
-
-    rv_off = truncnorm(a_off, b_off, loc=loc_off, scale=scale_off)
-    rv_on = truncnorm(a_on, b_on, loc=loc_on, scale=scale_on)
-
-    if not centric:
-        ON = (1 - p) * GS_ac + p * ES_ac
-        OF_abs = np.abs(GS_ac)
-        ON_abs = np.abs(ON)
-        k = np.median(ON_abs) / np.median(OF_abs)
-        x_off = sqrt_eps * sqrt_Sig_off * OF_abs
-        x_on = sqrt_eps * sqrt_Sig_on * (ON_abs / k)
-        ES = ES_ac
-    else:
-        ON = (1 - p) * GS_c + p * ES_c
-        OF_abs = np.abs(GS_c)
-        ON_abs = np.abs(ON)
-        k = np.median(ON_abs) / np.median(OF_abs)
-        x_off = sqrt_eps * sqrt_Sig_off * OF_abs
-        x_on = sqrt_eps * sqrt_Sig_on * (ON_abs / k)
-        ES = ES_c
-
-    # likelihood calculation
-    logw = rv_off.logpdf(x_off) + rv_on.logpdf(x_on)
-    ll_i = _logmeanexp(logw)
-
-    # weights calculation
-    m = np.max(logw)
-    w = np.exp(logw - m)
-    w *= w > eps
-    sum_w = np.sum(w)
-
-    if sum_w > 0 and np.sum(w > 0) > 5:
-        w /= sum_w
-        ES_abs = np.abs(ES)
-        mean = np.sum(ES_abs * w)
-        var = np.sum(w * (ES_abs) ** 2) - (mean) ** 2
-        es_val = sqrt_eps * mean
-        es_sig = sqrt_eps * np.sqrt(var)
-        fs_val = sqrt_Sig_off * es_val
-        fs_sig = sqrt_Sig_off * es_sig
-        return (
-            i,  # index
-            es_val,  # ES_abs_2
-            es_sig,  # SIGES_abs_2
-            fs_val,  # FS_abs_2
-            fs_sig,  # SIGFS_abs_2
-            ll_i,
-        )
+def _es_fractions(args):
+    """Excited state fraction p of every ON dataset, from one value for all of them or
+    one value each."""
+    if args.factor and args.es_fraction:
+        raise ValueError("Only specify `-f` or `-p`, not both.")
+    elif args.factor:
+        values = [1.0 / factor for factor in args.factor]
+    elif args.es_fraction is not None:
+        values = list(args.es_fraction)
     else:
-        return (i, np.nan, np.nan, np.nan, np.nan, ll_i)
+        values = [0.125]
+    if len(values) == 1:
+        values = values * len(args.onmtz)
+    if len(values) != len(args.onmtz):
+        raise ValueError("Give one value of -p (or -f) or one for each ON dataset")
+    return values
 
 
-# worker function for inference using the Normal distribution for intensities
-def estimate_reflection_intensity(args):
-    (
-        i,
-        centric,
-        I_off_obs,
-        SigI_off,
-        I_on_obs,
-        SigI_on,
-        Sigma_off,
-        Sigma_on,
-        p,
-        eps,
-        sqrt_eps,
-        sqrt_Sig_on,
-        sqrt_Sig_off,
-        r,
-    ) = args
-
-    if not centric:
-        ON = (1 - p) * GS_ac + p * ES_ac
-        OF_abs = np.abs(GS_ac)
-        ON_abs = np.abs(ON)
-        k = np.median(ON_abs) / np.median(OF_abs)
-        ON_abs = ON_abs / k
-
-        loc_OF = OF_abs**2 * Sigma_off * sqrt_eps**2
-        loc_ON = ON_abs**2 * Sigma_on * sqrt_eps**2
-        ES = ES_ac
-    else:
-        ON = (1 - p) * GS_c + p * ES_c
-        OF_abs = np.abs(GS_c)
-        ON_abs = np.abs(ON)
-        k = np.median(ON_abs) / np.median(OF_abs)
-        ON_abs = ON_abs / k
-
-        loc_OF = OF_abs**2 * Sigma_off * sqrt_eps**2
-        loc_ON = ON_abs**2 * Sigma_on * sqrt_eps**2
-        ES = ES_c
-
-    # likelihood calculation
-    logw = norm(loc=loc_OF, scale=SigI_off).logpdf(I_off_obs) + norm(
-        loc=loc_ON, scale=SigI_on
-    ).logpdf(I_on_obs)
-    ll_i = _logmeanexp(logw)
-
-    # weights calculation
-    m = np.max(logw)
-    w = np.exp(logw - m)
-    w *= w > eps
-    sum_w = np.sum(w)
-
-    if sum_w > 0 and np.sum(w > 0) > 5:
-        w /= sum_w
-        ES_abs = np.abs(ES)
-        mean = np.sum(ES_abs * w)
-        var = np.sum(w * (ES_abs) ** 2) - (mean) ** 2
-        es_val = sqrt_eps * mean
-        es_sig = sqrt_eps * np.sqrt(var)
-        fs_val = sqrt_Sig_off * es_val
-        fs_sig = sqrt_Sig_off * es_sig
-        return (
-            i,  # index
-            es_val,  # ES_abs_2
-            es_sig,  # SIGES_abs_2
-            fs_val,  # FS_abs_2
-            fs_sig,  # SIGFS_abs_2
-            ll_i,
-        )
-    else:
-        return (i, np.nan, np.nan, np.nan, np.nan, ll_i)
+def _segments(groups, centric):
+    """(group, case, start, stop) of the runs of reflections with the same group and
+    centricity in an order sorted by group and centricity."""
+    keys = 2 * groups + centric
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(keys)) + 1, [len(keys)]])
+    return [
+        (int(groups[start]), "c" if centric[start] else "ac", start, stop)
+        for start, stop in zip(bounds[:-1], bounds[1:])
+        if stop > start
+    ]
 
 
-# Outputs a list of columns and column types present in the .mtz files if any expected column is missing
-def _check_columns(ds, col_names, mtz_path):
-    missing = [c for c in col_names if c not in ds.columns]
-    if not missing:
-        return
-    col_info = ", ".join(f"{c} ({ds[c].dtype})" for c in ds.columns)
-    raise ValueError(
-        f"Column(s) {', '.join(missing)} not found in {mtz_path}.\n"
-        f"Available columns: {col_info}\n"
-        f"For MTZ column type reference, see: https://rs-station.github.io/reciprocalspaceship/userguide/mtzdtypes.html\n"
-        f"Run `rs.dw_extrapolate -h` to see column name options, then specify the correct column names with -use_SF or -use_I."
-    )
+def _targets(ntables, group, grouped):
+    """(table, output row) pairs that the reflections of ``group`` are evaluated for:
+    every table, or only the table of their group when the reflections are
+    ``grouped``."""
+    return [(group, 0)] if grouped else [(i, i) for i in range(ntables)]
 
 
-def extrapolate_dw(args):
-    """Run DW extrapolation given parsed command-line arguments.
+def prepare_data(args):
+    """Read the OFF data once, merge it with every ON dataset and compute the
+    per-reflection worker inputs.
 
     Parameters
     ----------
@@ -224,330 +158,838 @@ def extrapolate_dw(args):
 
     Returns
     -------
-    reciprocalspaceship.DataSet
-        Output dataset containing extrapolated structure factor columns that were written
-        to the output MTZ.
+    (datasets, model, cols, groups) : tuple
+        Merged dataset of every ON file, likelihood model ("SF" or "I"), dict of
+        per-reflection input arrays for
+        :func:`rsbooster.esf.dw_common.estimate_reflections` of all datasets one after
+        the other (see :func:`rsbooster.esf.dw_common.prepare_reflections`) and the
+        index of the dataset of every reflection
     """
-    # Unpack arguments
-    r = args.rDW
-    nsamples = args.nsamples
-    eps = 1e-10
+    series = prepare_series(
+        args.onmtz, args.offmtz[0], args.use_structure_factors, args.use_intensities
+    )
+    datasets = [ds_all for ds_all, _, _ in series]
+    model = series[0][1]
+    cols = {key: np.concatenate([c[key] for _, _, c in series]) for key in series[0][2]}
+    groups = np.repeat(np.arange(len(series)), [len(ds_all) for ds_all in datasets])
+    return datasets, model, cols, groups
 
-    if args.factor and args.es_fraction:
-        raise ValueError("Only specify `-f` or `-p`, not both.")
-    elif args.factor:
-        p = 1.0 / args.factor
-    elif args.es_fraction is not None:
-        p = args.es_fraction
-    else:
-        p = 0.125
-
-    # Read MTZ files
-    ds_on = rs.read_mtz(args.onmtz[0])
-    ds_of = rs.read_mtz(args.offmtz[0])
-
-    # Sample standard Multivariate Normals
-    rng = np.random.default_rng(seed=args.seed)
-    raw_Z_ac = rng.standard_normal((nsamples, 4)).astype(np.float32)  # acentric samples
-    raw_Z_c = rng.standard_normal((nsamples, 2)).astype(np.float32)  # centric samples
-
-    L_ac = np.sqrt(0.5) * np.array(
-        [
-            [1, 0, 0, 0],
-            [0, 1, 0, 0],
-            [r, 0, np.sqrt(1 - r**2), 0],
-            [0, r, 0, np.sqrt(1 - r**2)],
-        ],
-        dtype=np.float32,
-    )
-
-    E_ac = raw_Z_ac.dot(L_ac.T)
-    GS_ac_local = (E_ac[:, 0] + 1j * E_ac[:, 1]).astype(np.complex64)
-    ES_ac_local = (E_ac[:, 2] + 1j * E_ac[:, 3]).astype(np.complex64)
-
-    L_c = np.array([[1, 0], [r, np.sqrt(1 - r**2)]], dtype=np.float32)
-    E_c = raw_Z_c.dot(L_c.T)
-    GS_c_local = E_c[:, 0].astype(np.float32)
-    ES_c_local = E_c[:, 1].astype(np.float32)
-
-    # Allocate storage
-
-    GS_ac_shm_obj = shared_memory.SharedMemory(create=True, size=GS_ac_local.nbytes)
-    ES_ac_shm_obj = shared_memory.SharedMemory(create=True, size=ES_ac_local.nbytes)
-    GS_c_shm_obj = shared_memory.SharedMemory(create=True, size=GS_c_local.nbytes)
-    ES_c_shm_obj = shared_memory.SharedMemory(create=True, size=ES_c_local.nbytes)
-
-    np.ndarray(GS_ac_local.shape, dtype=GS_ac_local.dtype, buffer=GS_ac_shm_obj.buf)[
-        :
-    ] = GS_ac_local
-    np.ndarray(ES_ac_local.shape, dtype=ES_ac_local.dtype, buffer=ES_ac_shm_obj.buf)[
-        :
-    ] = ES_ac_local
-    np.ndarray(GS_c_local.shape, dtype=GS_c_local.dtype, buffer=GS_c_shm_obj.buf)[:] = (
-        GS_c_local
-    )
-    np.ndarray(ES_c_local.shape, dtype=ES_c_local.dtype, buffer=ES_c_shm_obj.buf)[:] = (
-        ES_c_local
-    )
-
-    # Merge and prepare data
-
-    if args.use_intensities:  ##I/SigI case
-        i_args = args.use_intensities
-        if len(i_args) == 2:
-            I_col_off, SigI_col_off = i_args
-            I_col_on, SigI_col_on = i_args
-        elif len(i_args) == 4:
-            I_col_off, SigI_col_off, I_col_on, SigI_col_on = i_args
-        else:
-            raise ValueError("-use_I requires 2 or 4 column names")
-        _check_columns(ds_of, [I_col_off, SigI_col_off], args.offmtz[0])
-        _check_columns(ds_on, [I_col_on, SigI_col_on], args.onmtz[0])
-        ds_on = ds_on.rename(columns={I_col_on: "I", SigI_col_on: "SigI"})
-        ds_on = ds_on.dropna(subset=["I", "SigI"], how="any")
-        ds_of = ds_of.rename(columns={I_col_off: "I", SigI_col_off: "SigI"})
-        ds_of = ds_of.dropna(subset=["I", "SigI"], how="any")
-
-        ds_all = ds_of.merge(
-            ds_on,
-            left_index=True,
-            right_index=True,
-            suffixes=("_off", "_on"),
-            check_isomorphous=False,
-        )
-        ds_all = ds_all.copy()
-        ds_all.label_centrics(inplace=True)
-        ds_all.compute_multiplicity(inplace=True)
-        ds_all.compute_dHKL(inplace=True)
-        multiplicity = ds_all.EPSILON.to_numpy()
-        sqrt_eps_arr = np.sqrt(multiplicity)
-    elif args.use_structure_factors:  ##Structure Factor case
-        sf_args = args.use_structure_factors
-        if len(sf_args) == 2:
-            F_col_off, SigF_col_off = sf_args
-            F_col_on, SigF_col_on = sf_args
-        elif len(sf_args) == 4:
-            F_col_off, SigF_col_off, F_col_on, SigF_col_on = sf_args
-        else:
-            raise ValueError("-use_SF requires 2 or 4 column names")
-        _check_columns(ds_of, [F_col_off, SigF_col_off], args.offmtz[0])
-        _check_columns(ds_on, [F_col_on, SigF_col_on], args.onmtz[0])
-        ds_on = ds_on.rename(columns={F_col_on: "F", SigF_col_on: "SigF"})
-        ds_on = ds_on.dropna(subset=["F", "SigF"], how="any")
-        ds_of = ds_of.rename(columns={F_col_off: "F", SigF_col_off: "SigF"})
-        ds_of = ds_of.dropna(subset=["F", "SigF"], how="any")
-
-        ds_on = reparam(ds_on)
-        ds_of = reparam(ds_of)
-        ds_all = ds_of.merge(
-            ds_on,
-            left_index=True,
-            right_index=True,
-            suffixes=("_off", "_on"),
-            check_isomorphous=False,
+
+def build_tables(args, rp_values):
+    """Draw the samples once and build a sample table for each (r, p), or quadrature
+    rules for each (r, p) with ``--engine quadrature``.
+
+    Returns
+    -------
+    (tables, replicates) : tuple
+        Sample tables and the number of randomized QMC replicates stored in each of them
+        (1 if the samples carry no replicate structure)
+    """
+    if args.adaptive and (
+        args.engine != "mc" or (args.sampler == "sobol" and args.qmc_replicates > 1)
+    ):
+        raise ValueError(
+            "--adaptive needs --engine mc and, with --sampler sobol, --qmc-replicates 1"
         )
-        ds_all = ds_all.copy()
-        ds_all.label_centrics(inplace=True)
-        ds_all.compute_multiplicity(inplace=True)
-        ds_all.compute_dHKL(inplace=True)
-        multiplicity = ds_all.EPSILON.to_numpy()
-        sqrt_eps_arr = np.sqrt(multiplicity)
-    else:
-        _check_columns(ds_of, ["F", "SigF"], args.offmtz[0])
-        _check_columns(ds_on, ["F", "SigF"], args.onmtz[0])
-        ds_on = ds_on.dropna(subset=["F", "SigF"], how="any")
-        ds_of = ds_of.dropna(subset=["F", "SigF"], how="any")
-        ds_all = ds_of.merge(
-            ds_on,
-            left_index=True,
-            right_index=True,
-            suffixes=("_off", "_on"),
-            check_isomorphous=False,
+    if args.adaptive and (
+        args.min_samples < 1
+        or (args.ess_target is not None and args.ess_target <= 0)
+        or (args.se_target is not None and args.se_target <= 0)
+    ):
+        raise ValueError("--min-samples, --ess-target and --se-target must be positive")
+    if (args.antithetic or args.control_variates) and (
+        args.engine != "mc" or args.adaptive
+    ):
+        raise ValueError(
+            "--antithetic and --control-variates need --engine mc and no --adaptive"
         )
-        ds_all = ds_all.copy()
-        ds_all.label_centrics(inplace=True)
-        ds_all.compute_multiplicity(inplace=True)
-        ds_all.compute_dHKL(inplace=True)
-        multiplicity = ds_all.EPSILON.to_numpy()
-        sqrt_eps_arr = np.sqrt(multiplicity)
-
-    # Prepare arguments for multiprocessing in working functions
-    if not args.use_intensities:
-        Sigma_off = mean_intensity_by_resolution(
-            (ds_all.F_off**2 / multiplicity).to_numpy(), ds_all.dHKL.to_numpy()
+    if (
+        (args.antithetic or args.control_variates)
+        and args.sampler == "sobol"
+        and args.qmc_replicates > 1
+    ):
+        raise ValueError(
+            "--antithetic and --control-variates need --qmc-replicates 1 with "
+            "--sampler sobol"
         )
-        Sigma_on = mean_intensity_by_resolution(
-            (ds_all.F_on**2 / multiplicity).to_numpy(), ds_all.dHKL.to_numpy()
+    if args.quantiles and (
+        args.engine != "mc"
+        or args.adaptive
+        or args.antithetic
+        or args.control_variates
+        or (args.sampler == "sobol" and args.qmc_replicates > 1)
+    ):
+        raise ValueError(
+            "--quantiles needs --engine mc without --adaptive, --antithetic or "
+            "--control-variates and, with --sampler sobol, --qmc-replicates 1"
         )
-        sqrt_Sigma_off = np.sqrt(Sigma_off)
-        sqrt_Sigma_on = np.sqrt(Sigma_on)
-        args_list = []
-        for i, row in enumerate(ds_all.itertuples(index=False)):
-            args_list.append(
-                (
-                    i,
-                    row.CENTRIC,
-                    row.loc_off,
-                    row.scale_off,
-                    row.loc_on,
-                    row.scale_on,
-                    sqrt_eps_arr[i],
-                    sqrt_Sigma_on[i],
-                    sqrt_Sigma_off[i],
-                    p,
-                    eps,
-                    row.low_off,
-                    row.high_off,
-                    r,
-                )
+    if args.engine == "quadrature":
+        return [quadrature_table(r, p, nodes=args.nodes) for r, p in rp_values], 1
+
+    # Antithetic pairs are made from half as many draws
+    ndraws = args.nsamples // 2 if args.antithetic else args.nsamples
+    replicates = args.qmc_replicates if args.sampler == "sobol" else 1
+
+    def draw():
+        if args.sampler == "sobol":
+            raw_Z_ac, raw_Z_c = sobol_normal_samples(
+                ndraws, seed=args.seed, replicates=replicates
             )
+        else:
+            rng = np.random.default_rng(seed=args.seed)
+            # acentric and centric samples
+            raw_Z_ac = rng.standard_normal((ndraws, 4)).astype(np.float32)
+            raw_Z_c = rng.standard_normal((ndraws, 2)).astype(np.float32)
+        if args.antithetic:
+            raw_Z_ac, raw_Z_c = antithetic_samples(raw_Z_ac, raw_Z_c)
+        return {"raw_Z_ac": raw_Z_ac, "raw_Z_c": raw_Z_c}
+
+    # Control variates need ON_abs to have the Wilson distribution, which the analytic k
+    # gives, and quantiles need the samples sorted by ES_abs
+    options = {"analytic_k": args.control_variates, "sort_es": args.quantiles}
+    if args.sample_bank is None:
+        raw = draw()
+        tables = sample_tables(raw["raw_Z_ac"], raw["raw_Z_c"], rp_values, **options)
     else:
-        I_off = ds_all.I_off.to_numpy()
-        SigI_off = ds_all.SigI_off.to_numpy()
-        I_on = ds_all.I_on.to_numpy()
-        SigI_on = ds_all.SigI_on.to_numpy()
-        Sigma_off = mean_intensity_by_resolution(
-            I_off / multiplicity, ds_all.dHKL.to_numpy()
-        )
-        Sigma_on = mean_intensity_by_resolution(
-            I_on / multiplicity, ds_all.dHKL.to_numpy()
-        )
-        sqrt_Sigma_off = np.sqrt(Sigma_off)
-        sqrt_Sigma_on = np.sqrt(Sigma_on)
-        args_list = []
-        for i, row in enumerate(ds_all.itertuples(index=False)):
-            args_list.append(
-                (
-                    i,
-                    row.CENTRIC,
-                    I_off[i],
-                    SigI_off[i],
-                    I_on[i],
-                    SigI_on[i],
-                    Sigma_off[i],
-                    Sigma_on[i],
-                    p,
-                    eps,
-                    sqrt_eps_arr[i],
-                    sqrt_Sigma_on[i],
-                    sqrt_Sigma_off[i],
-                    r,
+        key = {
+            "draw_dtype": "float64",
+            "sampler": args.sampler,
+            "seed": args.seed,
+            "ndraws": ndraws,
+            "replicates": replicates,
+            "antithetic": args.antithetic,
+        }
+        raw = {}
+
+        def build(r, p):
+            if not raw:
+                raw.update(
+                    sample_bank(args.sample_bank, dict(key, kind="normal"), draw)
                 )
+            (table,) = sample_tables(
+                raw["raw_Z_ac"], raw["raw_Z_c"], [(r, p)], **options
             )
+            return table
+
+        table_key = dict(key, kind="table", analytic_k=args.control_variates)
+        if args.quantiles:
+            table_key.update(sort_es=True)
+        tables = [
+            sample_bank(
+                args.sample_bank,
+                dict(table_key, r=r, p=p),
+                lambda r=r, p=p: build(r, p),
+            )
+            for r, p in rp_values
+        ]
+    nsamples = len(tables[0]["OF_abs_ac"])
+    if nsamples != args.nsamples:
+        replicate_note = (
+            f" ({replicates} scrambled Sobol replicates of {nsamples // replicates})"
+        )
+        print(f"Using {nsamples} samples" + (replicate_note if replicates > 1 else ""))
+    if args.engine == "histogram":
+        if replicates > 1:
+            print("Note: QMC error estimates are not available with --engine histogram")
+        replicates = 1
+        tables = [histogram_table(table, nbins=args.nbins) for table in tables]
+    return tables, replicates
+
+
+def _estimate_options(args, replicates):
+    """Keyword arguments for :func:`rsbooster.esf.dw_common.estimate_reflections` and
+    the output keys."""
+    options = {
+        "eps": 1e-10,
+        "tile_bytes": args.tile_mb * 2**20,
+        "replicates": replicates,
+    }
+    output_keys = ("ES", "SIGES", "FS", "SIGFS", "loglik")
+    if replicates > 1:
+        output_keys += ("SE_ES",)
+    elif args.antithetic or args.control_variates:
+        options.update(
+            antithetic=args.antithetic, control_variates=args.control_variates
+        )
+        output_keys += ("SE_ES", "SE_loglik")
+    if args.adaptive:
+        options.update(
+            min_samples=args.min_samples,
+            ess_target=args.ess_target,
+            se_target=args.se_target,
+        )
+        output_keys += ("ESS", "NSAMPLES")
+    if args.quantiles:
+        options.update(quantiles=True)
+        output_keys += tuple(ES_QUANTILES)
+    return options, output_keys
+
+
+def run_dw(
+    args, model, cols, centric, tables, replicates=1, on_block=None, groups=None
+):
+    """Evaluate every reflection against each sample table in a single pass over a
+    worker pool.
+
+    With ``groups``, the index of the ON dataset of every reflection, each reflection is
+    only evaluated against the table of its dataset and a single set of outputs is
+    returned. With ``args.backend == "mpi"`` this dispatches to :func:`run_dw_mpi` and
+    must be called on every rank. Otherwise ``on_block(idx, outputs)`` is called in the
+    parent after every finished block, with the reflection indices of the block and the
+    (outputs x reflections) arrays filled so far.
 
-    num_procs = args.nproc if args.nproc is not None else mp.cpu_count()
-
-    worker = (
-        estimate_reflection_intensity if args.use_intensities else estimate_reflection
-    )
+    Returns
+    -------
+    list of dict
+        For each table (one dict with ``groups``), arrays of ES, SIGES, FS, SIGFS and
+        loglik with one entry per reflection, the randomized QMC standard error SE_ES if
+        ``replicates > 1``, the standard errors SE_ES and SE_loglik with
+        ``--antithetic`` or ``--control-variates`` and ESS and NSAMPLES with
+        ``--adaptive``
+    """
+    if args.backend == "mpi":
+        return run_dw_mpi(args, model, cols, centric, tables, replicates, groups)
+    options, output_keys = _estimate_options(args, replicates)
+    if args.engine == "histogram":
+        _report_histogram(tables[0], cols, centric, model)
+
+    # Centric and acentric reflections of each ON dataset are batched separately.
+    # Workers receive ranges into the sorted reflection order and exchange data with the
+    # parent through shared memory only.
+    grouped = groups is not None
+    groups = np.asarray(groups) if grouped else np.zeros(len(centric), dtype=np.int64)
+    noutputs = 1 if grouped else len(tables)
+    order = np.lexsort((centric, groups))
+    tasks = []
+    for group, case, segment_start, segment_stop in _segments(
+        groups[order], centric[order]
+    ):
+        targets = _targets(len(tables), group, grouped)
+        for start in range(segment_start, segment_stop, args.block_size):
+            stop = min(start + args.block_size, segment_stop)
+            tasks.append((case, start, stop, model, options, targets))
 
-    with mp.Pool(
-        processes=num_procs,
-        initializer=init_shared_memory,
-        initargs=(
-            GS_ac_shm_obj.name,
-            ES_ac_shm_obj.name,
-            GS_c_shm_obj.name,
-            ES_c_shm_obj.name,
+    num_procs = args.nproc if args.nproc is not None else mp.cpu_count()
+    threads = None
+    if args.memory_budget is not None:
+        # The tables, columns and outputs exist in the parent and in shared memory, and
+        # ds_all in the parent
+        outputs_mb = noutputs * len(order) * len(output_keys) * 8 / 2**20
+        shared_mb = (
+            WORKER_BASE_MB
+            + 2 * (array_mb(list(tables)) + outputs_mb)
+            + 3 * array_mb(cols)
+        )
+        # Quadrature tiles hold nodes^2 points per reflection
+        nsamples = max(
+            (len(t["OF_abs_ac"]) for t in tables if "OF_abs_ac" in t),
+            default=args.nodes**2,
+        )
+        plan = plan_execution(
+            args.memory_budget,
+            shared_mb,
+            0,
             nsamples,
-        ),
-    ) as pool:
-        results = list(
-            tqdm(
-                pool.imap(worker, args_list, chunksize=200),
-                total=len(args_list),
-                disable=args.disable_progress_bar,
+            nproc=args.nproc,
+            tile_mb=args.tile_mb,
+        )
+        print(format_plan(plan, args.memory_budget))
+        num_procs = plan["nproc"]
+        options["tile_bytes"] = plan["tile_mb"] * 2**20
+        threads = plan["threads"]
+
+    handles = []
+    try:
+        new_handles, table_specs = create_shared_arrays(tables)
+        handles += new_handles
+        new_handles, column_specs = create_shared_arrays(dict(cols, order=order))
+        handles += new_handles
+        new_handles, output_specs = create_shared_arrays(
+            {key: np.full((noutputs, len(order)), np.nan) for key in output_keys}
+        )
+        handles += new_handles
+        output_shm, output_views = attach_shared_arrays(output_specs)
+
+        # Spawned rather than forked workers, so that they set up their BLAS/OpenMP
+        # thread pools under the cap
+        with limit_worker_threads(threads):
+            pool = mp.get_context("spawn").Pool(
+                processes=num_procs,
+                initializer=init_shared_memory,
+                initargs=(table_specs, column_specs, output_specs),
             )
+        with pool:
+            for start, stop in tqdm(
+                pool.imap_unordered(estimate_block, tasks),
+                total=len(tasks),
+                disable=args.disable_progress_bar,
+            ):
+                if on_block is not None:
+                    on_block(order[start:stop], output_views)
+
+        outputs = [
+            {key: np.array(output_views[key][i]) for key in output_keys}
+            for i in range(noutputs)
+        ]
+        del output_views
+        for shm in output_shm:
+            shm.close()
+    finally:
+        release_shared_arrays(handles)
+    return outputs
+
+
+def run_dw_mpi(args, model, cols, centric, tables, replicates=1, groups=None):
+    """MPI version of :func:`run_dw`; a collective call on all ranks of COMM_WORLD.
+
+    Rank 0 passes the reflection inputs and scatters an equal share of the acentric and
+    centric reflections to every rank, the other ranks pass None for model, cols and
+    centric. Every rank needs the same tables, which :func:`build_tables` produces from
+    the seed. Each rank evaluates its share in blocks of ``args.block_size`` reflections
+    and the outputs are gathered to rank 0.
+
+    Returns
+    -------
+    list of dict or None
+        The outputs of :func:`run_dw` on rank 0, None on the other ranks
+    """
+    comm = mpi_comm("mpi")
+    options, output_keys = _estimate_options(args, replicates)
+    pieces = None
+    if comm.rank == 0:
+        if args.engine == "histogram":
+            _report_histogram(tables[0], cols, centric, model)
+        all_groups = (
+            np.zeros(len(centric), dtype=np.int64)
+            if groups is None
+            else np.asarray(groups)
         )
+        pieces = [
+            (
+                idx,
+                {name: col[idx] for name, col in cols.items()},
+                centric[idx],
+                all_groups[idx],
+            )
+            for idx in split_reflections(centric, comm.size)
+        ]
+    model, grouped = comm.bcast((model, groups is not None), root=0)
+    idx, local_cols, local_centric, local_groups = comm.scatter(pieces, root=0)
+    noutputs = 1 if grouped else len(tables)
+
+    local = {key: np.full((noutputs, len(idx)), np.nan) for key in output_keys}
+    blocks = []
+    local_order = np.lexsort((local_centric, local_groups))
+    for group, case, start, stop in _segments(
+        local_groups[local_order], local_centric[local_order]
+    ):
+        rows = local_order[start:stop]
+        targets = _targets(len(tables), group, grouped)
+        blocks += [
+            (case, targets, rows[i : i + args.block_size])
+            for i in range(0, len(rows), args.block_size)
+        ]
+    for case, targets, rows in tqdm(
+        blocks, disable=args.disable_progress_bar or comm.rank != 0
+    ):
+        block_cols = {name: col[rows] for name, col in local_cols.items()}
+        for table, row in targets:
+            results = estimate_reflections(
+                tables[table], case, block_cols, model, **options
+            )
+            for key, value in results.items():
+                local[key][row, rows] = value
+
+    gathered = comm.gather((idx, local), root=0)
+    if comm.rank != 0:
+        return None
+    outputs = [
+        {key: np.full(len(centric), np.nan) for key in output_keys}
+        for _ in range(noutputs)
+    ]
+    for rank_idx, rank_outputs in gathered:
+        for i, output in enumerate(outputs):
+            for key in output_keys:
+                output[key][rank_idx] = rank_outputs[key][i]
+    return outputs
+
+
+def write_dw(ds_all, results, outfile):
+    """Add the extrapolated columns to a copy of ds_all and write them to an MTZ.
+
+    Returns
+    -------
+    (ds_out, total_nll) : tuple
+        Output dataset and the negative log-likelihood summed over reflections
+    """
+    ds_out, out_cols, total_nll = _output_dataset(ds_all, results)
+    ds_out.dropna(inplace=True)
+    # ds_out.infer_mtz_dtypes(inplace=True)
+    ds_out[[col for col, _ in out_cols] + ["CENTRIC"]].write_mtz(outfile)
+    return ds_out, total_nll
 
-    # Collect results
-    ES_abs_2_array = np.full(len(ds_all), np.nan)
-    SIGES_abs_2_array = np.full(len(ds_all), np.nan)
-    FS_abs_2_array = np.full(len(ds_all), np.nan)
-    SIGFS_abs_2_array = np.full(len(ds_all), np.nan)
-    loglik_array = np.full(len(ds_all), np.nan, dtype=np.float64)
 
-    for i, es_val, es_sig, fs_val, fs_sig, ll_i in results:
-        ES_abs_2_array[i] = es_val
-        SIGES_abs_2_array[i] = es_sig
-        FS_abs_2_array[i] = fs_val
-        SIGFS_abs_2_array[i] = fs_sig
-        loglik_array[i] = ll_i
+def write_dw_series(datasets, results, labels, outfile):
+    """Write the outputs of several ON datasets to a single MTZ, the columns of each
+    suffixed with its label.
 
-    total_nll = -np.sum(loglik_array)
+    Reflections that are missing from (or failed for) some of the datasets have missing
+    values in their columns.
 
-    # Assign and cast to MTZ-friendly types
-    ds_all["ES_abs_2"] = ES_abs_2_array.astype("float32")
-    ds_all["SIGES_abs_2"] = SIGES_abs_2_array.astype("float32")
-    ds_all["FS_abs_2"] = FS_abs_2_array.astype("float32")
-    ds_all["SIGFS_abs_2"] = SIGFS_abs_2_array.astype("float32")
+    Returns
+    -------
+    list of (ds_out, total_nll)
+        Output dataset and negative log-likelihood of every ON dataset, as returned by
+        :func:`write_dw`
+    """
+    merged = None
+    outputs = []
+    for ds_all, result, label in zip(datasets, results, labels):
+        ds_out, out_cols, total_nll = _output_dataset(ds_all, result)
+        names = [col for col, _ in out_cols]
+        ds_out.dropna(subset=names, inplace=True)
+        outputs.append((ds_out, total_nll))
+        part = ds_out[names].rename(columns={col: f"{col}_{label}" for col in names})
+        merged = part if merged is None else merged.join(part, how="outer")
+    merged.label_centrics(inplace=True)
+    merged.write_mtz(outfile)
+    return outputs
+
+
+def _output_dataset(ds_all, results):
+    """Copy of ds_all with the extrapolated columns, the (column, MTZ type) pairs of
+    those columns and the negative log-likelihood."""
+    total_nll = -np.sum(results["loglik"])
 
-    for col, mtz_type in [
+    # Assign and cast to MTZ-friendly types
+    ds_out = ds_all.copy()
+    ds_out["ES_abs_2"] = results["ES"].astype("float32")
+    ds_out["SIGES_abs_2"] = results["SIGES"].astype("float32")
+    ds_out["FS_abs_2"] = results["FS"].astype("float32")
+    ds_out["SIGFS_abs_2"] = results["SIGFS"].astype("float32")
+    out_cols = [
         ("ES_abs_2", "F"),
         ("SIGES_abs_2", "Q"),
         ("FS_abs_2", "F"),
         ("SIGFS_abs_2", "Q"),
-    ]:
-        ds_all[col] = ds_all[col].astype(mtz_type)
+    ]
+    if "SE_ES" in results:
+        ds_out["SE_ES_abs_2"] = results["SE_ES"].astype("float32")
+        out_cols.append(("SE_ES_abs_2", "Q"))
+    if "SE_loglik" in results:
+        ds_out["SE_LOGLIK"] = results["SE_loglik"].astype("float32")
+        out_cols.append(("SE_LOGLIK", "R"))
+    for key in ES_QUANTILES:
+        if key in results:
+            ds_out[key] = results[key].astype("float32")
+            out_cols.append((key, "F"))
+    if "ESS" in results:
+        ds_out["ESS"] = results["ESS"].astype("float32")
+        ds_out["NSAMPLES"] = results["NSAMPLES"].astype("int32")
+        out_cols += [("ESS", "R"), ("NSAMPLES", "I")]
+
+    for col, mtz_type in out_cols:
+        ds_out[col] = ds_out[col].astype(mtz_type)
+    return ds_out, out_cols, total_nll
+
+
+class Checkpoint:
+    """Per-reflection results of a run, kept on disk so that an interrupted run can be
+    resumed.
+
+    The directory holds ``params.json`` with the run parameters and their hash, the
+    Miller indices (``hkl.npy``, preceded by the index of the ON dataset when there are
+    several) and measurement inputs (``inputs.npy``) of its rows, a ``done.npy`` mask
+    and one (rows x tables) ``.npy`` file per output, all memory-mapped. Reflections are
+    matched to rows by Miller index. A reflection is computed again if it has no row, if
+    its row is not done or if its measurements changed; reflections that are new to the
+    data get new rows. The resolution-dependent Sigma is not part of the compared
+    inputs, so rows that are kept are not updated for the small change of Sigma that
+    appended reflections bring.
+    """
 
-    ds_all.dropna(inplace=True)
-    # ds_all.infer_mtz_dtypes(inplace=True)
-    ds_all[["ES_abs_2", "SIGES_abs_2", "FS_abs_2", "SIGFS_abs_2", "CENTRIC"]].write_mtz(
-        args.outfile
+    def __init__(
+        self,
+        path,
+        params,
+        hkl,
+        inputs,
+        output_keys,
+        ntables,
+        resume=False,
+        interval=60.0,
+    ):
+        self.path = path
+        self.interval = interval
+        self.output_keys = output_keys
+        params_path = os.path.join(path, "params.json")
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+        if os.path.exists(params_path):
+            if not resume:
+                raise ValueError(
+                    f"{path} holds a checkpoint; pass --resume to continue it or "
+                    "remove it"
+                )
+            with open(params_path, encoding="utf-8") as f:
+                if json.load(f)["hash"] != digest:
+                    raise ValueError(
+                        f"The checkpoint in {path} was written with different "
+                        "parameters"
+                    )
+            old_hkl = np.load(os.path.join(path, "hkl.npy"))
+        else:
+            os.makedirs(path, exist_ok=True)
+            old_hkl = np.empty((0, hkl.shape[1]), dtype=np.int32)
+
+        # Rows of the known reflections, followed by new rows for the others
+        known = {tuple(h): row for row, h in enumerate(old_hkl)}
+        self.rows = np.array([known.get(tuple(h), -1) for h in hkl], dtype=np.int64)
+        new = np.flatnonzero(self.rows < 0)
+        self.rows[new] = len(old_hkl) + np.arange(len(new))
+        nrows = len(old_hkl) + len(new)
+        self.arrays = {
+            "hkl": self._open("hkl", (nrows, hkl.shape[1]), np.int32, len(old_hkl)),
+            "inputs": self._open(
+                "inputs", (nrows, inputs.shape[1]), np.float64, len(old_hkl)
+            ),
+            "done": self._open("done", (nrows,), bool, len(old_hkl)),
+        }
+        for key in output_keys:
+            self.arrays[key] = self._open(
+                key, (nrows, ntables), np.float64, len(old_hkl)
+            )
+        self.arrays["hkl"][self.rows[new]] = hkl[new]
+
+        changed = np.any(self.arrays["inputs"][self.rows] != inputs, axis=1)
+        self.arrays["done"][self.rows[changed]] = False
+        self.arrays["inputs"][self.rows] = inputs
+        self.todo = np.flatnonzero(~self.arrays["done"][self.rows])
+        self.flush()
+        with open(params_path, "w", encoding="utf-8") as f:
+            json.dump({"hash": digest, "params": params}, f, indent=2)
+        self.last_flush = time.monotonic()
+
+    def _open(self, name, shape, dtype, nold):
+        """Memory-map ``name``.npy with ``shape``, keeping the first ``nold`` rows of an
+        existing file."""
+        path = os.path.join(self.path, name + ".npy")
+        if nold > 0:
+            array = np.load(path, mmap_mode="r+")
+            if array.shape == shape:
+                return array
+        # New or appended reflections: a new file, into which the old rows are copied,
+        # replaces the old one
+        tmp = os.path.join(self.path, f".{name}.npy")
+        grown = np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=shape)
+        grown[...] = np.nan if dtype == np.float64 else 0
+        if nold > 0:
+            grown[:nold] = array
+            del array
+        grown.flush()
+        os.replace(tmp, path)
+        return grown
+
+    def store(self, idx, outputs):
+        """Record the outputs (dict of (tables x len(idx)) arrays) of the reflections
+        idx."""
+        rows = self.rows[idx]
+        for key in self.output_keys:
+            self.arrays[key][rows] = outputs[key].T
+        self.arrays["done"][rows] = True
+        if time.monotonic() - self.last_flush > self.interval:
+            self.flush()
+
+    def flush(self):
+        """Write the memory-mapped arrays to disk, the done mask last."""
+        for name, array in self.arrays.items():
+            if name != "done":
+                array.flush()
+        self.arrays["done"].flush()
+        self.last_flush = time.monotonic()
+
+    def results(self):
+        """The outputs of the current reflections, as returned by :func:`run_dw`."""
+        ntables = self.arrays[self.output_keys[0]].shape[1]
+        return [
+            {key: self.arrays[key][self.rows, i] for key in self.output_keys}
+            for i in range(ntables)
+        ]
+
+
+def _checkpoint_params(args, model, rp_values, replicates):
+    """Everything besides the data that determines the results of a run, for
+    :class:`Checkpoint`."""
+    names = (
+        "engine",
+        "nsamples",
+        "sampler",
+        "seed",
+        "qmc_replicates",
+        "nbins",
+        "nodes",
+        "adaptive",
+        "min_samples",
+        "ess_target",
+        "se_target",
+        "antithetic",
+        "control_variates",
     )
+    params = {name: getattr(args, name) for name in names}
+    params.update(
+        model=model, rp_values=[list(rp) for rp in rp_values], replicates=replicates
+    )
+    # Sorted samples change the order of the sums, so runs with quantiles cannot resume
+    # runs without them
+    if args.quantiles:
+        params.update(quantiles=True)
+    return params
+
+
+def run_checkpointed(
+    args, datasets, model, cols, centric, tables, replicates, rp_values, groups=None
+):
+    """:func:`run_dw` for the reflections that the ``--checkpoint`` directory does not
+    hold yet.
+
+    Finished blocks are recorded in the checkpoint as they arrive (with ``--backend
+    mpi`` once the results are gathered) and the outputs of all reflections are returned
+    from it. Without ``--checkpoint`` this is :func:`run_dw`. Like :func:`run_dw`, ranks
+    other than 0 pass None for the data and get None back.
+    """
+    if args.checkpoint is None:
+        return run_dw(args, model, cols, centric, tables, replicates, groups=groups)
+    checkpoint = None
+    on_block = None
+    if datasets is not None:
+        hkl = np.concatenate([ds_all.get_hkls() for ds_all in datasets])
+        if groups is not None:
+            hkl = np.column_stack([groups, hkl]).astype(np.int32)
+        _, output_keys = _estimate_options(args, replicates)
+        inputs = np.column_stack(
+            [
+                value
+                for key, value in cols.items()
+                if not key.startswith(("Sigma_", "sqrt_Sig_"))
+            ]
+        )
+        checkpoint = Checkpoint(
+            args.checkpoint,
+            _checkpoint_params(args, model, rp_values, replicates),
+            hkl,
+            inputs,
+            output_keys,
+            len(tables) if groups is None else 1,
+            resume=args.resume,
+            interval=args.checkpoint_interval,
+        )
+        todo = checkpoint.todo
+        print(
+            f"Checkpoint {args.checkpoint}: {len(centric) - len(todo)} of "
+            f"{len(centric)} reflections done"
+        )
+        cols = {key: value[todo] for key, value in cols.items()}
+        centric = centric[todo]
+        if groups is not None:
+            groups = groups[todo]
+
+        def on_block(idx, outputs):
+            checkpoint.store(
+                todo[idx], {key: outputs[key][:, idx] for key in output_keys}
+            )
 
-    # Cleanup shared memory
-    for shm in [GS_ac_shm_obj, ES_ac_shm_obj, GS_c_shm_obj, ES_c_shm_obj]:
-        shm.close()
-        shm.unlink()
+    results = run_dw(
+        args, model, cols, centric, tables, replicates, on_block=on_block, groups=groups
+    )
+    if results is None:
+        return None
+    if args.backend == "mpi":
+        checkpoint.store(
+            todo,
+            {
+                key: np.stack([r[key] for r in results])
+                for key in checkpoint.output_keys
+            },
+        )
+    checkpoint.flush()
+    return checkpoint.results()
 
-    return ds_all, total_nll
 
+def _format_nll(ds_out, total_nll):
+    """The NLL, with its Monte Carlo standard error when the per-reflection errors were
+    written."""
+    if "SE_LOGLIK" not in ds_out:
+        return f"{total_nll}"
+    se = np.sqrt(np.sum(ds_out["SE_LOGLIK"].to_numpy(np.float64) ** 2))
+    return f"{total_nll} +/- {se:.4g}"
 
-def main():
-    parser = parse_arguments()
-    args = parser.parse_args()
 
-    if args.default_scan:
-        # fixed r
+def _prepare_root(args):
+    """:func:`prepare_data` and the centric flags, on rank 0 only with ``--backend mpi``
+    (Nones elsewhere)."""
+    comm = mpi_comm(args.backend)
+    if comm is not None and comm.rank != 0:
+        return None, None, None, None, None
+    datasets, model, cols, groups = prepare_data(args)
+    centric = np.concatenate([ds_all.CENTRIC.to_numpy(bool) for ds_all in datasets])
+    return datasets, model, cols, centric, groups
 
-        if not args.rDW:
-            args.rDW = 0.9
 
-        # disallow conflicting options
-        if args.factor or args.es_fraction:
-            raise ValueError(
-                "--default_scan cannot be used with --es-fraction or --factor"
-            )
-
-        p_values = np.arange(0.05, 0.51, 0.05)
+def _series_labels(onmtzs):
+    """Output label of every ON file: its name without the extension, or its position
+    when names repeat."""
+    labels = [os.path.splitext(os.path.basename(path))[0] for path in onmtzs]
+    if len(set(labels)) < len(labels):
+        labels = [f"on{i + 1}" for i in range(len(onmtzs))]
+    return labels
 
-        base_out = args.outfile
 
-        best = (None, np.inf)  # (p, ll)
-        scan_rows = []
+def extrapolate_dw(args):
+    """Run DW extrapolation given parsed command-line arguments.
 
-        for p in p_values:
-            args.es_fraction = float(p)
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Parsed arguments from :func:`parse_arguments`.
 
-            args.outfile = base_out.replace(".mtz", f"_p{p:.2f}.mtz")
+    Returns
+    -------
+    (ds_out, total_nll) : tuple
+        Output dataset containing extrapolated structure factor columns that were
+        written to the output MTZ, and the negative log-likelihood. With ``--backend
+        mpi`` only rank 0 reads and writes the data; the other ranks return None. With
+        several ON datasets, a list with one tuple per dataset; their outputs are
+        written to ``args.outfile`` with a ``_{label}`` suffix (see
+        :func:`_series_labels`), or to its columns with ``--single-mtz``.
+    """
+    rp_values = [(args.rDW, p) for p in _es_fractions(args)]
+    datasets, model, cols, centric, groups = _prepare_root(args)
+    tables, replicates = build_tables(args, rp_values)
+    series = len(args.onmtz) > 1
+    results = run_checkpointed(
+        args,
+        datasets,
+        model,
+        cols,
+        centric,
+        tables,
+        replicates,
+        rp_values,
+        groups if series else None,
+    )
+    if results is None:
+        return None
+    if not series:
+        return write_dw(datasets[0], results[0], args.outfile)
+
+    bounds = np.cumsum([0] + [len(ds_all) for ds_all in datasets])
+    results = [
+        {key: value[start:stop] for key, value in results[0].items()}
+        for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
+    labels = _series_labels(args.onmtz)
+    if args.single_mtz:
+        return write_dw_series(datasets, results, labels, args.outfile)
+    return [
+        write_dw(ds_all, result, args.outfile.replace(".mtz", f"_{label}.mtz"))
+        for ds_all, result, label in zip(datasets, results, labels)
+    ]
+
+
+def scan_dw(args, r_values, p_values):
+    """Evaluate a grid of (r, p) values with a single data preparation and pool pass.
+
+    The data are read and prepared once, the Monte Carlo samples are drawn once, and
+    every reflection is evaluated against the sample tables of all (r, p) in the same
+    worker task. One MTZ is written per (r, p), named after ``args.outfile`` with a
+    ``_p{p}`` (or ``_r{r}_p{p}`` when scanning r) suffix, and the negative
+    log-likelihoods are written to ``<outfile>_scan.csv``.
 
-            print(f"Running default scan: r={args.rDW}, p={p:.2f}")
-            ds_out, total_nll = extrapolate_dw(args)
-            print(f"Negative Log Likelihood = {total_nll}")
+    Returns
+    -------
+    list of (r, p, nll)
+        On rank 0 (or without MPI); None on the other ranks with ``--backend mpi``
+    """
+    if len(args.onmtz) > 1:
+        raise ValueError("Scans take a single ON dataset")
+    rp_values = [(float(r), float(p)) for r in r_values for p in p_values]
+    datasets, model, cols, centric, _ = _prepare_root(args)
+    tables, replicates = build_tables(args, rp_values)
+    if datasets is not None:
+        print(f"Running scan over {len(rp_values)} (r, p) values")
+    results = run_checkpointed(
+        args, datasets, model, cols, centric, tables, replicates, rp_values
+    )
+    if results is None:
+        return None
+    ds_all = datasets[0]
+
+    base_out = args.outfile
+    scan_rows = []
+    for (r, p), result in zip(rp_values, results):
+        if len(r_values) > 1:
+            outfile = base_out.replace(".mtz", f"_r{r:.2f}_p{p:.2f}.mtz")
+        else:
+            outfile = base_out.replace(".mtz", f"_p{p:.2f}.mtz")
+        ds_out, total_nll = write_dw(ds_all, result, outfile)
+        print(
+            f"  r={r:.2f}, p={p:.2f}: Negative Log Likelihood = "
+            f"{_format_nll(ds_out, total_nll)}"
+        )
+        scan_rows.append((r, p, total_nll))
+
+    np.savetxt(
+        base_out.replace(".mtz", "_scan.csv"),
+        np.array(scan_rows),
+        delimiter=",",
+        fmt=["%.4f", "%.4f", "%.6f"],
+        header="r,p,NLL",
+        comments="",
+    )
+    return scan_rows
 
-            scan_rows.append((p, total_nll))
 
-            if np.isfinite(total_nll) and total_nll < best[1]:
-                best = (p, total_nll)
+def main():
+    parser = parse_arguments()
+    args = parser.parse_args()
 
-        if best[0] is None:
+    scan_flags = [
+        flag
+        for flag, value in (
+            ("--default_scan", args.default_scan),
+            ("--scan_p", args.scan_p),
+            ("--scan_r", args.scan_r),
+        )
+        if value
+    ]
+    if scan_flags:
+        # disallow conflicting options
+        if args.factor or args.es_fraction:
+            fraction_flag = "--factor" if args.factor else "--es-fraction"
+            parser.error(f"{scan_flags[0]} cannot be used with {fraction_flag}")
+        if len(args.onmtz) > 1:
+            parser.error(f"{scan_flags[0]} takes a single ON dataset (-on)")
+
+        p_values = args.scan_p or np.arange(0.05, 0.51, 0.05)
+        r_values = args.scan_r or [args.rDW]
+
+        scan_rows = scan_dw(args, r_values, p_values)
+        if scan_rows is None:
+            return
+        finite = [row for row in scan_rows if np.isfinite(row[2])]
+        if not finite:
             raise RuntimeError("No finite NLL values found in scan.")
+        r, p, nll = min(finite, key=lambda row: row[2])
         print("\nDefault scan MLE (grid):")
-        print(f"  r={args.rDW}, p={best[0]:.2f}, NLL={best[1]:.3f}")
+        print(f"  r={r}, p={p:.2f}, NLL={nll:.3f}")
     else:
-        ds_out, total_nll = extrapolate_dw(args)
-        print(f"NLL = {total_nll}")
+        result = extrapolate_dw(args)
+        if result is None:
+            return
+        if len(args.onmtz) == 1:
+            print(f"NLL = {_format_nll(*result)}")
+        else:
+            for label, (ds_out, total_nll) in zip(_series_labels(args.onmtz), result):
+                print(f"  {label}: NLL = {_format_nll(ds_out, total_nll)}")
 
 
 def parse_arguments():
@@ -559,14 +1001,18 @@ def parse_arguments():
         "--onmtz",
         nargs="+",
         required=True,
-        help=".mtz file for perturbed dataset",
+        help=(
+            ".mtz file for perturbed dataset, or several (e.g. the time points of a\n"
+            "series) that are extrapolated against the same OFF data and Monte Carlo\n"
+            "samples"
+        ),
     )
     parser.add_argument(
         "-off",
         "--offmtz",
         nargs="+",
         required=True,
-        help=".mtz file for ground state dataset",
+        help=".mtz file for ground state dataset (only the first is used)",
     )
     parser.add_argument(
         "-use_SF",
@@ -574,10 +1020,10 @@ def parse_arguments():
         nargs="+",
         metavar="COL",
         help=(
-            "Use structure factors from French-Wilson scaling. "
-            "Provide 2 column names (F_col SigF_col) to use the same columns for both "
-            "on and off MTZs, or 4 column names (F_col_off SigF_col_off F_col_on SigF_col_on) "
-            "to use different columns for each file."
+            "Use structure factors from French-Wilson scaling. Provide 2 column names "
+            "(F_col SigF_col) to use the same columns for both on and off MTZs, or 4 "
+            "column names (F_col_off SigF_col_off F_col_on SigF_col_on) to use "
+            "different columns for each file."
         ),
     )
     parser.add_argument(
@@ -586,10 +1032,10 @@ def parse_arguments():
         nargs="+",
         metavar="COL",
         help=(
-            "Use integrated intensities. "
-            "Provide 2 column names (I_col SigI_col) to use the same columns for both "
-            "on and off MTZs, or 4 column names (I_col_off SigI_col_off I_col_on SigI_col_on) "
-            "to use different columns for each file."
+            "Use integrated intensities. Provide 2 column names (I_col SigI_col) to "
+            "use the same columns for both on and off MTZs, or 4 column names "
+            "(I_col_off SigI_col_off I_col_on SigI_col_on) to use different columns "
+            "for each file."
         ),
     )
     parser.add_argument(
@@ -607,25 +1053,246 @@ def parse_arguments():
         help="Double Wilson r (correlation) parameter",
     )
     parser.add_argument(
-        "-p", "--es-fraction", type=float, help="Excited state fraction p"
+        "-p",
+        "--es-fraction",
+        type=float,
+        nargs="+",
+        help="Excited state fraction p, or one value for each ON dataset",
     )
     parser.add_argument(
-        "-f", "--factor", type=float, help="Extrapolation factor f = 1/p"
+        "-f",
+        "--factor",
+        type=float,
+        nargs="+",
+        help="Extrapolation factor f = 1/p, or one value for each ON dataset",
     )
     parser.add_argument(
         "-o", "--outfile", default="esf_dw.mtz", help="Output file name"
     )
+    parser.add_argument(
+        "--single-mtz",
+        action="store_true",
+        help=(
+            "With several ON datasets, write all of their columns to the output file,\n"
+            "suffixed with the name of the ON file, instead of one output file per ON\n"
+            "dataset"
+        ),
+    )
     parser.add_argument(
         "--nproc",
         type=int,
         default=None,
         help="Number of processors for multiprocessing",
     )
+    parser.add_argument(
+        "--backend",
+        choices=["pool", "mpi"],
+        default="pool",
+        help=(
+            "Execution backend. 'pool' uses a multiprocessing pool of --nproc\n"
+            "processes on one machine. 'mpi' splits the reflections across the ranks\n"
+            "of an MPI job (e.g. mpirun -n 4 ...; requires mpi4py) and ignores\n"
+            "--nproc"
+        ),
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["mc", "histogram", "quadrature"],
+        default="mc",
+        help=(
+            "Likelihood engine. 'mc' evaluates every Monte Carlo sample. 'histogram'\n"
+            "bins the samples onto a 2D (|F_OFF|, |F_ON|) grid and evaluates each\n"
+            "reflection once per occupied cell; the relative error of a cell weight\n"
+            "is about (bin width / sigma)^2 (z^2 - 1) / 24 per axis. 'quadrature'\n"
+            "integrates over |F_GS| and |F_ON| with Gauss-Legendre rules fitted to\n"
+            "each reflection and handles the phase analytically; it is deterministic\n"
+            "and ignores --nsamples, --sampler and --seed"
+        ),
+    )
+    parser.add_argument(
+        "--nbins",
+        type=int,
+        default=256,
+        help="Number of bins along each axis of the histogram engine grid",
+    )
+    parser.add_argument(
+        "--nodes",
+        type=int,
+        default=48,
+        help="Number of Gauss-Legendre nodes per axis of the quadrature engine",
+    )
+    parser.add_argument(
+        "--sampler",
+        choices=["mc", "sobol"],
+        default="mc",
+        help=(
+            "How the standard normal draws are generated. 'mc' uses pseudo-random\n"
+            "numbers. 'sobol' maps scrambled Sobol points through the inverse normal\n"
+            "CDF (randomized quasi-Monte Carlo); the number of samples is rounded up\n"
+            "to a power of 2 per replicate, and with more than one replicate the\n"
+            "standard error of ES_abs_2 is written to SE_ES_abs_2"
+        ),
+    )
+    parser.add_argument(
+        "--qmc-replicates",
+        type=int,
+        default=4,
+        help=(
+            "Number of independently scrambled Sobol replicates used with --sampler "
+            "sobol"
+        ),
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help=(
+            "Give each reflection only as many samples as it needs: start from the\n"
+            "first --min-samples samples and double the prefix until --ess-target or\n"
+            "--se-target is met or all samples are used. The effective sample size\n"
+            "and number of samples used are written to ESS and NSAMPLES"
+        ),
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=None,
+        metavar="DIR",
+        help=(
+            "Keep the per-reflection results in DIR as memory-mapped .npy files,\n"
+            "updated as blocks finish (with --backend mpi once the results are\n"
+            "gathered). Rerun with --resume to compute only the reflections that are\n"
+            "missing, new to the data or whose measurements changed"
+        ),
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=(
+            "Continue the run in --checkpoint; its parameters must match those of this "
+            "run"
+        ),
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        default=60,
+        metavar="SECONDS",
+        help="How often the checkpoint is flushed to disk",
+    )
+    parser.add_argument(
+        "--sample-bank",
+        default=None,
+        metavar="DIR",
+        help=(
+            "Directory of an on-disk sample bank. The standard normal draws and the\n"
+            "sample table of every (r, p) are stored there as .npy files keyed by\n"
+            "sampler, seed, number of samples, r and p, and reused by later runs;\n"
+            "workers memory-map them read-only instead of receiving shared memory\n"
+            "copies. Not used with --engine quadrature"
+        ),
+    )
+    parser.add_argument(
+        "--antithetic",
+        action="store_true",
+        help=(
+            "Draw the samples in antithetic pairs that differ in the sign of the ES\n"
+            "innovation. Reduces the variance of ES_abs_2; --nsamples counts both\n"
+            "members of the pairs. Needs --engine mc and, with --sampler sobol,\n"
+            "--qmc-replicates 1"
+        ),
+    )
+    parser.add_argument(
+        "--control-variates",
+        action="store_true",
+        help=(
+            "Use the OFF and ON data terms, whose expectations under the Wilson prior\n"
+            "are known, as control variates for the likelihood. Reduces the variance\n"
+            "of the NLL and uses the analytic scale of the ON amplitudes instead of\n"
+            "the ratio of medians. Needs --engine mc and, with --sampler sobol,\n"
+            "--qmc-replicates 1"
+        ),
+    )
+    parser.add_argument(
+        "--quantiles",
+        action="store_true",
+        help=(
+            "Also write the 5%%, 50%% and 95%% posterior quantiles of |ES| (ES_q05,\n"
+            "ES_q50, ES_q95). The samples are sorted by |ES| once per run, so the\n"
+            "quantiles come from the cumulative sum of the weights at about the cost\n"
+            "of the moments. Needs --engine mc without --adaptive, --antithetic,\n"
+            "--control-variates or QMC replicates"
+        ),
+    )
+    parser.add_argument(
+        "--min-samples",
+        type=int,
+        default=4096,
+        help="Number of samples each reflection starts with in --adaptive mode",
+    )
+    parser.add_argument(
+        "--ess-target",
+        type=float,
+        default=1000,
+        help="Effective sample size at which --adaptive stops extending a reflection",
+    )
+    parser.add_argument(
+        "--se-target",
+        type=float,
+        default=None,
+        help=(
+            "Standard error of ES_abs_2, relative to ES_abs_2, at which --adaptive\n"
+            "stops extending a reflection (default: not used)"
+        ),
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=256,
+        help="Number of reflections sent to a worker at a time",
+    )
+    parser.add_argument(
+        "--tile-mb",
+        type=float,
+        default=64,
+        help=(
+            "Memory budget in MB for each (reflections x samples) temporary in a "
+            "worker; controls how many reflections are evaluated against the samples "
+            "at once"
+        ),
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=None,
+        metavar="MB",
+        help=(
+            "Total memory for the run in MB. Picks the number of workers (at most\n"
+            "--nproc), the BLAS/OpenMP threads per worker and the tile size (at most\n"
+            "--tile-mb) so that the run fits, and prints the plan. Only used with\n"
+            "--backend pool"
+        ),
+    )
     parser.add_argument(
         "--default_scan",
         action="store_true",
         help="Run default scan with r=0.9 and p from 0.05 to 0.5 in steps of 0.05",
     )
+    parser.add_argument(
+        "--scan_p",
+        type=float,
+        nargs="+",
+        default=None,
+        help=(
+            "p values for the scan (default: 0.05 to 0.5 in steps of 0.05); implies a "
+            "scan"
+        ),
+    )
+    parser.add_argument(
+        "--scan_r",
+        type=float,
+        nargs="+",
+        default=None,
+        help="r values for the scan (default: the value of -r); implies a scan",
+    )
     parser.add_argument(
         "--disable-progress-bar", action="store_true", help="Disable tqdm progress bar"
     )
@@ -638,64 +1305,6 @@ def parse_arguments():
     return parser
 
 
-# For getting truncated Normal parameters using method of moments
-def reparam(df):
-    l = len(df["F"])
-    high = np.repeat(np.array([1e10], dtype=np.float32), l)
-    df["high"] = high
-    low = np.repeat(np.array([1e-32], dtype=np.float32), l)
-    df["low"] = low
-
-    mean = df["F"].to_numpy()
-    std = df["SigF"].to_numpy()
-    locs = np.zeros(len(mean))
-    scales = np.zeros(len(std))
-
-    a = 1e-32
-    b = 1e10
-
-    for i in range(len(mean)):
-        m = mean[i]
-        s = std[i]
-
-        guess_x = (a - m) / s
-        guess_y = (b - m) / s
-        sol = optimize.root(equations, x0=[guess_x, guess_y], args=(m, s))
-        alpha_hat, beta_hat = sol.x
-        sigma_hat = (a - b) / (alpha_hat - beta_hat)
-        mu_hat = a - sigma_hat * alpha_hat
-        sigma_hat = np.abs(sigma_hat)
-
-        locs[i] = mu_hat
-        scales[i] = sigma_hat
-
-    df["loc"] = locs
-    df["scale"] = scales
-    df = df.infer_mtz_dtypes()
-
-    return df
-
-
-# Method of Moments equations for the reparam function
-def equations(ab, m, s):
-    a = 1e-32
-    b = 1e10
-
-    alpha, beta = ab
-    Z = norm.cdf(beta) - norm.cdf(alpha)
-    lam = (norm.pdf(alpha) - norm.pdf(beta)) / Z
-    nu = 1 + (alpha * norm.pdf(alpha) - beta * norm.pdf(beta)) / Z - lam**2
-    sigma = (b - a) / (beta - alpha)
-    mu = a - sigma * alpha
-    return [mu + sigma * lam - m, sigma**2 * nu - s**2]
-
-
-# worker function for computing the log-mean in the likelihood caclulation
-def _logmeanexp(logw):
-    m = np.max(logw)
-    return m + np.log(np.mean(np.exp(logw - m) + 1e-300))
-
-
 if __name__ == "__main__":
     mp.set_start_method("spawn", force=True)
     main()
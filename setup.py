@@ -49,7 +49,8 @@ setup(
     install_requires=["reciprocalspaceship", "matplotlib", "seaborn"],
     extras_require={
         "dev": tests_require + docs_require,
-        "docs": docs_require
+        "docs": docs_require,
+        "mpi": ["mpi4py"],
     },
     entry_points={
         "console_scripts": [
@@ -0,0 +1,1532 @@
+import argparse
+import contextlib
+import json
+import multiprocessing as mp
+import os
+import sys
+from multiprocessing import shared_memory
+
+import gemmi
+import pytest
+import numpy as np
+import reciprocalspaceship as rs
+from scipy import optimize, special
+from scipy.stats import truncnorm, norm
+
+from rsbooster.esf.dw_common import (
+    sample_table,
+    sobol_normal_samples,
+    reflection_logweights,
+    antithetic_samples,
+    histogram_table,
+    histogram_resolution,
+    quadrature_table,
+    estimate_reflections,
+    fused_reflections,
+    truncnorm_params_from_moments,
+    equations,
+    split_reflections,
+    create_shared_arrays,
+    attach_shared_arrays,
+    release_shared_arrays,
+    sample_bank,
+    plan_execution,
+    limit_worker_threads,
+    THREAD_ENV_VARS,
+    WORKER_BASE_MB,
+    TILE_TEMPORARIES,
+    ES_QUANTILES,
+)
+from rsbooster.esf import dw_common, dw_extrapolator, mle_dw_extrapolator
+from rsbooster.esf.dw_extrapolator import (
+    Checkpoint,
+    _es_fractions,
+    _segments,
+    _series_labels,
+)
+from rsbooster.esf.mle_dw_extrapolator import (
+    bayes_minimize,
+    profile_interval,
+    stratified_minibatch,
+    write_grid,
+)
+
+
+@pytest.fixture
+def table():
+    rng = np.random.default_rng(0)
+    raw_Z_ac = rng.standard_normal((5000, 4)).astype(np.float32)
+    raw_Z_c = rng.standard_normal((5000, 2)).astype(np.float32)
+    return sample_table(raw_Z_ac, raw_Z_c, r=0.9, p=0.2)
+
+
+def _reflections(model, n=7, seed=1):
+    rng = np.random.default_rng(seed)
+    cols = {
+        "sqrt_eps": np.ones(n),
+        "sqrt_Sig_off": rng.uniform(5, 20, n),
+        "sqrt_Sig_on": rng.uniform(5, 20, n),
+    }
+    F_off = cols["sqrt_Sig_off"] * rng.rayleigh(np.sqrt(0.5), n)
+    F_on = cols["sqrt_Sig_on"] * rng.rayleigh(np.sqrt(0.5), n)
+    if model == "SF":
+        cols.update(
+            loc_off=F_off,
+            scale_off=rng.uniform(0.5, 3, n),
+            loc_on=F_on,
+            scale_on=rng.uniform(0.5, 3, n),
+            low_off=np.full(n, 1e-32),
+            high_off=np.full(n, 1e10),
+            low_on=np.full(n, 1e-32),
+            high_on=np.full(n, 1e10),
+        )
+    else:
+        cols.update(
+            I_off=F_off**2,
+            SigI_off=rng.uniform(5, 30, n),
+            I_on=F_on**2,
+            SigI_on=rng.uniform(5, 30, n),
+            Sigma_off=cols["sqrt_Sig_off"] ** 2,
+            Sigma_on=cols["sqrt_Sig_on"] ** 2,
+        )
+    return cols
+
+
+def _reference(table, case, cols, model, i):
+    """Per-reflection estimate written with frozen scipy distributions"""
+    OF_abs = table["OF_abs_" + case].astype(np.float64)
+    ON_abs = table["ON_abs_" + case].astype(np.float64)
+    ES_abs = table["ES_abs_" + case].astype(np.float64)
+    c = {key: value[i] for key, value in cols.items()}
+    if model == "SF":
+        logw = 0
+        for state, x in (("off", OF_abs), ("on", ON_abs)):
+            loc, scale = c["loc_" + state], c["scale_" + state]
+            a = (c["low_" + state] - loc) / scale
+            b = (c["high_" + state] - loc) / scale
+            logw = logw + truncnorm(a, b, loc=loc, scale=scale).logpdf(
+                c["sqrt_eps"] * c["sqrt_Sig_" + state] * x
+            )
+    else:
+        eps = c["sqrt_eps"] ** 2
+        logw = norm(OF_abs**2 * c["Sigma_off"] * eps, c["SigI_off"]).logpdf(c["I_off"])
+        logw += norm(ON_abs**2 * c["Sigma_on"] * eps, c["SigI_on"]).logpdf(c["I_on"])
+    m = logw.max()
+    w = np.exp(logw - m)
+    loglik = m + np.log(np.mean(w) + 1e-300)
+    w /= w.sum()
+    mean = np.sum(w * ES_abs)
+    return loglik, c["sqrt_eps"] * mean
+
+
+@pytest.mark.parametrize("model", ["SF", "I"])
+@pytest.mark.parametrize("case", ["ac", "c"])
+def test_estimate_reflections_matches_scipy(table, model, case):
+    cols = _reflections(model)
+    results = estimate_reflections(table, case, cols, model)
+    for i in range(len(cols["sqrt_eps"])):
+        loglik, es = _reference(table, case, cols, model, i)
+        assert np.isclose(results["loglik"][i], loglik, rtol=1e-6)
+        assert np.isclose(results["ES"][i], es, rtol=1e-4)
+
+
+@pytest.mark.parametrize("tile_bytes", [8 * 1000, 8 * 12000])
+def test_estimate_reflections_tiling(table, tile_bytes):
+    """Results should not depend on how the reflections x samples matrix is tiled"""
+    cols = _reflections("SF")
+    expected = estimate_reflections(table, "ac", cols, "SF")
+    results = estimate_reflections(table, "ac", cols, "SF", tile_bytes=tile_bytes)
+    for key, value in expected.items():
+        assert np.allclose(results[key], value, rtol=1e-10, equal_nan=True)
+
+
+def test_sobol_normal_samples():
+    raw_Z_ac, raw_Z_c = sobol_normal_samples(5000, seed=0, replicates=4)
+    assert raw_Z_ac.shape == (4 * 2048, 4)
+    assert raw_Z_c.shape == (4 * 2048, 2)
+    assert np.all(np.isfinite(raw_Z_ac)) and np.all(np.isfinite(raw_Z_c))
+    # Each scrambled replicate is a balanced point set
+    for block in np.split(raw_Z_ac.astype(np.float64), 4):
+        assert np.allclose(block.mean(axis=0), 0, atol=1e-2)
+        assert np.allclose(block.std(axis=0), 1, atol=1e-2)
+
+
+@pytest.mark.parametrize("tile_bytes", [64 * 2**20, 8 * 3000])
+def test_estimate_reflections_replicates(tile_bytes):
+    """Replicate standard errors should not depend on tiling and should match the spread
+    of the replicates"""
+    raw_Z_ac, raw_Z_c = sobol_normal_samples(4096, seed=0, replicates=4)
+    table = sample_table(raw_Z_ac, raw_Z_c, r=0.9, p=0.2)
+    cols = _reflections("SF")
+    results = estimate_reflections(
+        table, "ac", cols, "SF", tile_bytes=tile_bytes, replicates=4
+    )
+
+    means = []
+    for block in range(4):
+        sub = {
+            key: value[block * 1024 : (block + 1) * 1024]
+            for key, value in table.items()
+        }
+        means.append(estimate_reflections(sub, "ac", cols, "SF")["ES"])
+    se = np.std(means, axis=0, ddof=1) / 2
+    assert np.allclose(results["SE_ES"], se, rtol=1e-6)
+
+
+@pytest.mark.parametrize("model", ["SF", "I"])
+def test_adaptive_reflections(table, model):
+    """Adaptive prefixes should stop at the targets and reduce to the full estimate when
+    they are unreachable"""
+    cols = _reflections(model, n=20)
+    expected = estimate_reflections(table, "ac", cols, model)
+    results = estimate_reflections(
+        table, "ac", cols, model, min_samples=100, ess_target=np.inf
+    )
+    assert np.all(results["NSAMPLES"] == 5000)
+    for key in ("loglik", "ES", "SIGES"):
+        assert np.allclose(results[key], expected[key], rtol=1e-6, equal_nan=True)
+
+    results = estimate_reflections(
+        table, "ac", cols, model, min_samples=100, ess_target=50
+    )
+    assert np.all((results["ESS"] >= 50) | (results["NSAMPLES"] == 5000))
+    assert np.all(np.isin(results["NSAMPLES"], [100, 200, 400, 800, 1600, 3200, 5000]))
+    assert np.any(results["NSAMPLES"] < 5000)
+
+
+@pytest.mark.parametrize(
+    "options", [["--min-samples", "0"], ["--ess-target", "0"], ["--se-target", "-0.1"]]
+)
+def test_adaptive_options(options):
+    """Sample budgets and targets that are not positive should be rejected before any
+    samples are drawn"""
+    argv = ["-on", "on.mtz", "-off", "off.mtz", "--adaptive"] + options
+    args = dw_extrapolator.parse_arguments().parse_args(argv)
+    with pytest.raises(ValueError):
+        dw_extrapolator.build_tables(args, [(0.9, 0.2)])
+
+
+@pytest.mark.parametrize("model", ["SF", "I"])
+@pytest.mark.parametrize("case", ["ac", "c"])
+def test_loglik_gradient(model, case):
+    """Reparameterization gradients should match central differences of the fixed-sample
+    log-likelihood"""
+    rng = np.random.default_rng(0)
+    raw_Z_ac = rng.standard_normal((5000, 4))
+    raw_Z_c = rng.standard_normal((5000, 2))
+    cols = _reflections(model)
+
+    def loglik(r, p):
+        table = sample_table(raw_Z_ac, raw_Z_c, r, p, dtype=np.float64, gradient=True)
+        return estimate_reflections(table, case, cols, model, moments=False)
+
+    r, p, h = 0.9, 0.2, 1e-6
+    results = loglik(r, p)
+    dr = (loglik(r + h, p)["loglik"] - loglik(r - h, p)["loglik"]) / (2 * h)
+    dp = (loglik(r, p + h)["loglik"] - loglik(r, p - h)["loglik"]) / (2 * h)
+    assert np.allclose(results["dloglik_dr"], dr, rtol=1e-5, atol=1e-5)
+    assert np.allclose(results["dloglik_dp"], dp, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("model", ["SF", "I"])
+@pytest.mark.parametrize("case", ["ac", "c"])
+@pytest.mark.parametrize("binned", [False, True])
+def test_fused_kernel(model, case, binned):
+    """The fused kernel should reproduce the tiled NumPy estimates, including gradients
+    and binned tables"""
+    rng = np.random.default_rng(0)
+    raw_Z_ac = rng.standard_normal((2000, 4))
+    raw_Z_c = rng.standard_normal((2000, 2))
+    table = sample_table(
+        raw_Z_ac, raw_Z_c, r=0.9, p=0.2, dtype=np.float64, gradient=True
+    )
+    if binned:
+        table = histogram_table(table, nbins=32)
+    cols = _reflections(model)
+    expected = estimate_reflections(table, case, cols, model, fused=False)
+    results = estimate_reflections(table, case, cols, model, fused=True)
+    assert results.keys() == expected.keys()
+    for key in expected:
+        assert np.allclose(
+            results[key], expected[key], rtol=1e-9, atol=1e-12, equal_nan=True
+        )
+
+
+def test_fused_without_numba(monkeypatch):
+    """Without Numba an explicit fused evaluation should warn and fall back to the tiled
+    NumPy evaluation"""
+    monkeypatch.setattr(dw_common, "numba", None)
+    rng = np.random.default_rng(0)
+    table = sample_table(
+        rng.standard_normal((2000, 4)), rng.standard_normal((2000, 2)), r=0.9, p=0.2
+    )
+    cols = _reflections("SF")
+    expected = estimate_reflections(table, "ac", cols, "SF")
+    with pytest.warns(RuntimeWarning, match="Numba"):
+        results = estimate_reflections(table, "ac", cols, "SF", fused=True)
+    with pytest.warns(RuntimeWarning, match="Numba"):
+        direct = fused_reflections(table, "ac", cols, "SF")
+    for key in expected:
+        assert np.array_equal(results[key], expected[key], equal_nan=True)
+        assert np.array_equal(direct[key], expected[key], equal_nan=True)
+
+
+@pytest.mark.parametrize("model", ["SF", "I"])
+@pytest.mark.parametrize("case", ["ac", "c"])
+def test_posterior_quantiles(model, case):
+    """Quantiles from a table sorted by ES_abs should match weighted quantiles of the
+    unsorted samples"""
+    rng = np.random.default_rng(0)
+    raw_Z_ac = rng.standard_normal((4000, 4))
+    raw_Z_c = rng.standard_normal((4000, 2))
+    table = sample_table(raw_Z_ac, raw_Z_c, r=0.9, p=0.2, dtype=np.float64)
+    sorted_table = sample_table(
+        raw_Z_ac, raw_Z_c, r=0.9, p=0.2, dtype=np.float64, sort_es=True
+    )
+    cols = _simulated_reflections(model, case, 0.9, 0.2, 8, 2)
+
+    logw = reflection_logweights(table, case, cols, model)
+    w = np.exp(logw - logw.max(axis=1, keepdims=True))
+    w *= w > 1e-10
+    order = np.argsort(table["ES_abs_" + case], kind="stable")
+    cum_w = np.cumsum(w[:, order], axis=1)
+    es = table["ES_abs_" + case][order]
+    expected = estimate_reflections(table, case, cols, model, fused=False)
+    for fused, tile_bytes in (
+        (True, 64 * 2**20),
+        (False, 64 * 2**20),
+        (False, 8 * 1000),
+    ):
+        results = estimate_reflections(
+            sorted_table,
+            case,
+            cols,
+            model,
+            fused=fused,
+            tile_bytes=tile_bytes,
+            quantiles=True,
+        )
+        for key in expected:
+            assert np.allclose(results[key], expected[key], rtol=1e-9)
+        for key, q in ES_QUANTILES.items():
+            idx = [np.searchsorted(c, q * c[-1]) for c in cum_w]
+            assert np.allclose(results[key], cols["sqrt_eps"] * es[idx], rtol=1e-12)
+
+    with pytest.raises(ValueError):
+        estimate_reflections(table, case, cols, model, quantiles=True)
+    with pytest.raises(ValueError):
+        estimate_reflections(
+            sorted_table, case, cols, model, quantiles=True, replicates=2
+        )
+
+
+def test_antithetic_samples():
+    """Antithetic partners should follow their draws and negate only the ES
+    innovation"""
+    rng = np.random.default_rng(0)
+    raw_Z_ac, raw_Z_c = rng.standard_normal((10, 4)), rng.standard_normal((10, 2))
+    paired_ac, paired_c = antithetic_samples(raw_Z_ac, raw_Z_c)
+    assert paired_ac.shape == (20, 4) and paired_c.shape == (20, 2)
+    assert np.array_equal(paired_ac[0::2], raw_Z_ac) and np.array_equal(
+        paired_c[0::2], raw_Z_c
+    )
+    assert np.array_equal(paired_ac[1::2], raw_Z_ac * [1, 1, -1, -1])
+    assert np.array_equal(paired_c[1::2], raw_Z_c * [1, -1])
+
+    table = sample_table(paired_ac, paired_c, r=0.9, p=0.2, dtype=np.float64)
+    for case in ("ac", "c"):
+        assert np.allclose(table["OF_abs_" + case][0::2], table["OF_abs_" + case][1::2])
+
+
+@pytest.mark.parametrize("model", ["SF", "I"])
+@pytest.mark.parametrize("case", ["ac", "c"])
+@pytest.mark.parametrize(
+    "antithetic,control_variates", [(True, False), (False, True), (True, True)]
+)
+def test_variance_reduced_reflections(model, case, antithetic, control_variates):
+    """Variance-reduced estimates should agree with quadrature to within their standard
+    errors"""
+    r, p = 0.9, 0.2
+    cols = _simulated_reflections(model, case, r, p, n=20, seed=4)
+    expected = estimate_reflections(quadrature_table(r, p), case, cols, model)
+    rng = np.random.default_rng(5)
+    raw_Z_ac, raw_Z_c = rng.standard_normal((4000, 4)), rng.standard_normal((4000, 2))
+    if antithetic:
+        raw_Z_ac, raw_Z_c = antithetic_samples(raw_Z_ac[:2000], raw_Z_c[:2000])
+    table = sample_table(
+        raw_Z_ac, raw_Z_c, r, p, dtype=np.float64, gradient=True, analytic_k=True
+    )
+    options = {"antithetic": antithetic, "control_variates": control_variates}
+    results = estimate_reflections(
+        table, case, cols, model, tile_bytes=2**16, **options
+    )
+    for key in ("loglik", "ES"):
+        se = results["SE_" + key]
+        assert np.all(se > 0)
+        assert np.all(np.abs(results[key] - expected[key]) < 5 * se + 1e-6)
+
+    # Everything but the likelihood is the plain estimate over all samples
+    plain = estimate_reflections(table, case, cols, model, fused=False)
+    for key in ("ES", "SIGES", "dloglik_dr", "dloglik_dp"):
+        assert np.allclose(results[key], plain[key], rtol=1e-9)
+    if not control_variates:
+        assert np.allclose(results["loglik"], plain["loglik"], rtol=1e-12)
+    with pytest.raises(ValueError):
+        estimate_reflections(table, case, cols, model, replicates=2, **options)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        ["--antithetic", "--sampler", "sobol", "--qmc-replicates", "4"],
+        ["--control-variates", "--sampler", "sobol", "--qmc-replicates", "4"],
+        ["--antithetic", "--engine", "histogram"],
+        ["--control-variates", "--adaptive"],
+    ],
+)
+def test_variance_reduction_options(options):
+    """Antithetic pairs and control variates should be rejected with estimates that
+    would drop their standard errors"""
+    argv = ["-on", "on.mtz", "-off", "off.mtz"] + options
+    args = dw_extrapolator.parse_arguments().parse_args(argv)
+    with pytest.raises(ValueError):
+        dw_extrapolator.build_tables(args, [(0.9, 0.2)])
+
+
+def test_stratified_minibatch():
+    """Minibatches should sample every stratum and give an unbiased estimate of the
+    mean"""
+    rng = np.random.default_rng(0)
+    strata = rng.integers(0, 20, 5000)
+    values = strata + rng.normal(size=5000)
+    groups = [np.flatnonzero(strata == label) for label in np.unique(strata)]
+    indices, weights = stratified_minibatch(rng, groups, 5000, 300)
+    assert len(np.unique(indices)) == len(indices)
+    assert np.array_equal(np.unique(strata[indices]), np.arange(20))
+    assert np.isclose(weights.sum(), 1)
+
+    estimates = []
+    for _ in range(200):
+        indices, weights = stratified_minibatch(rng, groups, 5000, 300)
+        estimates.append(weights.dot(values[indices]))
+    assert np.isclose(
+        np.mean(estimates), values.mean(), atol=3 * np.std(estimates) / np.sqrt(200)
+    )
+
+    indices, weights = stratified_minibatch(rng, groups, 5000, 10000)
+    assert np.array_equal(indices, np.arange(5000)) and np.allclose(weights, 1 / 5000)
+
+
+def test_bayes_minimize():
+    """Bayesian optimization should respect the budget, batch its proposals and find a
+    smooth minimum"""
+    rounds = []
+
+    def batch(thetas):
+        rounds.append(len(thetas))
+        return [1e3 * ((r - 0.7) ** 2 + 4 * (p - 0.2) ** 2) for r, p in thetas]
+
+    args = argparse.Namespace(seed=0, bo_init=8, bo_budget=24, bo_batch=4)
+    theta, history = bayes_minimize(
+        batch, np.array([0.9, 0.125]), [(1e-6, 1 - 1e-6)] * 2, args
+    )
+    assert rounds == [8, 4, 4, 4, 4]
+    assert history[-1]["nevals"] == 24
+    assert np.allclose(theta, [0.7, 0.2], atol=0.05)
+
+
+def test_profile_interval():
+    """Likelihood-ratio intervals of a quadratic profile should be exact and open at the
+    grid edges"""
+    values = np.linspace(0, 1, 101)
+    profile = 0.5 * ((values - 0.4) / 0.05) ** 2
+    lower, upper = profile_interval(values, profile, 1.92)
+    halfwidth = 0.05 * np.sqrt(2 * 1.92)
+    assert np.isclose(lower, 0.4 - halfwidth, atol=1e-3)
+    assert np.isclose(upper, 0.4 + halfwidth, atol=1e-3)
+
+    lower, upper = profile_interval(values[:40], profile[:40], 1.92)
+    assert np.isclose(lower, 0.4 - halfwidth, atol=1e-3) and np.isnan(upper)
+
+
+def test_write_grid(tmp_path):
+    """The grid summary should locate the minimum of a quadratic surface, skip NaN cells
+    and give its 95% likelihood-ratio intervals"""
+    r_values, p_values = np.linspace(0.5, 1, 51), np.linspace(0, 0.5, 51)
+    R, P = np.meshgrid(r_values, p_values, indexing="ij")
+    nll = 0.5 * ((R - 0.8) / 0.05) ** 2 + 0.5 * ((P - 0.2) / 0.04) ** 2
+    nll[0, 0] = np.nan
+    result = write_grid(str(tmp_path / "grid"), r_values, p_values, nll)
+    assert np.isclose(result["r"], 0.8) and np.isclose(result["p"], 0.2)
+    halfwidth = np.sqrt(2 * 1.92) * np.array([-1, 1])
+    assert np.allclose(result["ci_r"], 0.8 + 0.05 * halfwidth, atol=1e-3)
+    assert np.allclose(result["ci_p"], 0.2 + 0.04 * halfwidth, atol=1e-3)
+
+    grid = np.load(tmp_path / "grid.npz")
+    assert np.array_equal(grid["nll"], nll, equal_nan=True)
+    assert np.allclose(grid["p_at_profile_r"], 0.2)
+    assert np.allclose(grid["r_at_profile_p"], 0.8)
+    surface = np.loadtxt(tmp_path / "grid.csv", delimiter=",", skiprows=1)
+    assert surface.shape == (51 * 51, 4)
+    assert np.allclose(surface[1:, 3], nll.ravel()[1:] - result["fun"], atol=1e-6)
+
+
+def test_split_reflections():
+    """Parts should partition the reflections with balanced acentric and centric
+    counts"""
+    centric = np.random.default_rng(0).random(103) < 0.2
+    parts = split_reflections(centric, 4)
+    assert len(parts) == 4
+    assert np.array_equal(np.sort(np.concatenate(parts)), np.arange(103))
+    for mask in (~centric, centric):
+        counts = [np.count_nonzero(mask[idx]) for idx in parts]
+        assert max(counts) - min(counts) <= 1
+    assert all(np.all(np.diff(idx) > 0) for idx in parts)
+
+
+def test_sample_bank(tmp_path):
+    """Bank entries should be built once, memory-mapped read-only and shared with
+    workers by path"""
+    calls = []
+
+    def build():
+        calls.append(1)
+        rng = np.random.default_rng(0)
+        return {
+            "raw_Z_ac": rng.standard_normal((100, 4)),
+            "raw_Z_c": rng.standard_normal((100, 2)),
+        }
+
+    key = {"kind": "normal", "seed": 0, "ndraws": 100}
+    arrays = sample_bank(tmp_path, key, build)
+    again = sample_bank(tmp_path, dict(key), build)
+    assert len(calls) == 1
+    expected = build()
+    for name in expected:
+        assert np.array_equal(arrays[name], expected[name]) and np.array_equal(
+            again[name], expected[name]
+        )
+        assert isinstance(arrays[name], np.memmap) and not arrays[name].flags.writeable
+    sample_bank(tmp_path, dict(key, seed=1), build)
+    assert len(calls) == 3
+
+    handles, specs = create_shared_arrays(dict(arrays, order=np.arange(3)))
+    try:
+        assert len(handles) == 1 and specs["raw_Z_ac"][0].endswith("raw_Z_ac.npy")
+        _, attached = attach_shared_arrays(specs)
+        assert np.array_equal(attached["raw_Z_c"], expected["raw_Z_c"])
+    finally:
+        for shm in handles:
+            shm.close()
+            shm.unlink()
+
+
+def test_checkpoint(tmp_path):
+    """A resumed checkpoint should hold finished reflections and only list missing, new
+    or changed ones"""
+    rng = np.random.default_rng(0)
+    hkl = rng.integers(-20, 20, (10, 3)).astype(np.int32)
+    hkl[:, 0] = np.arange(10)
+    inputs = rng.normal(size=(10, 2))
+    keys = ("ES", "loglik")
+    params = {"nsamples": 100}
+    checkpoint = Checkpoint(tmp_path, params, hkl[:6], inputs[:6], keys, 2)
+    assert np.array_equal(checkpoint.todo, np.arange(6))
+    values = {key: rng.normal(size=(2, 4)) for key in keys}
+    checkpoint.store(np.arange(4), values)
+    del checkpoint
+
+    with pytest.raises(ValueError):
+        Checkpoint(tmp_path, params, hkl, inputs, keys, 2)
+    with pytest.raises(ValueError):
+        Checkpoint(tmp_path, {"nsamples": 200}, hkl, inputs, keys, 2, resume=True)
+
+    # Reordered, with new reflections and a changed measurement
+    order = rng.permutation(10)
+    changed = inputs.copy()
+    changed[1, 0] += 1
+    checkpoint = Checkpoint(
+        tmp_path, params, hkl[order], changed[order], keys, 2, resume=True
+    )
+    assert np.array_equal(np.sort(order[checkpoint.todo]), [1, 4, 5, 6, 7, 8, 9])
+    results = checkpoint.results()
+    for i in range(2):
+        for key in keys:
+            kept = np.isin(order, [0, 2, 3])
+            assert np.array_equal(results[i][key][kept], values[key][i, order[kept]])
+            assert np.all(np.isnan(results[i][key][np.isin(order, np.arange(4, 10))]))
+
+
+def test_series_segments():
+    """Segments should cover a series sorted by dataset and centricity, and p should be
+    given once or per ON"""
+    groups = np.array([0, 0, 0, 1, 1, 2])
+    centric = np.array([False, True, True, False, False, True])
+    assert _segments(groups, centric) == [
+        (0, "ac", 0, 1),
+        (0, "c", 1, 3),
+        (1, "ac", 3, 5),
+        (2, "c", 5, 6),
+    ]
+
+    args = argparse.Namespace(onmtz=["a.mtz", "b.mtz"], factor=None, es_fraction=[0.2])
+    assert _es_fractions(args) == [0.2, 0.2]
+    args.factor, args.es_fraction = [4.0, 5.0], None
+    assert _es_fractions(args) == [0.25, 0.2]
+    args.factor = [4.0, 5.0, 8.0]
+    with pytest.raises(ValueError):
+        _es_fractions(args)
+
+
+def test_plan_execution():
+    """Plans should respect the budget and worker cap, and reject budgets that fit no
+    worker"""
+    plan = plan_execution(1e6, 100, 10, 1_000_000, nproc=3, tile_mb=64)
+    assert plan["nproc"] == 3 and plan["tile_mb"] == 64 and plan["threads"] >= 1
+
+    budget = 100 + 2 * (WORKER_BASE_MB + 10 + TILE_TEMPORARIES * 20)
+    plan = plan_execution(budget, 100, 10, 1_000_000, nproc=8, tile_mb=64)
+    assert plan["nproc"] == 2
+    assert 7.6 <= plan["tile_mb"] <= 20
+    assert plan["estimated_mb"] <= budget + 1e-9
+
+    with pytest.raises(ValueError):
+        plan_execution(100 + WORKER_BASE_MB, 100, 10, 1_000_000)
+
+
+def test_limit_worker_threads(monkeypatch):
+    """The thread cap should reach workers spawned inside the block and leave the parent
+    environment as it was"""
+    monkeypatch.setenv("OMP_NUM_THREADS", "7")
+    monkeypatch.delenv("MKL_NUM_THREADS", raising=False)
+    with limit_worker_threads(2):
+        pool = mp.get_context("spawn").Pool(1)
+    with pool:
+        assert pool.map(os.getenv, THREAD_ENV_VARS) == ["2"] * len(THREAD_ENV_VARS)
+    assert os.environ["OMP_NUM_THREADS"] == "7" and "MKL_NUM_THREADS" not in os.environ
+    with limit_worker_threads(None):
+        assert os.environ["OMP_NUM_THREADS"] == "7"
+
+
+@pytest.mark.parametrize("model", ["SF", "I"])
+@pytest.mark.parametrize("case", ["ac", "c"])
+def test_histogram_engine(table, model, case):
+    """Binned samples should reproduce the Monte Carlo estimates within the documented
+    error bound"""
+    binned = histogram_table(table, nbins=128)
+    assert binned["count_" + case].sum() == len(table["OF_abs_" + case])
+
+    cols = _reflections(model)
+    expected = estimate_reflections(table, case, cols, model)
+    results = estimate_reflections(binned, case, cols, model)
+    ratio = histogram_resolution(binned, case, cols, model)
+    bound = 9 * ratio**2 / 24
+    assert np.all(np.abs(results["loglik"] - expected["loglik"]) <= 2 * bound + 1e-3)
+    assert np.all(np.abs(results["ES"] / expected["ES"] - 1) <= 2 * bound + 1e-3)
+
+
+def _midpoint_loglik(cols, model, case, r, p, i):
+    """Marginal log-likelihood of reflection i by the midpoint rule over (|GS|, |ON|)"""
+    a, b = (1 - p) + p * r, p * np.sqrt(1 - r**2)
+    k = np.hypot(a, b)
+    step = 7 / 2000
+    A = step * (np.arange(2000)[:, None] + 0.5)
+    B = step * (np.arange(2000)[None, :] + 0.5)
+    if case == "ac":
+        s2 = b**2 / 2
+        logp = np.log(2 * A) - A**2 + np.log(B / s2) - (B - a * A) ** 2 / (2 * s2)
+        logp += np.log(special.i0e(a * A * B / s2))
+    else:
+        logp = norm.logpdf(A) + np.log(2)
+        logp = logp + np.logaddexp(norm.logpdf(B, a * A, b), norm.logpdf(B, -a * A, b))
+    c = {key: value[i] for key, value in cols.items()}
+    if model == "SF":
+        for state, x in (("off", A), ("on", B / k)):
+            loc, scale = c["loc_" + state], c["scale_" + state]
+            F = c["sqrt_eps"] * c["sqrt_Sig_" + state] * x
+            logp = logp + truncnorm.logpdf(
+                F, (c["low_" + state] - loc) / scale, np.inf, loc, scale
+            )
+    else:
+        for state, x in (("off", A), ("on", B / k)):
+            loc = c["sqrt_eps"] ** 2 * c["Sigma_" + state] * x**2
+            logp = logp + norm.logpdf(c["I_" + state], loc, c["SigI_" + state])
+    m = logp.max()
+    return m + np.log(np.exp(logp - m).sum() * step**2)
+
+
+def _simulated_reflections(model, case, r, p, n, seed, rng=None):
+    """Reflection columns of ``_reflections`` with observations simulated from the DW
+    model."""
+    rng = np.random.default_rng(seed) if rng is None else rng
+    truth = sample_table(
+        rng.standard_normal((n, 4)), rng.standard_normal((n, 2)), r, p, dtype=np.float64
+    )
+    cols = _reflections(model, n=n, seed=seed)
+    for state, x in (("off", truth["OF_abs_" + case]), ("on", truth["ON_abs_" + case])):
+        F = cols["sqrt_Sig_" + state] * x
+        if model == "SF":
+            cols["loc_" + state] = F + cols["scale_" + state] * rng.standard_normal(n)
+        else:
+            cols["I_" + state] = F**2 + cols["SigI_" + state] * rng.standard_normal(n)
+    return cols
+
+
+@pytest.mark.parametrize("model", ["SF", "I"])
+@pytest.mark.parametrize("case", ["ac", "c"])
+def test_quadrature_engine(model, case):
+    """Quadrature should reproduce the marginal likelihood and agree with Monte Carlo on
+    simulated data"""
+    r, p = 0.9, 0.2
+    rng = np.random.default_rng(2)
+    cols = _simulated_reflections(model, case, r, p, n=5, seed=3, rng=rng)
+    results = estimate_reflections(quadrature_table(r, p), case, cols, model)
+    for i in range(5):
+        assert np.isclose(
+            results["loglik"][i],
+            _midpoint_loglik(cols, model, case, r, p, i),
+            atol=1e-4,
+        )
+
+    raw_Z_ac = rng.standard_normal((200_000, 4)).astype(np.float32)
+    raw_Z_c = rng.standard_normal((200_000, 2)).astype(np.float32)
+    expected = estimate_reflections(
+        sample_table(raw_Z_ac, raw_Z_c, r, p), case, cols, model
+    )
+    assert np.allclose(results["ES"], expected["ES"], rtol=3e-2)
+    assert np.allclose(results["SIGES"], expected["SIGES"], rtol=1e-1)
+
+    # Converged in the number of nodes
+    finer = estimate_reflections(
+        quadrature_table(r, p, nodes=96, theta_nodes=32), case, cols, model
+    )
+    assert np.allclose(results["loglik"], finer["loglik"], atol=1e-6)
+    assert np.allclose(results["ES"], finer["ES"], rtol=1e-4)
+
+
+def test_truncnorm_params_from_moments():
+    """Vectorized method of moments should reproduce the requested moments and the
+    root-finding solver"""
+    rng = np.random.default_rng(0)
+    F = rng.uniform(0.01, 1000, 200)
+    SigF = F / rng.uniform(1.05, 50, 200)
+    loc, scale, converged = truncnorm_params_from_moments(F, SigF, tol=1e-10)
+    assert converged.all()
+
+    rv = truncnorm(-loc / scale, np.inf, loc=loc, scale=scale)
+    assert np.allclose(rv.mean(), F, rtol=1e-8)
+    assert np.allclose(rv.std(), SigF, rtol=1e-8)
+
+    # Compare against scipy.optimize.root where it is well conditioned
+    for i in np.flatnonzero(F / SigF > 1.5)[:20]:
+        m, s = F[i], SigF[i]
+        sol = optimize.root(equations, x0=[-m / s, (1e10 - m) / s], args=(m, s))
+        alpha, beta = sol.x
+        sigma = np.abs((1e-32 - 1e10) / (alpha - beta))
+        assert np.isclose(scale[i], sigma, rtol=1e-6)
+        assert np.isclose(loc[i], 1e-32 - sigma * alpha, rtol=1e-6, atol=1e-6 * s)
+
+
+def test_truncnorm_params_from_moments_no_solution():
+    """A mean/std ratio <= 1 has no solution; the mean should still be matched"""
+    loc, scale, converged = truncnorm_params_from_moments(
+        np.array([1.0]), np.array([1.2])
+    )
+    assert not converged[0]
+    rv = truncnorm(-loc / scale, np.inf, loc=loc, scale=scale)
+    assert np.isclose(rv.mean()[0], 1.0, rtol=1e-6)
+
+
+def _write_mtz(path, seed):
+    """Synthetic French-Wilson |F| of about 400 reflections to 4.5 A"""
+    cell = gemmi.UnitCell(30, 40, 50, 90, 90, 90)
+    spacegroup = gemmi.SpaceGroup(19)
+    hkl = rs.utils.generate_reciprocal_asu(cell, spacegroup, 4.5, anomalous=False)
+    F = 1.0 + np.random.default_rng(seed).rayleigh(10.0, len(hkl))
+    ds = rs.DataSet(
+        {
+            "H": hkl[:, 0],
+            "K": hkl[:, 1],
+            "L": hkl[:, 2],
+            "F": F,
+            "SigF": 0.5 + 0.05 * F,
+        },
+        cell=cell,
+        spacegroup=spacegroup,
+    ).set_index(["H", "K", "L"])
+    ds = ds.infer_mtz_dtypes()
+    ds["F"] = ds["F"].astype("F")
+    ds["SigF"] = ds["SigF"].astype("Q")
+    ds.write_mtz(str(path))
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def mtz_files(tmp_path_factory):
+    path = tmp_path_factory.mktemp("mtz")
+    return {
+        name: _write_mtz(path / f"{name}.mtz", seed)
+        for seed, name in enumerate(["off", "on", "on2"])
+    }
+
+
+def _run(main, monkeypatch, argv):
+    monkeypatch.setattr(sys, "argv", ["rs.test"] + [str(arg) for arg in argv])
+    return main()
+
+
+# Output columns of rs.dw_extrapolate and the estimates they hold
+DW_COLUMNS = {
+    "ES_abs_2": "ES",
+    "SIGES_abs_2": "SIGES",
+    "FS_abs_2": "FS",
+    "SIGFS_abs_2": "SIGFS",
+}
+
+
+def _dw_argv(mtz_files, out, *options):
+    """rs.dw_extrapolate arguments for the test data with 1024 samples"""
+    argv = ["-on", mtz_files["on"], "-off", mtz_files["off"], "-n", 1024]
+    argv += ["--nproc", 2, "--block-size", 64, "--disable-progress-bar", "-o", out]
+    return argv + list(options)
+
+
+def _dw_table(r=0.9, p=0.125, nsamples=1024, seed=28, **options):
+    """Sample table of the seeded pseudo-random draws of rs.dw_extrapolate"""
+    rng = np.random.default_rng(seed)
+    raw_Z_ac = rng.standard_normal((nsamples, 4)).astype(np.float32)
+    raw_Z_c = rng.standard_normal((nsamples, 2)).astype(np.float32)
+    return sample_table(raw_Z_ac, raw_Z_c, r, p, **options)
+
+
+def _dw_reference(mtz_files, table, **options):
+    """Estimates for every reflection of the test data against ``table``, computed in
+    process"""
+    ds_all, model, cols = dw_common.prepare_reflections(
+        mtz_files["on"], mtz_files["off"]
+    )
+    centric = ds_all.CENTRIC.to_numpy(bool)
+    results = {}
+    for case, mask in (("ac", ~centric), ("c", centric)):
+        block = {key: value[mask] for key, value in cols.items()}
+        estimates = estimate_reflections(table, case, block, model, **options)
+        for key, value in estimates.items():
+            results.setdefault(key, np.full(len(ds_all), np.nan))[mask] = value
+    return ds_all, results
+
+
+def _assert_matches(path, ds_all, results, columns=DW_COLUMNS, rtol=1e-5):
+    """The columns of the MTZ at ``path`` should hold ``results`` of its reflections"""
+    ds = rs.read_mtz(str(path))
+    rows = ds_all.index.get_indexer(ds.index)
+    assert len(ds) > 0.9 * len(ds_all) and np.all(rows >= 0)
+    for col, key in columns.items():
+        assert np.allclose(
+            ds[col].to_numpy(np.float64), results[key][rows], rtol=rtol, atol=1e-6
+        )
+    return ds
+
+
+def test_dw_extrapolate_reference(mtz_files, tmp_path, monkeypatch, capsys):
+    """rs.dw_extrapolate should write the estimates against one sample table built from
+    the seeded draws, and report their NLL"""
+    out = tmp_path / "esf.mtz"
+    _run(dw_extrapolator.main, monkeypatch, _dw_argv(mtz_files, out))
+    ds_all, expected = _dw_reference(mtz_files, _dw_table())
+    ds = _assert_matches(out, ds_all, expected)
+    assert list(ds.columns) == [*DW_COLUMNS, "CENTRIC"]
+    nll = float(capsys.readouterr().out.split("NLL = ")[-1])
+    assert np.isclose(nll, -np.sum(expected["loglik"]), rtol=1e-6)
+
+
+def test_dw_extrapolate_histogram(mtz_files, tmp_path, monkeypatch, capsys):
+    """--engine histogram should write the estimates against the binned sample table and
+    report the bin widths"""
+    out = tmp_path / "esf.mtz"
+    argv = _dw_argv(mtz_files, out, "--engine", "histogram", "--nbins", 64)
+    _run(dw_extrapolator.main, monkeypatch, argv)
+    ds_all, expected = _dw_reference(mtz_files, histogram_table(_dw_table(), nbins=64))
+    _assert_matches(out, ds_all, expected)
+    assert "Histogram engine: " in capsys.readouterr().out
+
+
+@pytest.mark.parametrize(
+    "scan", [["--scan_p", 0.1, 0.2], ["--scan_r", 0.8, 0.9, "--scan_p", 0.2]]
+)
+def test_dw_extrapolate_scan(mtz_files, tmp_path, monkeypatch, scan):
+    """A scan should write the estimates and the NLL of every (r, p) against the sample
+    tables of one set of draws"""
+    out = tmp_path / "esf.mtz"
+    _run(dw_extrapolator.main, monkeypatch, _dw_argv(mtz_files, out, *scan))
+    rows = np.loadtxt(tmp_path / "esf_scan.csv", delimiter=",", skiprows=1, ndmin=2)
+    suffix = "_r{r:.2f}_p{p:.2f}" if "--scan_r" in scan else "_p{p:.2f}"
+    assert len(rows) == 2
+    for r, p, nll in rows:
+        ds_all, expected = _dw_reference(mtz_files, _dw_table(r, p))
+        outfile = tmp_path / f"esf{suffix.format(r=r, p=p)}.mtz"
+        _assert_matches(outfile, ds_all, expected)
+        assert np.isclose(nll, -np.sum(expected["loglik"]), rtol=1e-6)
+
+
+@pytest.mark.parametrize(
+    "options,message",
+    [
+        (["--scan_p", 0.1, "-p", 0.2], "--scan_p cannot be used with --es-fraction"),
+        (["--default_scan", "-f", 4], "--default_scan cannot be used with --factor"),
+    ],
+)
+def test_dw_extrapolate_scan_options(
+    mtz_files, tmp_path, monkeypatch, capsys, options, message
+):
+    """Scans should refuse a fixed excited state fraction and name the flags"""
+    argv = _dw_argv(mtz_files, tmp_path / "esf.mtz", *options)
+    with pytest.raises(SystemExit):
+        _run(dw_extrapolator.main, monkeypatch, argv)
+    assert message in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("nproc,block_size", [(1, 1000), (3, 17)])
+def test_dw_run(mtz_files, tmp_path, nproc, block_size):
+    """run_dw should fill the outputs of every table from shared memory, independent of
+    the blocks and workers, and report every block once"""
+    argv = _dw_argv(mtz_files, tmp_path / "esf.mtz", "--nproc", nproc)
+    args = dw_extrapolator.parse_arguments().parse_args([str(arg) for arg in argv])
+    args.block_size = block_size
+    (ds_all,), model, cols, _ = dw_extrapolator.prepare_data(args)
+    centric = ds_all.CENTRIC.to_numpy(bool)
+    rp_values = [(0.9, 0.125), (0.8, 0.3)]
+    tables, replicates = dw_extrapolator.build_tables(args, rp_values)
+    seen = []
+    results = dw_extrapolator.run_dw(
+        args,
+        model,
+        cols,
+        centric,
+        tables,
+        replicates,
+        on_block=lambda idx, outputs: seen.extend(idx),
+    )
+    assert sorted(seen) == list(range(len(ds_all)))
+    _, output_keys = dw_extrapolator._estimate_options(args, replicates)
+    for (r, p), result in zip(rp_values, results):
+        assert tuple(result) == output_keys
+        _, expected = _dw_reference(mtz_files, _dw_table(r, p))
+        for key in output_keys:
+            assert np.allclose(
+                result[key], expected[key], rtol=1e-5, atol=1e-6, equal_nan=True
+            )
+
+
+def test_dw_run_releases_shared_memory(mtz_files, tmp_path, monkeypatch):
+    """A failing worker should propagate its error and leave no shared memory behind"""
+    argv = _dw_argv(mtz_files, tmp_path / "esf.mtz")
+    args = dw_extrapolator.parse_arguments().parse_args([str(arg) for arg in argv])
+    (ds_all,), model, cols, _ = dw_extrapolator.prepare_data(args)
+    tables, _ = dw_extrapolator.build_tables(args, [(0.9, 0.125)])
+    created = []
+
+    def recording_create_shared_arrays(arrays):
+        handles, specs = create_shared_arrays(arrays)
+        created.extend(shm.name for shm in handles)
+        return handles, specs
+
+    monkeypatch.setattr(
+        dw_extrapolator, "create_shared_arrays", recording_create_shared_arrays
+    )
+    missing = dict(list(cols.items())[1:])
+    with pytest.raises(KeyError):
+        dw_extrapolator.run_dw(
+            args, model, missing, ds_all.CENTRIC.to_numpy(bool), tables
+        )
+    assert created
+    for name in created:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+def test_dw_extrapolate_sobol(mtz_files, tmp_path, monkeypatch):
+    """--sampler sobol should write the estimates against the scrambled Sobol table and
+    the standard error of ES over the replicates"""
+    out = tmp_path / "esf.mtz"
+    options = ["--sampler", "sobol", "--qmc-replicates", 2]
+    _run(dw_extrapolator.main, monkeypatch, _dw_argv(mtz_files, out, *options))
+    raw_Z_ac, raw_Z_c = sobol_normal_samples(1024, seed=28, replicates=2)
+    table = sample_table(raw_Z_ac, raw_Z_c, 0.9, 0.125)
+    ds_all, expected = _dw_reference(mtz_files, table, replicates=2)
+    columns = dict(DW_COLUMNS, SE_ES_abs_2="SE_ES")
+    ds = _assert_matches(out, ds_all, expected, columns=columns)
+    assert np.all(ds["SE_ES_abs_2"].to_numpy(float) >= 0)
+
+
+def test_dw_extrapolate_quadrature(mtz_files, tmp_path, monkeypatch):
+    """--engine quadrature should write the estimates of the quadrature rules, whatever
+    the seed"""
+    ds_all, expected = _dw_reference(mtz_files, quadrature_table(0.9, 0.125, nodes=16))
+    for seed in (28, 5):
+        out = tmp_path / f"esf_{seed}.mtz"
+        options = ["--engine", "quadrature", "--nodes", 16, "--seed", seed]
+        _run(dw_extrapolator.main, monkeypatch, _dw_argv(mtz_files, out, *options))
+        _assert_matches(out, ds_all, expected)
+
+
+def test_dw_extrapolate_adaptive(mtz_files, tmp_path, monkeypatch):
+    """--adaptive should write the estimates of the per-reflection sample budgets with
+    their effective sample sizes"""
+    out = tmp_path / "esf.mtz"
+    options = ["--adaptive", "--min-samples", 256]
+    _run(dw_extrapolator.main, monkeypatch, _dw_argv(mtz_files, out, *options))
+    ds_all, expected = _dw_reference(
+        mtz_files, _dw_table(), min_samples=256, ess_target=1000
+    )
+    columns = dict(DW_COLUMNS, ESS="ESS", NSAMPLES="NSAMPLES")
+    ds = _assert_matches(out, ds_all, expected, columns=columns)
+    nsamples = ds["NSAMPLES"].to_numpy(int)
+    assert np.all((nsamples >= 256) & (nsamples <= 1024))
+
+
+def test_dw_extrapolate_mpi(mtz_files, tmp_path, monkeypatch):
+    """--backend mpi on a single rank should write the outputs of --backend pool"""
+    pytest.importorskip("mpi4py")
+    for backend in ("pool", "mpi"):
+        out = tmp_path / f"{backend}.mtz"
+        argv = _dw_argv(mtz_files, out, "--backend", backend)
+        _run(dw_extrapolator.main, monkeypatch, argv)
+    pool, mpi = (rs.read_mtz(str(tmp_path / f"{b}.mtz")) for b in ("pool", "mpi"))
+    assert mpi.index.equals(pool.index)
+    for col in DW_COLUMNS:
+        assert np.allclose(mpi[col].to_numpy(float), pool[col].to_numpy(float))
+
+
+def test_dw_extrapolate_memory_budget(mtz_files, tmp_path, monkeypatch, capsys):
+    """--memory-budget should print a plan within the budget without changing the
+    estimates, and reject budgets too small for a single worker"""
+    out = tmp_path / "esf.mtz"
+    argv = _dw_argv(mtz_files, out, "--memory-budget", 4000)
+    _run(dw_extrapolator.main, monkeypatch, argv)
+    plan = capsys.readouterr().out.split("Execution plan for a 4000 MB budget: ")[1]
+    assert float(plan.split("about ")[1].split(" MB")[0]) <= 4000
+    ds_all, expected = _dw_reference(mtz_files, _dw_table())
+    _assert_matches(out, ds_all, expected)
+    argv = _dw_argv(mtz_files, out, "--memory-budget", 10)
+    with pytest.raises(ValueError, match="too small"):
+        _run(dw_extrapolator.main, monkeypatch, argv)
+
+
+def test_dw_extrapolate_variance_reduction(mtz_files, tmp_path, monkeypatch):
+    """--antithetic --control-variates should write the estimates of the antithetic
+    pairs with their standard errors"""
+    out = tmp_path / "esf.mtz"
+    argv = _dw_argv(mtz_files, out, "--antithetic", "--control-variates")
+    _run(dw_extrapolator.main, monkeypatch, argv)
+    rng = np.random.default_rng(28)
+    raw_Z_ac = rng.standard_normal((512, 4)).astype(np.float32)
+    raw_Z_c = rng.standard_normal((512, 2)).astype(np.float32)
+    raw_Z_ac, raw_Z_c = antithetic_samples(raw_Z_ac, raw_Z_c)
+    table = sample_table(raw_Z_ac, raw_Z_c, 0.9, 0.125, analytic_k=True)
+    ds_all, expected = _dw_reference(
+        mtz_files, table, antithetic=True, control_variates=True
+    )
+    columns = dict(DW_COLUMNS, SE_ES_abs_2="SE_ES", SE_LOGLIK="SE_loglik")
+    ds = _assert_matches(out, ds_all, expected, columns=columns)
+    assert np.all(ds["SE_LOGLIK"].to_numpy(float) > 0)
+
+
+def test_dw_extrapolate_sample_bank(mtz_files, tmp_path, monkeypatch):
+    """--sample-bank should store the draws and tables once and give the estimates of
+    freshly drawn samples on every run"""
+    bank = tmp_path / "bank"
+    ds_all, expected = _dw_reference(mtz_files, _dw_table())
+    entries = None
+    for run in range(2):
+        out = tmp_path / f"esf_{run}.mtz"
+        argv = _dw_argv(mtz_files, out, "--sample-bank", bank)
+        _run(dw_extrapolator.main, monkeypatch, argv)
+        _assert_matches(out, ds_all, expected)
+        stored = {path: path.stat().st_mtime_ns for path in bank.rglob("*.npy")}
+        assert entries is None or stored == entries
+        entries = stored
+    assert len(entries) > 0
+
+
+def test_dw_extrapolate_series(mtz_files, tmp_path, monkeypatch):
+    """Several ON datasets should share the OFF data and the samples and give the
+    results of separate runs, written to one MTZ per ON dataset or to the labelled
+    columns of a single MTZ"""
+    reads = []
+    tables = []
+    read_mtz = rs.read_mtz
+    build_tables = dw_extrapolator.build_tables
+
+    def counting_read_mtz(path, *args, **kwargs):
+        reads.append(path)
+        return read_mtz(path, *args, **kwargs)
+
+    def counting_build_tables(args, rp_values):
+        tables.append(rp_values)
+        return build_tables(args, rp_values)
+
+    monkeypatch.setattr(rs, "read_mtz", counting_read_mtz)
+    monkeypatch.setattr(dw_extrapolator, "build_tables", counting_build_tables)
+    argv = [
+        "-off",
+        mtz_files["off"],
+        "-n",
+        1024,
+        "--nproc",
+        2,
+        "--disable-progress-bar",
+    ]
+    series = ["-on", mtz_files["on"], mtz_files["on2"], "-p", 0.1, 0.2]
+    _run(
+        dw_extrapolator.main,
+        monkeypatch,
+        argv + series + ["-o", tmp_path / "series.mtz"],
+    )
+    assert reads.count(mtz_files["off"]) == 1 and tables == [[(0.9, 0.1), (0.9, 0.2)]]
+    _run(
+        dw_extrapolator.main,
+        monkeypatch,
+        argv + series + ["--single-mtz", "-o", tmp_path / "single.mtz"],
+    )
+    single = rs.read_mtz(str(tmp_path / "single.mtz"))
+
+    for label, p in (("on", 0.1), ("on2", 0.2)):
+        on = ["-on", mtz_files[label], "-p", p, "-o", tmp_path / f"{label}.mtz"]
+        _run(dw_extrapolator.main, monkeypatch, argv + on)
+        expected = rs.read_mtz(str(tmp_path / f"{label}.mtz"))
+        result = rs.read_mtz(str(tmp_path / f"series_{label}.mtz"))
+        assert result.index.equals(expected.index)
+        for col in ("ES_abs_2", "SIGES_abs_2", "FS_abs_2", "SIGFS_abs_2"):
+            assert np.array_equal(result[col].to_numpy(), expected[col].to_numpy())
+            merged = single[f"{col}_{label}"].dropna()
+            assert np.array_equal(
+                merged.loc[expected.index].to_numpy(), expected[col].to_numpy()
+            )
+    assert "CENTRIC" in single
+
+    assert _series_labels(["a/t1.mtz", "b/t2.mtz"]) == ["t1", "t2"]
+    assert _series_labels(["a/on.mtz", "b/on.mtz"]) == ["on1", "on2"]
+
+
+def test_dw_extrapolate_scan_series(mtz_files, tmp_path, monkeypatch, capsys):
+    """Scans should refuse several ON datasets"""
+    argv = _dw_argv(mtz_files, tmp_path / "esf.mtz", "--scan_p", 0.1)
+    argv[1:2] = [mtz_files["on"], mtz_files["on2"]]
+    with pytest.raises(SystemExit):
+        _run(dw_extrapolator.main, monkeypatch, argv)
+    assert "--scan_p takes a single ON dataset" in capsys.readouterr().err
+
+
+def test_dw_extrapolate_resume(mtz_files, tmp_path, monkeypatch):
+    """A resumed run should write exactly the output of an uninterrupted one, and a run
+    with other parameters should refuse to resume"""
+    checkpoint = tmp_path / "checkpoint"
+    argv = [
+        "-on",
+        mtz_files["on"],
+        "-off",
+        mtz_files["off"],
+        "-n",
+        1024,
+        "--nproc",
+        2,
+        "--block-size",
+        32,
+    ]
+    argv += ["--disable-progress-bar", "--checkpoint", checkpoint]
+    _run(dw_extrapolator.main, monkeypatch, argv + ["-o", tmp_path / "full.mtz"])
+    done = np.load(checkpoint / "done.npy")
+    assert done.all()
+
+    # Interrupt: every third block of 32 rows is lost
+    lost = (np.arange(len(done)) // 32) % 3 == 1
+    np.save(checkpoint / "done.npy", done & ~lost)
+    ES = np.load(checkpoint / "ES.npy")
+    ES[lost] = np.nan
+    np.save(checkpoint / "ES.npy", ES)
+    _run(
+        dw_extrapolator.main,
+        monkeypatch,
+        argv + ["--resume", "-o", tmp_path / "resumed.mtz"],
+    )
+    assert np.load(checkpoint / "done.npy").all()
+
+    _run(dw_extrapolator.main, monkeypatch, argv[:-2] + ["-o", tmp_path / "plain.mtz"])
+    full = rs.read_mtz(str(tmp_path / "full.mtz"))
+    for name in ("resumed.mtz", "plain.mtz"):
+        other = rs.read_mtz(str(tmp_path / name))
+        assert other.index.equals(full.index)
+        for col in ("ES_abs_2", "SIGES_abs_2", "FS_abs_2", "SIGFS_abs_2"):
+            assert np.array_equal(other[col].to_numpy(), full[col].to_numpy())
+
+    with pytest.raises(ValueError):
+        _run(dw_extrapolator.main, monkeypatch, argv + ["-o", tmp_path / "again.mtz"])
+    for options in (["--seed", 1], ["-n", 2048]):
+        with pytest.raises(ValueError, match="different parameters"):
+            _run(
+                dw_extrapolator.main,
+                monkeypatch,
+                argv + ["--resume", "-o", tmp_path / "other.mtz"] + options,
+            )
+
+
+def test_dw_extrapolate_quantiles(mtz_files, tmp_path, monkeypatch):
+    """--quantiles should write ordered posterior quantiles of |ES| from the sorted
+    sample table"""
+    out = tmp_path / "esf.mtz"
+    _run(dw_extrapolator.main, monkeypatch, _dw_argv(mtz_files, out, "--quantiles"))
+    table = _dw_table(sort_es=True)
+    ds_all, expected = _dw_reference(mtz_files, table, quantiles=True)
+    columns = dict(DW_COLUMNS, **{key: key for key in ES_QUANTILES})
+    ds = _assert_matches(out, ds_all, expected, columns=columns)
+    quantiles = ds[list(ES_QUANTILES)].to_numpy(float)
+    assert np.all(np.diff(quantiles, axis=1) >= 0)
+
+
+def _mle_argv(mtz_files, out, *options):
+    """rs.mle_dw_extrapolate arguments for the test data with 1024 samples"""
+    argv = ["--onmtz", mtz_files["on"], "--offmtz", mtz_files["off"], "-n", 1024]
+    argv += ["--nproc", 2, "--disable_progress_bar", "-o", out]
+    return argv + list(options)
+
+
+def _mle_fit(mtz_files, tmp_path, monkeypatch, *options):
+    """JSON results of rs.mle_dw_extrapolate on the test data"""
+    out = tmp_path / "fit.json"
+    _run(mle_dw_extrapolator.main, monkeypatch, _mle_argv(mtz_files, out, *options))
+    with open(out) as f:
+        return json.load(f)
+
+
+def _mle_draws(nsamples=1024, seed=13):
+    """Seeded standard normal draws of rs.mle_dw_extrapolate"""
+    rng = np.random.default_rng(seed)
+    raw_Z_ac = rng.standard_normal(size=(nsamples, 4), dtype=np.float32)
+    raw_Z_c = rng.standard_normal(size=(nsamples, 2), dtype=np.float32)
+    return raw_Z_ac, raw_Z_c
+
+
+def _mle_nll(mtz_files, r, p, rows=None):
+    """NLL of the reflections ``rows`` (default: all) of the test data at (r, p) for
+    the seeded draws of rs.mle_dw_extrapolate, computed in process"""
+    ds_all, model, cols = dw_common.prepare_reflections(
+        mtz_files["on"], mtz_files["off"]
+    )
+    if rows is not None:
+        ds_all = ds_all.iloc[rows]
+        cols = {key: value[rows] for key, value in cols.items()}
+    raw_Z_ac, raw_Z_c = _mle_draws()
+    table = sample_table(
+        raw_Z_ac.astype(np.float64),
+        raw_Z_c.astype(np.float64),
+        r,
+        p,
+        dtype=np.float64,
+    )
+    centric = ds_all.CENTRIC.to_numpy(bool)
+    nll = 0.0
+    for case, mask in (("ac", ~centric), ("c", centric)):
+        block = {key: value[mask] for key, value in cols.items()}
+        estimates = estimate_reflections(table, case, block, model, moments=False)
+        nll -= estimates["loglik"].sum()
+    return nll
+
+
+def test_mle_dw_extrapolate_nll(mtz_files, tmp_path, monkeypatch):
+    """Every NLL evaluated by the fit should match the sum over the reflections against
+    the sample table of its (r, p)"""
+    result = _mle_fit(mtz_files, tmp_path, monkeypatch, "--maxiter", 2)
+    assert len(result["evaluations"]) > 1
+    for evaluation in result["evaluations"]:
+        expected = _mle_nll(mtz_files, evaluation["r"], evaluation["p"])
+        assert np.isclose(evaluation["nll"], expected, rtol=1e-9)
+    assert np.isclose(result["fun"], _mle_nll(mtz_files, result["r"], result["p"]))
+
+
+@contextlib.contextmanager
+def _mle_objective(mtz_files, monkeypatch, *options):
+    """Objective of rs.mle_dw_extrapolate with a running pool for all reflections of
+    the test data"""
+    argv = _mle_argv(mtz_files, "fit.json", *options)
+    args = mle_dw_extrapolator.parse_arguments().parse_args([str(a) for a in argv])
+    args.tile_bytes = mle_dw_extrapolator.TILE_BYTES
+    args.threads = None
+    raw_Z_ac, raw_Z_c = mle_dw_extrapolator.normal_samples(args)
+    ds_all, _, cols = dw_common.prepare_reflections(args.onmtz, args.offmtz)
+    sample_handles, sample_specs = create_shared_arrays(
+        {"raw_Z_ac": raw_Z_ac, "raw_Z_c": raw_Z_c}
+    )
+    monkeypatch.setattr(
+        mle_dw_extrapolator.objective_factory, "sample_specs", sample_specs
+    )
+    objective = None
+    try:
+        objective = mle_dw_extrapolator.objective_factory(
+            args, cols, ds_all.CENTRIC.to_numpy(bool)
+        )
+        yield objective
+    finally:
+        if objective is not None:
+            objective._pool.close()
+            objective._pool.join()
+            release_shared_arrays(objective._handles)
+        release_shared_arrays(sample_handles)
+
+
+def test_mle_objective_memoized(mtz_files, monkeypatch):
+    """Repeated points should be evaluated once, within a batch and across calls"""
+    with _mle_objective(mtz_files, monkeypatch) as objective:
+        nll = objective.batch([(0.9, 0.125), (0.8, 0.3), (0.9, 0.125)])
+        assert nll[0] == nll[2] and len(objective.evaluations) == 2
+        assert objective.cache_hits == 0
+        assert objective(np.array([0.8, 0.3])) == nll[1]
+        assert objective.cache_hits == 1 and len(objective.evaluations) == 2
+    assert np.isclose(nll[1], _mle_nll(mtz_files, 0.8, 0.3), rtol=1e-9)
+
+
+def test_mle_dw_extrapolate_callback(mtz_files, tmp_path, monkeypatch):
+    """The optimizer callback should reuse the cached NLL of every iterate"""
+    result = _mle_fit(mtz_files, tmp_path, monkeypatch, "--maxiter", 2)
+    points = [(e["r"], e["p"]) for e in result["evaluations"]]
+    assert len(set(points)) == len(points)
+    assert result["cache_hits"] > 0
+
+
+def test_mle_objective_minibatch(mtz_files, monkeypatch):
+    """A minibatch of every reflection with weights 1/n should give the mean NLL and its
+    forward-difference gradient"""
+    with _mle_objective(mtz_files, monkeypatch) as objective:
+        theta = np.array([0.8, 0.3])
+        nrefl = len(rs.read_mtz(mtz_files["on"]))
+        indices = np.arange(nrefl)
+        nll, grad = objective.minibatch(theta, indices, np.full(nrefl, 1.0 / nrefl))
+        nll_r, nll_p = objective.batch([theta + [1e-6, 0], theta + [0, 1e-6]])
+        full = objective(theta)
+    assert np.isclose(nll, full / nrefl, rtol=1e-9)
+    assert np.allclose(grad, (np.array([nll_r, nll_p]) - full) / 1e-6 / nrefl)
+
+
+def test_mle_dw_extrapolate_adam(mtz_files, tmp_path, monkeypatch):
+    """--optimizer adam should record every stochastic step within the bounds and
+    report the full-data NLL of the polished result"""
+    options = ["--optimizer", "adam", "--steps", 3, "--batch-size", 100]
+    result = _mle_fit(mtz_files, tmp_path, monkeypatch, *options, "--polish-iter", 1)
+    history = result["stochastic"]["history"]
+    assert len(history) == 3
+    for step in history:
+        assert 0 < step["r"] < 1 and 0 < step["p"] < 1
+        assert np.isfinite(step["batch_nll"])
+    assert np.isclose(result["fun"], _mle_nll(mtz_files, result["r"], result["p"]))
+
+
+def test_mle_dw_extrapolate_bayes(mtz_files, tmp_path, monkeypatch):
+    """--optimizer bayes should spend exactly its budget in rounds of --bo-batch points
+    and return one of the evaluated points"""
+    options = ["--optimizer", "bayes", "--bo-budget", 4, "--bo-init", 2]
+    result = _mle_fit(mtz_files, tmp_path, monkeypatch, *options, "--bo-batch", 2)
+    evaluations = result["evaluations"]
+    assert len(evaluations) == result["nfev"] == 4
+    assert [h["nevals"] for h in result["bayes"]["history"]] == [2, 4]
+    assert (evaluations[0]["r"], evaluations[0]["p"]) == (0.9, 0.125)
+    evaluated = {(e["r"], e["p"]): e["nll"] for e in evaluations}
+    assert evaluated[result["r"], result["p"]] == result["fun"]
+    assert np.isclose(result["fun"], _mle_nll(mtz_files, result["r"], result["p"]))
+
+
+def test_mle_objective_worker_state(mtz_files, monkeypatch):
+    """Workers holding the columns for the whole fit should rebuild their sample table
+    whenever theta changes, also when returning to an earlier point"""
+    points = [(0.9, 0.125), (0.8, 0.3), (0.85, 0.2)]
+    with _mle_objective(mtz_files, monkeypatch, "--nproc", 3) as objective:
+        first = objective.batch(points[:2])
+        last = objective(np.array(points[2]))
+        again = objective.batch([(0.9, 0.125 + 1e-9)])
+    nll = first + [last]
+    for (r, p), value in zip(points, nll):
+        assert np.isclose(value, _mle_nll(mtz_files, r, p), rtol=1e-9)
+    assert again[0] != nll[0] and np.isclose(again[0], nll[0], rtol=1e-6)
+
+
+def test_mle_dw_extrapolate_subset(mtz_files, tmp_path, monkeypatch):
+    """--subset should fit the reflections of ds_all.sample(subset, random_state=seed),
+    with the inputs prepared from the full data"""
+    ds_all, _, cols_all = dw_common.prepare_reflections(
+        mtz_files["on"], mtz_files["off"]
+    )
+    rows = ds_all.index.get_indexer(ds_all.sample(200, random_state=13).index)
+    objective_factory = mle_dw_extrapolator.objective_factory
+    fitted = []
+
+    def recording_objective_factory(args, cols, centric):
+        fitted.append(cols)
+        return objective_factory(args, cols, centric)
+
+    monkeypatch.setattr(
+        mle_dw_extrapolator, "objective_factory", recording_objective_factory
+    )
+    result = _mle_fit(mtz_files, tmp_path, monkeypatch, "--subset", 200, "--maxiter", 1)
+    assert result["subset"] == 200
+    for key, value in cols_all.items():
+        assert np.array_equal(fitted[0][key], value[rows])
+    evaluation = result["evaluations"][0]
+    nll = _mle_nll(mtz_files, evaluation["r"], evaluation["p"], rows=rows)
+    assert np.isclose(evaluation["nll"], nll, rtol=1e-9)
+
+
+def test_mle_dw_extrapolate_extrapolate(mtz_files, tmp_path, monkeypatch, capsys):
+    """--extrapolate should write the rs.dw_extrapolate columns of every reflection at
+    the fitted (r, p), estimated against the samples of the fit"""
+    out = tmp_path / "fit.mtz"
+    options = ["--subset", 200, "--maxiter", 1, "--extrapolate", out]
+    result = _mle_fit(mtz_files, tmp_path, monkeypatch, *options)
+    raw_Z_ac, raw_Z_c = _mle_draws()
+    table = sample_table(raw_Z_ac, raw_Z_c, result["r"], result["p"])
+    ds_all, expected = _dw_reference(mtz_files, table)
+    ds = _assert_matches(out, ds_all, expected)
+    assert list(ds.columns) == [*DW_COLUMNS, "CENTRIC"]
+    assert len(ds) > result["subset"]
+    nll_full = result["extrapolate"]["nll_full"]
+    assert np.isclose(nll_full, -np.sum(expected["loglik"]), rtol=1e-6)
+    assert f"full-data NLL = {nll_full:.4f}" in capsys.readouterr().out
+
+
+def test_prepare_reflections(mtz_files):
+    """Explicit F/SigF column names should give the default inputs, and unknown or
+    miscounted column names should be rejected"""
+    _, model, cols = dw_common.prepare_reflections(mtz_files["on"], mtz_files["off"])
+    for names in (["F", "SigF"], ["F", "SigF", "F", "SigF"]):
+        _, _, named = dw_common.prepare_reflections(
+            mtz_files["on"], mtz_files["off"], use_structure_factors=names
+        )
+        assert model == "SF" and named.keys() == cols.keys()
+        for key, value in cols.items():
+            assert np.allclose(named[key], value)
+    with pytest.raises(ValueError, match="-use_SF requires 2 or 4 column names"):
+        dw_common.prepare_reflections(
+            mtz_files["on"], mtz_files["off"], use_structure_factors=["F"] * 3
+        )
+    with pytest.raises(ValueError, match="Column\\(s\\) I, SigI not found"):
+        dw_common.prepare_reflections(
+            mtz_files["on"], mtz_files["off"], use_intensities=["I", "SigI"]
+        )
+
+
+def test_mle_dw_extrapolate_mpi(mtz_files, tmp_path, monkeypatch):
+    """--backend mpi on a single rank should evaluate the NLLs of --backend pool and
+    extrapolate the same way"""
+    pytest.importorskip("mpi4py")
+    results = {}
+    for backend in ("pool", "mpi"):
+        options = ["--backend", backend, "--maxiter", 2]
+        options += ["--extrapolate", tmp_path / f"{backend}.mtz"]
+        results[backend] = _mle_fit(mtz_files, tmp_path, monkeypatch, *options)
+    pool, mpi = results["pool"], results["mpi"]
+    assert mpi["backend"] == "mpi" and mpi["nproc"] == 1
+    assert len(mpi["evaluations"]) == len(pool["evaluations"])
+    for a, b in zip(mpi["evaluations"], pool["evaluations"]):
+        assert np.allclose([a["r"], a["p"], a["nll"]], [b["r"], b["p"], b["nll"]])
+    assert np.isclose(mpi["extrapolate"]["nll_full"], pool["extrapolate"]["nll_full"])
+    pool, mpi = (rs.read_mtz(str(tmp_path / f"{b}.mtz")) for b in ("pool", "mpi"))
+    for col in DW_COLUMNS:
+        assert np.allclose(mpi[col].to_numpy(float), pool[col].to_numpy(float))
+
+
+def test_mle_dw_extrapolate_memory_budget(mtz_files, tmp_path, monkeypatch):
+    """--memory-budget should report a plan within the budget without changing the
+    NLL values, and reject budgets too small for a single worker"""
+    result = _mle_fit(
+        mtz_files, tmp_path, monkeypatch, "--memory-budget", 4000, "--maxiter", 1
+    )
+    plan = result["plan"]
+    assert 1 <= plan["nproc"] <= 2 and plan["estimated_mb"] <= 4000
+    for evaluation in result["evaluations"]:
+        expected = _mle_nll(mtz_files, evaluation["r"], evaluation["p"])
+        assert np.isclose(evaluation["nll"], expected, rtol=1e-9)
+    with pytest.raises(ValueError, match="too small"):
+        _mle_fit(mtz_files, tmp_path, monkeypatch, "--memory-budget", 10)
+
+
+def test_mle_dw_extrapolate_sample_bank(mtz_files, tmp_path, monkeypatch):
+    """Fits from --sample-bank draws should evaluate the NLL of freshly drawn samples"""
+    options = ["--sample-bank", tmp_path / "bank", "--maxiter", 1]
+    for _ in range(2):
+        result = _mle_fit(mtz_files, tmp_path, monkeypatch, *options)
+        for evaluation in result["evaluations"]:
+            expected = _mle_nll(mtz_files, evaluation["r"], evaluation["p"])
+            assert np.isclose(evaluation["nll"], expected, rtol=1e-9)
+    assert result["sample_bank"] == str(tmp_path / "bank")
+
+
+@pytest.mark.parametrize("gradient", ["fd", "analytic"])
+def test_mle_dw_extrapolate_objective(mtz_files, tmp_path, monkeypatch, gradient):
+    """The NLL of the fit and of --extrapolate at the fitted (r, p) should use the same
+    k"""
+    out = tmp_path / "fit.json"
+    argv = [
+        "--onmtz",
+        mtz_files["on"],
+        "--offmtz",
+        mtz_files["off"],
+        "-n",
+        1024,
+        "--nproc",
+        2,
+        "-o",
+        out,
+    ]
+    argv += [
+        "--maxiter",
+        2,
+        "--gradient",
+        gradient,
+        "--extrapolate",
+        tmp_path / "fit.mtz",
+    ]
+    argv += ["--disable_progress_bar"]
+    _run(mle_dw_extrapolator.main, monkeypatch, argv)
+    with open(out) as f:
+        result = json.load(f)
+    assert result["gradient"] == gradient
+    assert result["k"] == ("median" if gradient == "fd" else "analytic")
+    assert np.isclose(result["extrapolate"]["nll_full"], result["fun"], rtol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        ["--optimizer", "bayes", "--gradient", "analytic"],
+        ["--engine", "histogram", "--gradient", "analytic"],
+        ["--control-variates", "--gradient", "analytic"],
+    ],
+)
+def test_mle_dw_extrapolate_options(mtz_files, tmp_path, monkeypatch, options):
+    """Analytic gradients should be rejected for optimizers and estimates that cannot
+    use them"""
+    argv = [
+        "--onmtz",
+        mtz_files["on"],
+        "--offmtz",
+        mtz_files["off"],
+        "-n",
+        1024,
+        "-o",
+        tmp_path / "fit.json",
+    ]
+    with pytest.raises(ValueError):
+        _run(mle_dw_extrapolator.main, monkeypatch, argv + options)
+
+
+def test_mle_dw_extrapolate_grid(mtz_files, tmp_path, monkeypatch):
+    """--grid should write the NLL surface of the whole grid and its profile
+    likelihoods"""
+    options = ["--grid", tmp_path / "grid", "--grid-r", 0.7, 0.9, 3]
+    options += ["--grid-p", 0.1, 0.3, 4]
+    _mle_fit(mtz_files, tmp_path, monkeypatch, *options)
+    grid = np.load(tmp_path / "grid.npz")
+    r_values, p_values = np.linspace(0.7, 0.9, 3), np.linspace(0.1, 0.3, 4)
+    expected = [[_mle_nll(mtz_files, r, p) for p in p_values] for r in r_values]
+    assert np.allclose(grid["nll"], expected, rtol=1e-9)
+    assert np.allclose(grid["profile_r"], grid["nll"].min(axis=1))
+    assert np.allclose(grid["profile_p"], grid["nll"].min(axis=0))
+    surface = np.loadtxt(tmp_path / "grid.csv", delimiter=",", skiprows=1)
+    assert surface.shape == (12, 4)